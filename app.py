@@ -1,15 +1,16 @@
 """Flask app for the Carousell Scalper API."""
 
 import re
-import os
 import logging
 from datetime import datetime
 from dotenv import load_dotenv
 from dateutil.relativedelta import relativedelta
 
-from flask import request, jsonify, Flask
-from pocketbase import PocketBase, utils as pbutils
-from workers.carousell_scalper_worker import scrape_carousell_with_params
+from flask import request, jsonify, Flask, Response
+from pocketbase import utils as pbutils
+import repository
+from metrics import render_metrics
+from workers.carousell_scalper_worker import scrape_ready_alerts
 
 load_dotenv()
 
@@ -19,63 +20,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-client = PocketBase(os.getenv("POCKETBASE_URL"))
-
-
 app = Flask(__name__)
 
 
 @app.route("/scrape-carousell")
 def scrape_carousell():
-    """Scrape carousell,
+    """Scrape carousell, by running the scheduler now instead of waiting for its
+    next tick, so alerts are only ever dispatched by the scheduler task.
 
     Returns:
         JSON: Return statement to api.
     """
-    try:
-        alerts_to_scrape = client.collection("alerts").get_full_list(
-            query_params={
-                "filter": f"""status = "ready_to_search" &&
-                                        next_time_to_run < "{datetime.today()}" &&
-                                        expire_at > "{datetime.today()}" """
-            }
-        )
-
-        for alert in alerts_to_scrape:
-            print(alert.id)
-            user_id = (
-                client.collection("chats")
-                .get_list(1, 1, query_params={"filter": f'id = "{alert.created_by}"'})
-                .items[0]
-                .user_id
-            )
-
-            if user_id is None:
-                continue
-
-            if alert.url is not None:
-                scrape_carousell_with_params.delay(
-                    alert.id,
-                    user_id,
-                    initial_url=alert.url,
-                    is_first_time=alert.is_first_scrape,
-                )
-            else:
-                scrape_carousell_with_params.delay(
-                    alert.id,
-                    user_id,
-                    query=alert.query,
-                    from_range=alert.from_price,
-                    to_range=alert.to_price,
-                    is_first_time=alert.is_first_scrape,
-                )
-
-    except pbutils.ClientResponseError as error:
-        return (
-            jsonify({"status": "not ok", "message": error.data["message"]}),
-            error.status,
-        )
-
+    scrape_ready_alerts.delay()
     return jsonify({"ok": "ok"}), 200
 
 
@@ -104,7 +60,7 @@ def register_client_alert_request():
         api_key = query + "_" + expiry_date.strftime("%d/%m/%Y_%H:%M:%S")
         cleaned_api_key = re.sub(r"[^\w\s]", "", api_key)
         cleaned_api_key = re.sub(r"\s+", "-", cleaned_api_key)
-        client.collection("alerts").create(
+        repository.create_alert(
             {
                 "query": query,
                 "from_price": from_price,
@@ -128,6 +84,16 @@ def register_client_alert_request():
         return jsonify({"status": "not ok", "message": error})
 
 
+@app.route("/metrics")
+def metrics():
+    """Metrics of the app in the prometheus text format.
+
+    Returns:
+        Response: Metrics, one sample a line.
+    """
+    return Response(render_metrics(), mimetype="text/plain")
+
+
 @app.route("/")
 def index():
     """Nothing much here yet.
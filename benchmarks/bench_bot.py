@@ -0,0 +1,187 @@
+"""Load test of the bot handlers against a PocketBase stand-in with latency.
+
+/check_alerts_left and /my_alerts updates of every user are queued at once to a
+running Application with the handlers of the bot, which takes them one at a time
+like it does when polling, and timed until their reply is sent. It runs with the db calls blocking the
+event loop like the handlers used to, with them awaited but every handler
+blocking the next update, and with the handlers as the bot registers them.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_bot [--users 200] [--latency-ms 20]
+"""
+
+import io
+import time
+import asyncio
+import logging
+import argparse
+import contextlib
+from datetime import datetime
+
+from telegram import Chat, Message, MessageEntity, Update, User
+from telegram.ext import Application, ExtBot
+
+import db
+import bot
+import repository
+from benchmarks.stubs import StubPocketBase
+
+COMMANDS = ("check_alerts_left", "my_alerts")
+
+
+class BenchBot(ExtBot):
+    """Bot which knows itself without asking telegram and keeps the messages it
+    sends."""
+
+    def __init__(self):
+        super().__init__("1:bench")
+        with self._unfrozen():
+            self.replies = []
+
+    async def get_me(self, *args, **kwargs):
+        with self._unfrozen():
+            self._bot_user = User(1, "bench", True, username="bench_bot")
+        return self._bot_user
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        self.replies.append((time.perf_counter(), text))
+
+
+def make_update(application: Application, update_id: int, user_id: int, command: str):
+    user = User(user_id, "user", False)
+    message = Message(
+        update_id,
+        datetime.now(),
+        Chat(user_id, Chat.PRIVATE),
+        from_user=user,
+        text=f"/{command}",
+        entities=[MessageEntity(MessageEntity.BOT_COMMAND, 0, len(command) + 1)],
+    )
+    message.set_bot(application.bot)
+    return Update(update_id, message=message)
+
+
+def seed(client: StubPocketBase, users: int, alerts_per_user: int, listings: int):
+    for user_id in range(users):
+        chat = client.seed("chats", {"user_id": str(user_id)})
+        client.seed(
+            "codes",
+            {
+                "code": f"code{user_id}",
+                "subscribed_by": chat["id"],
+                "alert_amt_to_give": 5,
+            },
+        )
+        for _ in range(alerts_per_user):
+            alert = client.seed(
+                "alerts",
+                {
+                    "created_by": chat["id"],
+                    "query": "ipad",
+                    "url": None,
+                    "from_price": 0,
+                    "to_price": 0,
+                    "expire_at": "2030-01-01T00:00:00",
+                },
+            )
+            for index in range(listings):
+                client.seed(
+                    "listings", {"alert_id": alert["id"], "listing_id": str(index)}
+                )
+
+
+async def run_blocking(call, *args, **kwargs):
+    """How the handlers ran their db calls before, on the event loop itself."""
+    return call(*args, **kwargs)
+
+
+def percentile(values: list, fraction: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def dispatch(application: Application, updates: list):
+    """Queue the updates for the update fetcher of the running application and
+    wait until each got its reply."""
+    for update in updates:
+        await application.update_queue.put(update)
+    while len(application.bot.replies) < len(updates):
+        await asyncio.sleep(0.001)
+
+
+def bench(name: str, run_db, block_all: bool, users: int):
+    """Handle an update of each command for every user, all received at once.
+
+    Returns:
+        float: Updates handled per second.
+    """
+    bot.run_async = run_db
+    repository.chat_id_cache.clear()
+    repository.chat_user_id_cache.clear()
+    repository.query_cache.clear()
+
+    bench_bot = BenchBot()
+    application = Application.builder().bot(bench_bot).build()
+    bot.add_handlers(application)
+    if block_all:
+        for handler in application.handlers[0]:
+            handler.block = True
+
+    updates = [
+        make_update(application, len(COMMANDS) * user_id + index, user_id, command)
+        for user_id in range(users)
+        for index, command in enumerate(COMMANDS)
+    ]
+
+    async def main():
+        await application.initialize()
+        await application.start()
+        start = time.perf_counter()
+        await dispatch(application, updates)
+        await application.stop()
+        await application.shutdown()
+        return start
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = asyncio.run(main())
+
+    latencies = [sent_at - start for sent_at, _ in bench_bot.replies]
+    elapsed = max(latencies)
+    errors = sum("wrong" in text or "try again" in text for _, text in bench_bot.replies)
+    print(
+        f"{name:<11} {len(latencies) / elapsed:8.1f} updates/s "
+        f"p50 {percentile(latencies, 0.5) * 1000:7.0f}ms "
+        f"p95 {percentile(latencies, 0.95) * 1000:7.0f}ms "
+        f"replies {len(latencies)}/{len(updates)} errors {errors}"
+    )
+    return len(latencies) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--alerts-per-user", type=int, default=3)
+    parser.add_argument("--listings-per-alert", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    logging.getLogger("telegram.ext").setLevel(logging.WARNING)
+    client = StubPocketBase(latency_seconds=args.latency_ms / 1000)
+    seed(client, args.users, args.alerts_per_user, args.listings_per_alert)
+    repository.get_client = lambda: client
+    db.get_client = lambda: client
+    db.async_client = db.AsyncPocketBase(client, args.concurrency)
+
+    print(
+        f"{args.users * 2} updates from {args.users} users, "
+        f"{args.latency_ms:.0f}ms per db call, {args.concurrency} db calls at once"
+    )
+    baseline = bench("blocking", run_blocking, True, args.users)
+    bench("in order", db.run_async, True, args.users)
+    speedup = bench("block=False", db.run_async, False, args.users)
+    print(f"{'':<11} {speedup / baseline:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Time-to-parse and bytes transferred of a search page, with the full browser
+profile against the lean one, and the bytes sent back by the browser for the
+whole page_source against the card fields of the in-browser extraction.
+
+Needs a selenium server at SELENIUM_URL, and loads the real page.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_browser_profile [--query iphone] [--repeat 5]
+"""
+
+import io
+import os
+import json
+import time
+import random
+import argparse
+import contextlib
+from urllib.parse import urlparse
+
+from dotenv import load_dotenv
+
+import workers.carousell_scalper_worker as worker
+from constants import USER_AGENTS
+from workers.listing_extractor import (
+    CARD_CSS,
+    CARD_FIELDS_SCRIPT,
+    NAME_STYLE_PATTERN,
+    SELLER_TESTID,
+    extract_listings,
+    extract_listings_from_cards,
+    get_currency_pattern,
+)
+from workers.browser_profile import execute_cdp_command, get_transfer_bytes
+
+
+def percentile(values: list, fraction: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def load(driver, url: str, in_browser: bool):
+    """Load the page from a cold cache and parse it.
+
+    Returns:
+        tuple: Seconds to parse, bytes transferred, bytes sent back by the browser
+        and listings found.
+    """
+    driver.get("about:blank")
+    try:
+        execute_cdp_command(driver, "Network.clearBrowserCache")
+    except Exception as error:
+        print(f"Could not clear the cache, later loads may be cached... {error}")
+
+    start = time.perf_counter()
+    driver.get(url)
+    worker.wait_for_cards(driver)
+    hostname = urlparse(url).hostname
+    if in_browser:
+        cards = driver.execute_script(
+            CARD_FIELDS_SCRIPT,
+            CARD_CSS,
+            SELLER_TESTID,
+            get_currency_pattern(hostname).pattern,
+            NAME_STYLE_PATTERN.pattern,
+        )
+        items = extract_listings_from_cards(cards, None, hostname)
+        payload_bytes = len(json.dumps(cards).encode())
+    else:
+        page_source = driver.page_source
+        items = extract_listings(page_source, None, hostname)
+        payload_bytes = len(page_source.encode())
+    seconds = time.perf_counter() - start
+
+    return seconds, get_transfer_bytes(driver), payload_bytes, len(items)
+
+
+def bench(name: str, lean: bool, in_browser: bool, url: str, repeat: int):
+    """Load the page `repeat` times in a session of the profile.
+
+    Returns:
+        tuple: Median seconds to parse, bytes transferred and bytes sent back.
+    """
+    os.environ["LEAN_BROWSER_PROFILE"] = "true" if lean else "false"
+    with contextlib.redirect_stdout(io.StringIO()):
+        driver = worker.set_up_driver_option(random.choice(USER_AGENTS))
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = [load(driver, url, in_browser) for _ in range(repeat)]
+    finally:
+        driver.quit()
+
+    seconds = percentile([result[0] for result in results], 0.5)
+    transfer_bytes = percentile([result[1] for result in results], 0.5)
+    payload_bytes = percentile([result[2] for result in results], 0.5)
+    print(
+        f"{name:<13} time-to-parse p50 {seconds:6.2f}s "
+        f"max {max(result[0] for result in results):6.2f}s "
+        f"transferred {transfer_bytes / 1024:7.0f} KB "
+        f"sent back {payload_bytes / 1024:6.0f} KB "
+        f"listings {results[-1][3]}"
+    )
+    return seconds, transfer_bytes, payload_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--query", default="iphone")
+    parser.add_argument("--url", help="Search page to load, instead of --query")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    load_dotenv()
+    if os.getenv("SELENIUM_URL") is None:
+        parser.error("SELENIUM_URL is not set")
+
+    url = args.url or worker.set_up_scape_url(args.query, 0, 0)
+    print(f"{url}, {args.repeat} cold loads each")
+
+    full_seconds, full_bytes, page_bytes = bench("full", False, False, url, args.repeat)
+    lean_seconds, lean_bytes, _ = bench("lean", True, False, url, args.repeat)
+    script_seconds, _, card_bytes = bench("lean + script", True, True, url, args.repeat)
+    print(
+        f"lean is {full_seconds / max(lean_seconds, 1e-9):.1f}x faster to parse and "
+        f"transfers {1 - lean_bytes / max(full_bytes, 1):.0%} fewer bytes, "
+        f"with the script {full_seconds / max(script_seconds, 1e-9):.1f}x faster "
+        f"and the browser sends back {1 - card_bytes / max(page_bytes, 1):.0%} fewer"
+    )
+
+
+if __name__ == "__main__":
+    main()
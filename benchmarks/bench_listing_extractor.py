@@ -0,0 +1,135 @@
+"""Microbenchmark of the listing extractor against the original scrape_page.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_listing_extractor [--repeat 20]
+"""
+
+import re
+import time
+import argparse
+import contextlib
+import io
+from datetime import date
+
+from bs4 import BeautifulSoup
+
+from benchmarks.pages import load_pages
+from constants import CURRENCY_MAP
+from workers.listing_extractor import (
+    BS4_BACKEND,
+    BS4_PARSER,
+    HTMLParser,
+    SELECTOLAX_BACKEND,
+    extract_listings,
+)
+
+
+def legacy_scrape_page(soup: BeautifulSoup, alert_id: str, hostname: str):
+    """scrape_page as it was before the extractor, kept to compare against."""
+    item_listings = soup.find_all("div", {"data-testid": re.compile("listing-card-")})
+
+    items_found = []
+    for item_listing in item_listings:
+        try:
+            seller = item_listing.find(
+                "p", {"data-testid": "listing-card-text-seller-name"}
+            ).getText()
+            price_result = item_listing.find(
+                "p",
+                {
+                    "title": re.compile(
+                        CURRENCY_MAP[hostname.split(".")[len(hostname.split(".")) - 1]]
+                    )
+                },
+            )
+            price = price_result.getText() if price_result else "0"
+            name = item_listing.find("p", {"style": re.compile("--max-line")}).getText()
+
+            item_id = item_listing["data-testid"].split("-")[2]
+            urlify_name = name
+            urlify_name = re.sub(r"[^\w\s]", "", urlify_name)
+            urlify_name = re.sub(r"\s+", "-", urlify_name)
+            if urlify_name[0] == "-":
+                urlify_name = urlify_name[1:]
+            if urlify_name[-1] == "-":
+                urlify_name = urlify_name[:-1]
+            item_url = f"{hostname}/p/{urlify_name}-{item_id}"
+            clean_price = price.replace("$", "").replace(",", "")
+            clean_price = re.sub(r"[a-zA-Z]", r"", clean_price).strip()
+
+            items_found.append(
+                {
+                    "listing_id": item_id,
+                    "detail_url": item_url,
+                    "image_url": item_listing.find_all("img")[0].get("src"),
+                    "name": name,
+                    "price": float(clean_price),
+                    "seller": seller,
+                    "date_found": date.today().isoformat(),
+                    "alert_id": alert_id,
+                }
+            )
+        except Exception:
+            continue
+
+    return items_found
+
+
+def run_legacy(html, hostname):
+    return legacy_scrape_page(BeautifulSoup(html, "html.parser"), "alert", hostname)
+
+
+def run_bs4(html, hostname):
+    return extract_listings(html, "alert", hostname, backend=BS4_BACKEND)
+
+
+def run_selectolax(html, hostname):
+    return extract_listings(html, "alert", hostname, backend=SELECTOLAX_BACKEND)
+
+
+def bench(name, run, pages, repeat):
+    """Time `run` over every page and check it matches the legacy output.
+
+    Returns:
+        float: Items extracted per second.
+    """
+    expected = [run_legacy(html, hostname) for hostname, html in pages]
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = [run(html, hostname) for hostname, html in pages]
+    if results != expected:
+        raise AssertionError(f"{name} does not give the same items as scrape_page")
+
+    num_of_items = 0
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            for hostname, html in pages:
+                num_of_items += len(run(html, hostname))
+    elapsed = time.perf_counter() - start
+
+    per_page_ms = elapsed / (repeat * len(pages)) * 1000
+    print(f"{name:<28} {per_page_ms:8.2f} ms/page {num_of_items / elapsed:10.0f} items/s")
+    return num_of_items / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    pages = load_pages()
+    print(
+        f"{len(pages)} pages, {sum(len(html) for _, html in pages) // len(pages)} bytes"
+        f" and {len(run_legacy(*pages[0][::-1]))} listings each"
+    )
+
+    baseline = bench("scrape_page (html.parser)", run_legacy, pages, args.repeat)
+    speedup = bench(f"extractor bs4 ({BS4_PARSER})", run_bs4, pages, args.repeat)
+    print(f"{'':<28} {speedup / baseline:8.1f}x")
+    if HTMLParser is not None:
+        speedup = bench("extractor selectolax", run_selectolax, pages, args.repeat)
+        print(f"{'':<28} {speedup / baseline:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""Offline benchmark of the scrape pipeline, replaying search pages through
+scrape_page, create_listing_to_db and send_messages.
+
+PocketBase and Telegram are replaced by the stand-ins of benchmarks.stubs, with
+a latency on every call. Every page is scraped for an alert of its own. The
+listings of a first round are saved without being measured, then in every
+measured round a share of the listings is new, like a search which gets a few new
+listings between scrapes. Telegram's rate limits are off unless given.
+
+Run from the root of the repo:
+    python -m benchmarks.bench_pipeline [--rounds 10] [--db-latency-ms 5]
+    python -m benchmarks.bench_pipeline --save baseline.json
+    python -m benchmarks.bench_pipeline --baseline baseline.json [--tolerance 0.2]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import contextlib
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+import repository
+import workers.carousell_scalper_worker as worker
+from benchmarks.pages import load_pages
+from benchmarks.stubs import StubBot, StubPocketBase
+from workers.listing_extractor import BS4_PARSER
+from workers.telegram_sender import TelegramSender
+
+STAGES = ("parse", "save", "send", "total")
+
+
+def percentile(values: list, fraction: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def set_up(args):
+    """Point the worker at the stand-ins.
+
+    Returns:
+        tuple: The PocketBase stand-in and the telegram sender.
+    """
+    os.environ["SEEN_INDEX_DIR"] = tempfile.mkdtemp(prefix="bench-seen-index-")
+
+    client = StubPocketBase(latency_seconds=args.db_latency_ms / 1000)
+    worker.get_client = lambda: client
+    repository.get_client = lambda: client
+
+    sender = TelegramSender(
+        None,
+        global_rate=args.global_rate,
+        chat_rate=args.chat_rate,
+        bot=StubBot(latency_seconds=args.telegram_latency_ms / 1000),
+    )
+    worker.telegram_sender = sender
+    worker.telegram_sender_pid = os.getpid()
+    return client, sender
+
+
+def renew_listings(items: list, round_index: int, new_fraction: float):
+    """Give the newest share of the listings ids not seen in earlier rounds."""
+    for item in items[: round(len(items) * new_fraction)]:
+        item["listing_id"] = f"{item['listing_id']}{round_index:04d}"
+    return items
+
+
+def scrape(page_index: int, hostname: str, html: str, round_index: int, args):
+    """Scrape one page for its alert and send the new listings to its chat.
+
+    Returns:
+        dict: Seconds of each stage, items parsed and listings created.
+    """
+    alert_id = f"benchalert{page_index:05d}"
+
+    start = time.perf_counter()
+    items = worker.scrape_page(BeautifulSoup(html, BS4_PARSER), alert_id, hostname)
+    parsed_at = time.perf_counter()
+
+    if round_index > 0:
+        items = renew_listings(items, round_index, args.new_fraction)
+    num_of_created, messages, _ = worker.create_listing_to_db(
+        items, alert_id, hostname=hostname
+    )
+    saved_at = time.perf_counter()
+
+    if num_of_created > 0:
+        worker.send_messages(
+            f"benchchat{page_index}", messages, query="bench", from_range=0, to_range=0
+        ).result()
+    sent_at = time.perf_counter()
+
+    return {
+        "parse": parsed_at - start,
+        "save": saved_at - parsed_at,
+        "send": sent_at - saved_at,
+        "total": sent_at - start,
+        "items": len(items),
+        "created": num_of_created,
+    }
+
+
+def run(pages: list, rounds: range, args):
+    """Scrape every page once a round.
+
+    Returns:
+        dict: Items per second, listings created per second and the seconds of
+        each scrape by stage.
+    """
+    timings = {stage: [] for stage in STAGES}
+    num_of_items = num_of_created = 0
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for round_index in rounds:
+            for page_index, (hostname, html) in enumerate(pages):
+                result = scrape(page_index, hostname, html, round_index, args)
+                for stage in STAGES:
+                    timings[stage].append(result[stage])
+                num_of_items += result["items"]
+                num_of_created += result["created"]
+    elapsed = time.perf_counter() - start
+
+    return {
+        "items_per_second": num_of_items / elapsed,
+        "created_per_second": num_of_created / elapsed,
+        "timings": timings,
+    }
+
+
+def measure_peak_memory(pages: list, round_index: int, args):
+    """Run one more round with allocations traced.
+
+    Returns:
+        float: Peak of the memory allocated by python during the round, in MB.
+    """
+    tracemalloc.start()
+    try:
+        run(pages, range(round_index, round_index + 1), args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024 / 1024
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Check the results against a baseline saved by --save.
+
+    Returns:
+        list: Regressions found, empty when there are none.
+    """
+    regressions = []
+    if results["items_per_second"] < baseline["items_per_second"] * (1 - tolerance):
+        regressions.append(
+            f"items/s {results['items_per_second']:.1f} < "
+            f"{baseline['items_per_second']:.1f}"
+        )
+    for stage in STAGES:
+        now, then = results["p95_ms"][stage], baseline["p95_ms"][stage]
+        # Stages well under a millisecond are too noisy to compare.
+        if now > max(then * (1 + tolerance), then + 1):
+            regressions.append(f"{stage} p95 {now:.1f}ms > {then:.1f}ms")
+    if results["peak_memory_mb"] > baseline["peak_memory_mb"] * (1 + tolerance):
+        regressions.append(
+            f"peak memory {results['peak_memory_mb']:.1f}MB > "
+            f"{baseline['peak_memory_mb']:.1f}MB"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--new-fraction", type=float, default=0.1)
+    parser.add_argument("--db-latency-ms", type=float, default=5)
+    parser.add_argument("--telegram-latency-ms", type=float, default=50)
+    parser.add_argument("--global-rate", type=float, default=1000)
+    parser.add_argument("--chat-rate", type=float, default=1000)
+    parser.add_argument("--save", help="Save the results as a baseline")
+    parser.add_argument("--baseline", help="Fail when slower than this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    pages = load_pages()
+    client, sender = set_up(args)
+    print(
+        f"{len(pages)} pages, {args.rounds} rounds with {args.new_fraction:.0%} new "
+        f"listings, {args.db_latency_ms:.0f}ms per db call, "
+        f"{args.telegram_latency_ms:.0f}ms per telegram call"
+    )
+
+    try:
+        run(pages, range(0, 1), args)
+        measured = run(pages, range(1, args.rounds + 1), args)
+        peak_memory_mb = measure_peak_memory(pages, args.rounds + 1, args)
+    finally:
+        sender.close()
+
+    results = {
+        "items_per_second": measured["items_per_second"],
+        "created_per_second": measured["created_per_second"],
+        "p50_ms": {},
+        "p95_ms": {},
+        "p99_ms": {},
+        "peak_memory_mb": peak_memory_mb,
+        # ru_maxrss is in KB on linux.
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    print(
+        f"{results['items_per_second']:.1f} items/s, "
+        f"{results['created_per_second']:.1f} listings created/s"
+    )
+    print(f"{'stage':<8} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for stage in STAGES:
+        for name, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            results[name][stage] = percentile(measured["timings"][stage], fraction) * 1000
+        print(
+            f"{stage:<8} {results['p50_ms'][stage]:7.1f}ms "
+            f"{results['p95_ms'][stage]:7.1f}ms {results['p99_ms'][stage]:7.1f}ms"
+        )
+    print(
+        f"peak memory {results['peak_memory_mb']:.1f}MB traced, "
+        f"{results['max_rss_mb']:.1f}MB rss"
+    )
+    print(f"db calls {dict(sorted(client.calls.items()))}")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"saved to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regression against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
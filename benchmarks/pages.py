@@ -0,0 +1,100 @@
+"""Search pages replayed by the benchmarks.
+
+Saved pages can be dropped in benchmarks/pages as `<hostname>.<anything>.html`,
+e.g. `www.carousell.sg.iphone.html`. When there are none, pages shaped like a
+carousell search page are generated instead.
+"""
+
+import os
+import glob
+import random
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), "pages")
+DEFAULT_HOSTNAME = "www.carousell.sg"
+
+NAMES = [
+    "iPhone 14 Pro Max 256GB",
+    "Nintendo Switch OLED (like new)",
+    "IKEA Poang armchair - self collect!",
+    "Sony WH-1000XM4 headphones",
+    "Brompton M6L 2021",
+]
+
+
+def generate_card(listing_id: int, rng: random.Random):
+    """Generate the html of one listing card.
+
+    Args:
+        listing_id (int): Id of the listing.
+        rng (random.Random): Used to vary the card content.
+
+    Returns:
+        str: Html of the card.
+    """
+    name = rng.choice(NAMES)
+    price = f"S${rng.randint(1, 5000):,}"
+    return f"""
+<div data-testid="listing-card-{listing_id}" class="D_pj D_sz">
+  <div class="D_pq"><a href="/u/seller_{listing_id % 97}/">
+    <img src="https://media.karousell.com/avatar/{listing_id}.jpg" alt="seller">
+    <p data-testid="listing-card-text-seller-name" class="D_l2">seller_{listing_id % 97}</p>
+    <p class="D_l3">{rng.randint(1, 59)} minutes ago</p>
+  </a></div>
+  <a href="/p/{listing_id}/"><div class="D_ra">
+    <img src="https://media.karousell.com/photos/{listing_id}.jpg" alt="{name}">
+  </div>
+  <p class="D_l4" style="--max-line: 2;">{name}</p>
+  <div><p class="D_l5" title="{price}">{price}</p></div>
+  <p class="D_l6" style="--max-line: 1;">Like new</p></a>
+  <button aria-label="Like"><svg viewBox="0 0 24 24"><path d="M0 0h24v24H0z"></path></svg></button>
+</div>"""
+
+
+def generate_page(num_of_cards=40, seed=0):
+    """Generate a search page with scripts and layout around the listing cards.
+
+    Args:
+        num_of_cards (int, optional): Listing cards on the page. Defaults to 40.
+        seed (int, optional): Seed of the generated content. Defaults to 0.
+
+    Returns:
+        str: Html of the page.
+    """
+    rng = random.Random(seed)
+    filler_script = "<script>window.__tracking = " + "[1,2,3]," * 2000 + "[];</script>"
+    filler_nav = "".join(
+        f'<li class="D_nav"><a href="/categories/{i}/">Category {i}</a></li>'
+        for i in range(200)
+    )
+    # Newest listings first, like a search sorted by recency.
+    cards = "".join(
+        generate_card(1200000000 + seed * 1000 + num_of_cards - i, rng)
+        for i in range(num_of_cards)
+    )
+    return f"""<!DOCTYPE html>
+<html><head><title>Search</title>{filler_script}</head>
+<body><nav><ul>{filler_nav}</ul></nav>
+<main><div class="D_grid">{cards}</div>
+<button>Show more results</button></main>
+{filler_script}</body></html>"""
+
+
+def load_pages(num_of_cards=40):
+    """Load saved pages, or generate some when none are saved.
+
+    Args:
+        num_of_cards (int, optional): Cards of each generated page. Defaults to 40.
+
+    Returns:
+        list: (hostname, html) of each page.
+    """
+    pages = []
+    for path in sorted(glob.glob(os.path.join(PAGES_DIR, "*.html"))):
+        hostname = ".".join(os.path.basename(path).split(".")[:3])
+        with open(path, encoding="utf-8") as file:
+            pages.append((hostname, file.read()))
+
+    if len(pages) > 0:
+        return pages
+
+    return [(DEFAULT_HOSTNAME, generate_page(num_of_cards, seed)) for seed in range(5)]
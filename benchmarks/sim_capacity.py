@@ -0,0 +1,414 @@
+"""Capacity simulation of the scheduler and the scrape workers.
+
+Thousands of alerts are seeded into the PocketBase stand-in, then
+scrape_ready_alerts runs every tick like celery beat does, and the scrapes it
+queues run scrape_carousell_with_params and scrape_carousell_shared_query on
+`--concurrency` worker threads. Pages come from a fake fetch backend which waits
+a lognormal latency and needs one of `--selenium-sessions` for the browser, and
+new listings show up on each search at its own rate.
+
+Time is compressed by `--time-scale`: the tick, the adaptive intervals, leases
+and every latency are divided by it, and results are reported in simulated time.
+Keep the scale low enough for the stand-ins to keep up, the simulator warns when
+they do not.
+
+Run from the root of the repo:
+    python -m benchmarks.sim_capacity [--alerts 2000] [--minutes 30]
+        [--concurrency 3] [--selenium-sessions 3] [--time-scale 10]
+"""
+
+import io
+import os
+import sys
+import math
+import time
+import queue
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+from types import SimpleNamespace
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+
+import repository
+import workers.carousell_scalper_worker as worker
+from benchmarks.stubs import StubPocketBase
+from workers.fetchers import HTTP_BACKEND, SELENIUM_BACKEND, choose_fetch_backend
+from workers.leases import READY_STATUS
+from workers.listing_extractor import get_stop_after
+from workers.scheduler import (
+    canonicalize_url,
+    get_scrape_capacity,
+    parse_db_datetime,
+)
+
+QUERIES = ["iphone", "switch oled", "brompton", "ikea poang", "sony xm4", "lego"]
+
+
+def percentile(values: list, fraction: float):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def lognormal(median: float, sigma: float):
+    return median * math.exp(random.gauss(0, sigma))
+
+
+def poisson(mean: float):
+    """Draw a poisson count, by Knuth's method for small means."""
+    if mean > 30:
+        return max(0, round(random.gauss(mean, math.sqrt(mean))))
+
+    limit = math.exp(-mean)
+    count, product = 0, random.random()
+    while product > limit:
+        count += 1
+        product *= random.random()
+    return count
+
+
+class Simulation:
+    """Queue, workers, selenium sessions and pages of a simulated deployment.
+
+    Args:
+        args (Namespace): Arguments of the simulation.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.scale = args.time_scale
+        self.tasks = queue.Queue()
+        self.sessions = threading.BoundedSemaphore(args.selenium_sessions)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        # Next listing id and rate of new listings an hour of each search.
+        self.searches = {}
+        self.queue_waits = []
+        self.overdue = []
+        self.session_waits = []
+        self.scrapes = {}
+        self.busy_seconds = 0.0
+        self.session_seconds = 0.0
+        self.backends = {HTTP_BACKEND: 0, SELENIUM_BACKEND: 0}
+
+    def sim_sleep(self, seconds: float):
+        """Wait simulated seconds."""
+        time.sleep(seconds / self.scale)
+
+    def get_search(self, url: str):
+        with self.lock:
+            return self.searches.setdefault(
+                canonicalize_url(url),
+                {
+                    "next_listing_id": 1000000000,
+                    "rate": lognormal(self.args.listings_per_hour, 1.0),
+                    "fetched_at": time.monotonic(),
+                },
+            )
+
+    def fetch_listings(
+        self, url, is_first_time=False, fetch_backend=None, high_water_listing_id=None
+    ):
+        """Fake fetch_listings, a page of the newest listings of the search after
+        the latency of the backend."""
+        backend = choose_fetch_backend(fetch_backend, is_first_time)
+        if backend == HTTP_BACKEND:
+            self.sim_sleep(lognormal(self.args.http_seconds, 0.5))
+            if random.random() < self.args.http_fallback_rate:
+                backend = SELENIUM_BACKEND
+
+        if backend == SELENIUM_BACKEND:
+            start = time.monotonic()
+            with self.sessions:
+                acquired_at = time.monotonic()
+                seconds = lognormal(self.args.selenium_seconds, 0.4)
+                if is_first_time:
+                    seconds += lognormal(self.args.load_more_seconds, 0.4)
+                self.sim_sleep(seconds)
+            with self.lock:
+                self.session_waits.append((acquired_at - start) * self.scale)
+                self.session_seconds += time.monotonic() - acquired_at
+
+        search = self.get_search(url)
+        with self.lock:
+            now = time.monotonic()
+            hours = (now - search["fetched_at"]) * self.scale / 3600
+            search["fetched_at"] = now
+            num_of_new = min(40, poisson(search["rate"] * hours))
+            search["next_listing_id"] += num_of_new
+            newest = search["next_listing_id"]
+            self.backends[backend] += 1
+
+        # Like the extractor, stop a few listings after the high water mark.
+        num_of_items = 40 if is_first_time else num_of_new + get_stop_after()
+        items = [
+            {
+                "listing_id": str(newest - index),
+                "name": f"listing {newest - index}",
+                "price": 10.0,
+                "seller": "seller",
+                "detail_url": f"https://www.carousell.sg/p/{newest - index}",
+                "image_url": None,
+                "date_found": datetime.today().date().isoformat(),
+            }
+            for index in range(num_of_items)
+        ]
+        return items, backend
+
+    def make_task(self, task):
+        """Wrap a celery task so delay queues it for the worker threads."""
+        simulation = self
+
+        class SimulatedTask:
+            def delay(self, *args, **kwargs):
+                simulation.enqueue(task, args, kwargs)
+
+            def __call__(self, *args, **kwargs):
+                return task(*args, **kwargs)
+
+        return SimulatedTask()
+
+    def enqueue(self, task, args, kwargs):
+        jobs = args[0] if args else [kwargs]
+        now = datetime.today()
+        with self.lock:
+            for job in jobs:
+                alert = self.client.collections["alerts"][job["alert_id"]]
+                next_time_to_run = parse_db_datetime(alert.get("next_time_to_run"))
+                if next_time_to_run is not None:
+                    lag = (now - next_time_to_run).total_seconds()
+                    self.overdue.append(max(lag, 0) * self.scale)
+        self.tasks.put((task, args, kwargs, time.monotonic()))
+
+    def work(self):
+        """Run queued scrapes until the simulation stops, like a worker process."""
+        while not self.stopped.is_set():
+            try:
+                task, args, kwargs, enqueued_at = self.tasks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            started_at = time.monotonic()
+            try:
+                task(*args, **kwargs)
+            except Exception as error:
+                print(f"Task failed... {error}", file=sys.stderr)
+            finished_at = time.monotonic()
+
+            jobs = args[0] if args else [kwargs]
+            with self.lock:
+                self.queue_waits.append((started_at - enqueued_at) * self.scale)
+                self.busy_seconds += finished_at - started_at
+                for job in jobs:
+                    self.scrapes.setdefault(job["alert_id"], []).append(finished_at)
+
+    def beat(self, tick_seconds: float):
+        """Run the scheduler every tick, like celery beat."""
+        while not self.stopped.wait(tick_seconds / self.scale):
+            worker.scrape_ready_alerts()
+            worker.reap_alert_leases()
+
+    def set_up(self):
+        """Seed the alerts and point the worker at the simulation."""
+        args = self.args
+        for name, default in (
+            ("ADAPTIVE_MIN_SECONDS", "120"),
+            ("ADAPTIVE_MAX_SECONDS", "1800"),
+            ("SCRAPE_DEFAULT_SECONDS", "30"),
+        ):
+            os.environ[name] = str(float(os.getenv(name, default)) / self.scale)
+        lease_seconds = int(os.getenv("ALERT_LEASE_SECONDS", "600")) / self.scale
+        os.environ["ALERT_LEASE_SECONDS"] = str(math.ceil(lease_seconds))
+        os.environ["SCRAPE_WORKER_CONCURRENCY"] = str(args.concurrency)
+        os.environ["SELENIUM_MAX_SESSIONS"] = str(args.selenium_sessions)
+        os.environ["SEEN_INDEX_DIR"] = tempfile.mkdtemp(prefix="sim-seen-index-")
+        os.environ["NOTIFICATION_QUEUE_ENABLED"] = "true"
+        os.environ["DIGEST_WINDOW_SECONDS"] = "0"
+
+        self.client = StubPocketBase(latency_seconds=args.db_latency_ms / 1000 / self.scale)
+        worker.get_client = lambda: self.client
+        repository.get_client = lambda: self.client
+        worker.fetch_listings = self.fetch_listings
+        worker.get_queue_depth = self.tasks.qsize
+        worker.SCRAPE_TICK_SECONDS = args.tick_seconds / self.scale
+        # Capacity has a floor of a second a scrape, which holds in simulated time.
+        worker.get_scrape_capacity = lambda in_flight, seconds, tick: (
+            get_scrape_capacity(in_flight, seconds * self.scale, tick * self.scale)
+        )
+        worker.scrape_carousell_with_params = self.make_task(
+            worker.scrape_carousell_with_params
+        )
+        worker.scrape_carousell_shared_query = self.make_task(
+            worker.scrape_carousell_shared_query
+        )
+        # Notifications go out from their own queue, not the scrape workers.
+        worker.send_alert_notifications = SimpleNamespace(delay=lambda *a, **k: None)
+
+        now = datetime.today()
+        chats = [
+            self.client.seed("chats", {"user_id": str(index)})
+            for index in range(max(1, args.alerts // 3))
+        ]
+        for index in range(args.alerts):
+            query = f"{random.choice(QUERIES)} {index % args.unique_searches}"
+            search = self.get_search(worker.set_up_scape_url(query, 0, 0))
+            # Rates are per hour of real time, as the worker measures them.
+            rate = search["rate"] * self.scale
+            interval_seconds = random.uniform(0, args.tick_seconds * 10) / self.scale
+            self.client.seed(
+                "alerts",
+                {
+                    "created_by": random.choice(chats)["id"],
+                    "query": query,
+                    "url": "",
+                    "from_price": 0,
+                    "to_price": 0,
+                    "status": READY_STATUS,
+                    "is_first_scrape": random.random() < args.first_time_fraction,
+                    "fetch_backend": (
+                        SELENIUM_BACKEND
+                        if random.random() < args.selenium_fraction
+                        else HTTP_BACKEND
+                    ),
+                    "high_water_listing_id": str(search["next_listing_id"]),
+                    "listing_rate": rate,
+                    "last_scraped_at": now.isoformat(),
+                    "next_time_to_run": (
+                        now + relativedelta(seconds=interval_seconds)
+                    ).isoformat(),
+                    "expire_at": (now + relativedelta(months=1)).isoformat(),
+                    "lease_owner": "",
+                    "lease_expires_at": "",
+                },
+            )
+
+    def run(self):
+        """Run the simulation for --minutes of simulated time.
+
+        Returns:
+            float: Real seconds it ran for.
+        """
+        threads = [
+            threading.Thread(target=self.work, daemon=True)
+            for _ in range(self.args.concurrency)
+        ]
+        threads.append(
+            threading.Thread(
+                target=self.beat, args=(self.args.tick_seconds,), daemon=True
+            )
+        )
+
+        start = time.monotonic()
+        cpu_start = time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in threads:
+                thread.start()
+            self.stopped.wait(self.args.minutes * 60 / self.scale)
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+        self.cpu_seconds = time.process_time() - cpu_start
+        return time.monotonic() - start
+
+    def report(self, real_seconds: float):
+        args = self.args
+        sim_hours = real_seconds * self.scale / 3600
+
+        intervals = []
+        scrapes_per_hour = []
+        for alert_id in self.client.collections["alerts"]:
+            finished = self.scrapes.get(alert_id, [])
+            scrapes_per_hour.append(len(finished) / sim_hours)
+            intervals += [
+                (later - earlier) * self.scale / 60
+                for earlier, later in zip(finished, finished[1:])
+            ]
+
+        now = datetime.today().isoformat()
+        backlog = sum(
+            alert["status"] == READY_STATUS and alert["next_time_to_run"] < now
+            for alert in self.client.collections["alerts"].values()
+        )
+        num_of_scrapes = sum(len(finished) for finished in self.scrapes.values())
+        workers_busy = self.busy_seconds / (real_seconds * args.concurrency)
+        sessions_busy = self.session_seconds / (real_seconds * args.selenium_sessions)
+
+        print(
+            f"{args.alerts} alerts on {args.unique_searches} searches, "
+            f"{args.concurrency} workers, {args.selenium_sessions} selenium sessions, "
+            f"{args.minutes} simulated minutes"
+        )
+        print(
+            f"scrapes          {num_of_scrapes} alert runs in {len(self.queue_waits)} "
+            f"tasks, {num_of_scrapes / sim_hours:.0f}/h, http {self.backends[HTTP_BACKEND]}, "
+            f"selenium {self.backends[SELENIUM_BACKEND]}"
+        )
+        print(
+            f"per alert        {sum(scrapes_per_hour) / len(scrapes_per_hour):.1f} "
+            f"scrapes/h avg, p10 {percentile(scrapes_per_hour, 0.1):.1f}, "
+            f"p50 {percentile(scrapes_per_hour, 0.5):.1f}, never scraped "
+            f"{scrapes_per_hour.count(0)}"
+        )
+        print(
+            f"interval         p50 {percentile(intervals, 0.5):.1f}min "
+            f"p95 {percentile(intervals, 0.95):.1f}min"
+        )
+        print(
+            f"queue wait       p50 {percentile(self.queue_waits, 0.5):.0f}s "
+            f"p95 {percentile(self.queue_waits, 0.95):.0f}s"
+        )
+        print(
+            f"overdue queued   p50 {percentile(self.overdue, 0.5):.0f}s "
+            f"p95 {percentile(self.overdue, 0.95):.0f}s, backlog at end {backlog}"
+        )
+        print(
+            f"selenium wait    p50 {percentile(self.session_waits, 0.5):.0f}s "
+            f"p95 {percentile(self.session_waits, 0.95):.0f}s"
+        )
+        print(
+            f"utilization      workers {workers_busy:.0%}, "
+            f"selenium sessions {sessions_busy:.0%}"
+        )
+        if self.cpu_seconds > 0.5 * real_seconds:
+            print(
+                f"warning: the simulator used {self.cpu_seconds / real_seconds:.0%} of "
+                "a cpu, lower --time-scale for accurate numbers"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--alerts", type=int, default=2000)
+    parser.add_argument("--unique-searches", type=int, default=1500)
+    parser.add_argument("--minutes", type=float, default=30)
+    parser.add_argument("--concurrency", type=int, default=3)
+    parser.add_argument("--selenium-sessions", type=int, default=3)
+    parser.add_argument("--time-scale", type=float, default=10)
+    parser.add_argument("--tick-seconds", type=float, default=60)
+    parser.add_argument("--http-seconds", type=float, default=1.5)
+    parser.add_argument("--http-fallback-rate", type=float, default=0.05)
+    parser.add_argument("--selenium-seconds", type=float, default=8)
+    parser.add_argument("--load-more-seconds", type=float, default=20)
+    parser.add_argument("--selenium-fraction", type=float, default=0.2)
+    parser.add_argument("--first-time-fraction", type=float, default=0.02)
+    parser.add_argument("--listings-per-hour", type=float, default=2)
+    parser.add_argument("--db-latency-ms", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    simulation = Simulation(args)
+    simulation.set_up()
+    real_seconds = simulation.run()
+    simulation.report(real_seconds)
+
+
+if __name__ == "__main__":
+    main()
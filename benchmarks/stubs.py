@@ -0,0 +1,324 @@
+"""In-process stand-ins for PocketBase and Telegram, to benchmark without the
+network.
+
+StubPocketBase keeps records in memory, understands the filters the repo sends
+and sleeps a configurable latency on every call, outside of its lock so that
+concurrent calls overlap like they would against the real server. StubBot does
+the same for the telegram bot, keeping the messages it was asked to send.
+"""
+
+import re
+import time
+import uuid
+import random
+import asyncio
+import threading
+from datetime import datetime
+
+from pocketbase.models import Record
+from pocketbase.models.utils import ListResult
+from pocketbase.utils import ClientResponseError
+
+# Like PocketBase, any quote after a backslash is taken as escaped.
+TOKEN_PATTERN = re.compile(
+    r"""\s*(?:
+        (?P<string>"(?:\\"|[^"])*+"|'(?:\\'|[^'])*+')
+        |(?P<number>-?\d+(?:\.\d+)?)
+        |(?P<operator>&&|\|\||!=|>=|<=|=|>|<|\(|\))
+        |(?P<name>[\w.]+)
+    )""",
+    re.VERBOSE,
+)
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+COMPARISONS = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a is not None and b is not None and a > b,
+    "<": lambda a, b: a is not None and b is not None and a < b,
+    ">=": lambda a, b: a is not None and b is not None and a >= b,
+    "<=": lambda a, b: a is not None and b is not None and a <= b,
+}
+
+
+def tokenize(expression: str):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError(f"Can not parse filter at {expression[position:]!r}")
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = value[1:-1].replace("\\" + value[0], value[0])
+        elif kind == "number":
+            value = float(value)
+        tokens.append((kind, value))
+    return tokens
+
+
+def coerce(a, b):
+    """Compare dates as dates and numbers as numbers, like PocketBase does."""
+    if isinstance(a, (int, float)) or isinstance(b, (int, float)):
+        try:
+            return float(a or 0), float(b or 0)
+        except (TypeError, ValueError):
+            return a, b
+    if (
+        isinstance(a, str)
+        and isinstance(b, str)
+        and DATE_PATTERN.match(a)
+        and DATE_PATTERN.match(b)
+    ):
+        try:
+            return datetime.fromisoformat(a), datetime.fromisoformat(b)
+        except ValueError:
+            return a, b
+    return a, b
+
+
+class FilterParser:
+    """Recursive descent parser of the filters the repo sends."""
+
+    def __init__(self, expression: str):
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        if len(self.tokens) == 0:
+            return lambda record: True
+        predicate = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected token {self.peek()}")
+        return predicate
+
+    def parse_or(self):
+        predicates = [self.parse_and()]
+        while self.peek() == ("operator", "||"):
+            self.take()
+            predicates.append(self.parse_and())
+        return lambda record: any(predicate(record) for predicate in predicates)
+
+    def parse_and(self):
+        predicates = [self.parse_term()]
+        while self.peek() == ("operator", "&&"):
+            self.take()
+            predicates.append(self.parse_term())
+        return lambda record: all(predicate(record) for predicate in predicates)
+
+    def parse_term(self):
+        if self.peek() == ("operator", "("):
+            self.take()
+            predicate = self.parse_or()
+            self.take()
+            return predicate
+
+        left = self.take()
+        operator = self.take()[1]
+        right = self.take()
+        compare = COMPARISONS[operator]
+
+        def predicate(record):
+            a, b = coerce(self.resolve(left, record), self.resolve(right, record))
+            return compare(a, b)
+
+        return predicate
+
+    @staticmethod
+    def resolve(token, record):
+        kind, value = token
+        if kind != "name":
+            return value
+        if value in ("true", "false"):
+            return value == "true"
+        if value == "null":
+            return None
+        return record.get(value)
+
+
+class StubRecordService:
+    def __init__(self, stub, collection: str):
+        self.stub = stub
+        self.collection = collection
+
+    def get_list(self, page: int = 1, per_page: int = 30, query_params=None):
+        records = self.stub.query(self.collection, query_params or {})
+        start = (page - 1) * per_page
+        return ListResult(
+            page=page,
+            per_page=per_page,
+            total_items=len(records),
+            total_pages=max(1, -(-len(records) // max(per_page, 1))),
+            items=records[start:start + per_page],
+        )
+
+    def get_full_list(self, batch: int = 200, query_params=None):
+        return self.stub.query(self.collection, query_params or {})
+
+    def get_one(self, id: str, query_params=None):
+        return self.stub.get(self.collection, id)
+
+    def create(self, body_params: dict, query_params=None):
+        return self.stub.write(self.collection, None, body_params)
+
+    def update(self, id: str, body_params: dict, query_params=None):
+        return self.stub.write(self.collection, id, body_params)
+
+    def delete(self, id: str, query_params=None):
+        self.stub.sleep()
+        with self.stub.lock:
+            self.stub.collections.get(self.collection, {}).pop(id, None)
+        return True
+
+
+class StubPocketBase:
+    """PocketBase client keeping the collections in memory.
+
+    Args:
+        latency_seconds (float, optional): Mean latency of a call. Defaults to 0.
+        jitter (float, optional): Latency varies by up to this fraction. Defaults
+        to 0.5.
+        relations (dict, optional): Collection of each relation field, used to
+        expand. Defaults to created_by to chats.
+    """
+
+    def __init__(self, latency_seconds=0.0, jitter=0.5, relations=None):
+        self.latency_seconds = latency_seconds
+        self.jitter = jitter
+        self.relations = relations or {"created_by": "chats"}
+        self.collections = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def collection(self, collection: str):
+        return StubRecordService(self, collection)
+
+    def seed(self, collection: str, body: dict):
+        """Add a record without latency.
+
+        Returns:
+            dict: Record as stored.
+        """
+        record = {"id": body.get("id") or uuid.uuid4().hex[:15], **body}
+        record.setdefault("created", datetime.today().isoformat())
+        record.setdefault("updated", record["created"])
+        self.collections.setdefault(collection, {})[record["id"]] = record
+        return record
+
+    def sleep(self):
+        if self.latency_seconds > 0:
+            time.sleep(
+                self.latency_seconds
+                * random.uniform(1 - self.jitter, 1 + self.jitter)
+            )
+
+    def count_call(self, key: str):
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def metrics_line(self):
+        """Calls made so far, like PooledPocketBase.metrics_line."""
+        with self.lock:
+            calls = dict(self.calls)
+        return " ".join(f"{key}={count}" for key, count in sorted(calls.items()))
+
+    def to_record(self, record: dict, expand: str = None):
+        data = dict(record)
+        if expand:
+            data["expand"] = {}
+            for field in expand.split(","):
+                related = self.collections.get(self.relations.get(field), {}).get(
+                    record.get(field)
+                )
+                if related is not None:
+                    data["expand"][field] = dict(related)
+        return Record(data)
+
+    def query(self, collection: str, query_params: dict):
+        self.count_call(f"GET {collection}")
+        self.sleep()
+        predicate = FilterParser(query_params.get("filter", "")).parse()
+        with self.lock:
+            records = [
+                record
+                for record in self.collections.get(collection, {}).values()
+                if predicate(record)
+            ]
+        for field in reversed(query_params.get("sort", "").split(",")):
+            if field:
+                records.sort(
+                    key=lambda record: str(record.get(field.lstrip("-+")) or ""),
+                    reverse=field.startswith("-"),
+                )
+        return [self.to_record(record, query_params.get("expand")) for record in records]
+
+    def get(self, collection: str, id: str):
+        self.count_call(f"GET {collection}")
+        self.sleep()
+        with self.lock:
+            record = self.collections.get(collection, {}).get(id)
+        if record is None:
+            raise ClientResponseError(
+                "Response error. Status code:404", status=404, data={"message": "Not found."}
+            )
+        return self.to_record(record)
+
+    def write(self, collection: str, id: str, body: dict):
+        method = "POST" if id is None else "PATCH"
+        self.count_call(f"{method} {collection}")
+        self.sleep()
+        with self.lock:
+            if id is None:
+                record = self.seed(collection, body)
+            else:
+                record = self.collections.get(collection, {}).get(id)
+                if record is None:
+                    raise ClientResponseError(
+                        "Response error. Status code:404",
+                        status=404,
+                        data={"message": "Not found."},
+                    )
+                record.update(body)
+                record["updated"] = datetime.today().isoformat()
+        return self.to_record(record)
+
+
+class StubBot:
+    """Telegram bot which only waits a latency and keeps the messages sent.
+
+    Args:
+        latency_seconds (float, optional): Mean latency of a call. Defaults to 0.
+        jitter (float, optional): Latency varies by up to this fraction. Defaults
+        to 0.5.
+    """
+
+    def __init__(self, latency_seconds=0.0, jitter=0.5):
+        self.latency_seconds = latency_seconds
+        self.jitter = jitter
+        self.messages = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.latency_seconds > 0:
+            await asyncio.sleep(
+                self.latency_seconds
+                * random.uniform(1 - self.jitter, 1 + self.jitter)
+            )
+        self.messages.append((chat_id, text))
@@ -2,12 +2,15 @@
 
 import re
 import os
+import asyncio
 import logging
 import utils
+import repository
+from db import run_async
 from datetime import datetime
 from dotenv import load_dotenv
 
-from pocketbase import PocketBase, utils as pbutils
+from pocketbase import utils as pbutils
 
 from telegram import (
     ReplyKeyboardRemove,
@@ -42,11 +45,9 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def get_client():
-    return PocketBase(os.getenv("POCKETBASE_URL"))
-
-
-def create_alert(created_by, query=None, from_price=None, to_price=None, url=None):
+async def create_alert(
+    created_by, query=None, from_price=None, to_price=None, url=None
+):
     print("create_alert")
     expiryDate = utils.get_alert_expiry()
     nextTimeToRun = utils.get_alert_next_time_to_run(min_seconds=60, max_seconds=150)
@@ -55,7 +56,8 @@ def create_alert(created_by, query=None, from_price=None, to_price=None, url=Non
     )
     cleanedApiKey = re.sub(r"[^\w\s]", "", apiKey)
     cleanedApiKey = re.sub(r"\s+", "-", cleanedApiKey)
-    get_client().collection("alerts").create(
+    await run_async(
+        repository.create_alert,
         {
             "url": url,
             "query": query,
@@ -73,41 +75,10 @@ def create_alert(created_by, query=None, from_price=None, to_price=None, url=Non
     return True
 
 
-def get_chat_id_by_user_id(user_id):
-    print("get_chat_id_by_user_id")
-    print(get_client().collection("chats").get_full_list())
-    chats = (
-        get_client()
-        .collection("chats")
-        .get_list(1, 1, query_params={"filter": f'user_id = "{str(user_id)}"'})
-    )
-
-    if chats.items is None or len(chats.items) == 0:
-        return get_client().collection("chats").create({"user_id": str(user_id)}).id
-
-    return chats.items[0].id
-
-
 async def get_user_alert_amt_available(user_id: str):
-    chat_id = get_chat_id_by_user_id(user_id)
+    chat_id = await run_async(repository.get_or_create_chat_id, user_id)
 
-    codes = (
-        get_client()
-        .collection("codes")
-        .get_full_list(query_params={"filter": f'subscribed_by = "{chat_id}"'})
-    )
-
-    total_alerts = 0
-    for code in codes:
-        total_alerts += code.alert_amt_to_give
-
-    alerts = (
-        get_client()
-        .collection("alerts")
-        .get_full_list(query_params={"filter": f'created_by = "{chat_id}"'})
-    )
-
-    return total_alerts - len(alerts)
+    return await run_async(repository.get_alerts_left, chat_id)
 
 
 async def show_start_docs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -193,28 +164,22 @@ async def use_code_process(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         if user_id is None:
             raise Exception("Something went wrong with your chat.")
 
-        codes = (
-            get_client()
-            .collection("codes")
-            .get_list(1, 1, query_params={"filter": f'code = "{code}"'})
-        )
+        code = await run_async(repository.get_code, code)
 
         # Check if code exist in db.
-        if codes.items is None or len(codes.items) == 0:
+        if code is None:
             raise Exception("Code is not valid.")
 
         # Check if code is used.
-        if codes.items[0].subscribed_by is not None:
+        if code.subscribed_by is not None:
             raise Exception("Code is already used.")
 
-        chat_id = get_chat_id_by_user_id(user_id)
+        chat_id = await run_async(repository.get_or_create_chat_id, user_id)
 
         # Update code to be used.
-        get_client().collection("codes").update(
-            codes.items[0].id, {"subscribed_by": chat_id}
-        )
+        await run_async(repository.redeem_code, code, chat_id)
 
-        message = codes.items[0].alert_amt_to_give
+        message = code.alert_amt_to_give
     except pbutils.ClientResponseError as e:
         is_error = True
         message = e.data["message"]
@@ -379,10 +344,12 @@ async def subscribe_to_alert_confirmation(
             return SUBSCRIBE_TO_ALERT_CONFIRMATION
 
         query = context.user_data["query"]
-        chat_id = get_chat_id_by_user_id(update.effective_user.id)
+        chat_id = await run_async(
+            repository.get_or_create_chat_id, update.effective_user.id
+        )
 
         if query.startswith("http"):
-            result = create_alert(chat_id, url=query)
+            result = await create_alert(chat_id, url=query)
         else:
             from_price = (
                 None
@@ -396,7 +363,7 @@ async def subscribe_to_alert_confirmation(
                 or context.user_data["to_price"] == "0"
                 else float(context.user_data["to_price"])
             )
-            result = create_alert(
+            result = await create_alert(
                 chat_id, query=query, from_price=from_price, to_price=to_price
             )
 
@@ -442,23 +409,20 @@ async def see_my_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     print("see_my_alerts")
     try:
         user_id = update.effective_user.id
-        chat_id = get_chat_id_by_user_id(user_id)
-
-        alerts = (
-            get_client()
-            .collection("alerts")
-            .get_full_list(query_params={"filter": f'created_by = "{str(chat_id)}"'})
+        chat_id = await run_async(repository.get_or_create_chat_id, user_id)
+
+        alerts = await run_async(repository.get_alerts_created_by, chat_id)
+        listing_counts = await asyncio.gather(
+            *[
+                run_async(repository.count_listings_of_alert, alert.id)
+                for alert in alerts
+            ]
         )
 
         message = ""
         chat_num = 1
 
-        for alert in alerts:
-            listings = (
-                get_client()
-                .collection("listings")
-                .get_full_list(query_params={"filter": f'alert_id = "{alert.id}"'})
-            )
+        for alert, listing_count in zip(alerts, listing_counts):
             if alert.url is not None:
                 message += f"""Alert {chat_num}.\n<b>Search URL:</b> {alert.url}\n"""
             else:
@@ -473,7 +437,7 @@ async def see_my_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             expiry = datetime.fromisoformat(alert.expire_at)
             expiry.strftime("%I:%M %p")
             message += f'\n<b>Expire At:</b> {expiry.strftime("%d %b %y, %I:%M %p")}\n'
-            message += f"<b>Listing Found:</b> {len(listings)}\n"
+            message += f"<b>Listing Found:</b> {listing_count}\n"
 
             message += "\n"
             message += "------------------------\n"
@@ -539,12 +503,16 @@ few. If you are interested, please fill in this form and we will get back to you
     )
 
 
-if __name__ == "__main__":
-    print("initiating bot")
+def add_handlers(application: Application):
+    """Register the commands of the bot.
 
-    client = PocketBase(os.getenv("POCKETBASE_URL"))
-    botApp = Application.builder().token(os.getenv("TELEGRAM_TOKEN")).build()
+    Updates are taken one at a time and in order. Commands which keep no state
+    across updates run with block=False, so the next update does not wait for
+    their db calls. Conversations block, so the steps of a user stay in order.
 
+    Args:
+        application (Application): Application of the bot.
+    """
     use_code_handler = ConversationHandler(
         entry_points=[CommandHandler("use_code", use_code)],
         states={
@@ -582,13 +550,24 @@ if __name__ == "__main__":
         fallbacks=[CommandHandler("cancel", cancel)],
     )
 
-    botApp.add_handler(CommandHandler("start", show_start_docs))
-    botApp.add_handler(CommandHandler("help", show_help_docs))
-    botApp.add_handler(CommandHandler("request_for_code", request_for_code))
-    botApp.add_handler(CommandHandler("my_alerts", see_my_alerts))
+    application.add_handler(CommandHandler("start", show_start_docs, block=False))
+    application.add_handler(CommandHandler("help", show_help_docs, block=False))
+    application.add_handler(
+        CommandHandler("request_for_code", request_for_code, block=False)
+    )
+    application.add_handler(CommandHandler("my_alerts", see_my_alerts, block=False))
+
+    application.add_handler(
+        CommandHandler("check_alerts_left", check_alerts_left, block=False)
+    )
+    application.add_handler(use_code_handler)
+    application.add_handler(subscribe_to_alert_handler)
+
 
-    botApp.add_handler(CommandHandler("check_alerts_left", check_alerts_left))
-    botApp.add_handler(use_code_handler)
-    botApp.add_handler(subscribe_to_alert_handler)
+if __name__ == "__main__":
+    print("initiating bot")
+
+    botApp = Application.builder().token(os.getenv("TELEGRAM_TOKEN")).build()
+    add_handlers(botApp)
 
     botApp.run_polling()
@@ -0,0 +1,256 @@
+"""Shared PocketBase access, one pooled keep-alive client per process."""
+
+import os
+import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from pocketbase import PocketBase
+from pocketbase.models import FileUpload
+from pocketbase.utils import ClientResponseError
+
+client = None
+client_pid = None
+async_client = None
+client_lock = threading.Lock()
+
+
+class PooledPocketBase(PocketBase):
+    """PocketBase client which sends every request over one httpx client, so
+    connections are kept alive and reused, and times every call.
+    """
+
+    def __init__(self, base_url: str, http_client: httpx.Client):
+        super().__init__(base_url)
+        self.http_client = http_client
+        self.metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def send(self, path: str, req_config: dict):
+        """Sends an api http request, same as Client.send but over the pool."""
+        config = {"method": "GET"}
+        config.update(req_config)
+        # check if Authorization header can be added
+        if self.auth_store.token and (
+            "headers" not in config or "Authorization" not in config["headers"]
+        ):
+            config["headers"] = config.get("headers", {})
+            config["headers"].update({"Authorization": self.auth_store.token})
+
+        method = config.get("method", "GET")
+        body = config.get("body", None)
+        # handle requests including files as multipart:
+        data = {}
+        files = ()
+        for k, v in (body if isinstance(body, dict) else {}).items():
+            if isinstance(v, FileUpload):
+                files += v.get(k)
+            else:
+                data[k] = v
+        if len(files) > 0:
+            body = None
+        else:
+            files = None
+            data = None
+
+        start = time.perf_counter()
+        try:
+            response = self.http_client.request(
+                method=method,
+                url=self.build_url(path),
+                params=config.get("params", None),
+                headers=config.get("headers", None),
+                json=body,
+                data=data,
+                files=files,
+            )
+        except Exception as e:
+            self._record(method, path, time.perf_counter() - start, failed=True)
+            raise ClientResponseError(
+                f"General request error. Original error: {e}",
+                original_error=e,
+            )
+        self._record(
+            method, path, time.perf_counter() - start, response.status_code >= 400
+        )
+
+        try:
+            data = response.json()
+        except Exception:
+            data = None
+        if response.status_code >= 400:
+            raise ClientResponseError(
+                f"Response error. Status code:{response.status_code}",
+                url=response.url,
+                status=response.status_code,
+                data=data,
+            )
+        return data
+
+    def _record(self, method: str, path: str, seconds: float, failed=False):
+        # /api/collections/<collection>/records/<id>
+        parts = path.strip("/").split("/")
+        collection = parts[2] if len(parts) > 2 else path
+        key = f"{method} {collection}"
+
+        with self._metrics_lock:
+            metric = self.metrics.setdefault(
+                key, {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+            )
+            metric["calls"] += 1
+            metric["errors"] += 1 if failed else 0
+            metric["total_seconds"] += seconds
+            metric["max_seconds"] = max(metric["max_seconds"], seconds)
+
+    def metrics_line(self):
+        """Latency of the calls so far formatted for the logs.
+
+        Returns:
+            str: calls, errors, average and max latency by method and collection.
+        """
+        with self._metrics_lock:
+            metrics = {key: dict(metric) for key, metric in self.metrics.items()}
+
+        return ", ".join(
+            f"{key}: {metric['calls']} calls {metric['errors']} errors "
+            f"avg {metric['total_seconds'] / metric['calls'] * 1000:.0f}ms "
+            f"max {metric['max_seconds'] * 1000:.0f}ms"
+            for key, metric in sorted(metrics.items())
+        )
+
+
+def create_client():
+    """Create a pooled client from env.
+
+    Returns:
+        PooledPocketBase: Client of the process.
+    """
+    pool_size = int(os.getenv("POCKETBASE_POOL_SIZE", "10"))
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=float(os.getenv("POCKETBASE_KEEPALIVE_SECONDS", "30")),
+        ),
+        timeout=httpx.Timeout(
+            float(os.getenv("POCKETBASE_TIMEOUT_SECONDS", "30")),
+            connect=float(os.getenv("POCKETBASE_CONNECT_TIMEOUT_SECONDS", "5")),
+        ),
+    )
+    return PooledPocketBase(os.getenv("POCKETBASE_URL"), http_client)
+
+
+def get_client():
+    """Get the client of this process, created again after a fork so that worker
+    processes never share connections.
+
+    Returns:
+        PooledPocketBase: Client of the process.
+    """
+    global client, client_pid
+    if client is None or client_pid != os.getpid():
+        with client_lock:
+            if client is None or client_pid != os.getpid():
+                client = create_client()
+                client_pid = os.getpid()
+    return client
+
+
+class AsyncRecordService:
+    """Awaitable version of the record service of a collection."""
+
+    def __init__(self, async_client, collection: str):
+        self.async_client = async_client
+        self.collection = collection
+
+    def _service(self):
+        return self.async_client.client.collection(self.collection)
+
+    async def get_list(self, page: int = 1, per_page: int = 30, query_params=None):
+        return await self.async_client.run(
+            self._service().get_list, page, per_page, query_params or {}
+        )
+
+    async def get_full_list(self, batch: int = 200, query_params=None):
+        return await self.async_client.run(
+            self._service().get_full_list, batch, query_params or {}
+        )
+
+    async def get_one(self, id: str, query_params=None):
+        return await self.async_client.run(
+            self._service().get_one, id, query_params or {}
+        )
+
+    async def create(self, body_params: dict, query_params=None):
+        return await self.async_client.run(
+            self._service().create, body_params, query_params or {}
+        )
+
+    async def update(self, id: str, body_params: dict, query_params=None):
+        return await self.async_client.run(
+            self._service().update, id, body_params, query_params or {}
+        )
+
+    async def delete(self, id: str, query_params=None):
+        return await self.async_client.run(
+            self._service().delete, id, query_params or {}
+        )
+
+
+class AsyncPocketBase:
+    """Run the calls of the pooled client on a bounded thread pool, so that they
+    can be awaited without blocking the event loop of the bot.
+    """
+
+    def __init__(self, client: PooledPocketBase, max_concurrency: int):
+        self.client = client
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="pocketbase"
+        )
+
+    def collection(self, collection: str):
+        return AsyncRecordService(self, collection)
+
+    async def run(self, call, *args, **kwargs):
+        """Await a call of the sync client.
+
+        Args:
+            call (callable): Call of the sync client.
+
+        Returns:
+            Any: Result of the call.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(call, *args, **kwargs)
+        )
+
+
+def get_async_client():
+    """Get the awaitable client of this process.
+
+    Returns:
+        AsyncPocketBase: Client of the process.
+    """
+    global async_client
+    if async_client is None or async_client.client is not get_client():
+        async_client = AsyncPocketBase(
+            get_client(), int(os.getenv("POCKETBASE_POOL_SIZE", "10"))
+        )
+    return async_client
+
+
+async def run_async(call, *args, **kwargs):
+    """Await a blocking db call, e.g. of repository, on the pool of the awaitable
+    client of this process.
+
+    Args:
+        call (callable): Blocking call.
+
+    Returns:
+        Any: Result of the call.
+    """
+    return await get_async_client().run(call, *args, **kwargs)
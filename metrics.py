@@ -0,0 +1,398 @@
+"""In-process metrics of the app and the workers.
+
+Histograms, counters and gauges register themselves by name and labels, and are
+rendered in the prometheus text format. Celery worker processes each write a snapshot of
+their metrics to METRICS_DIR after every task, and the main worker process serves
+them merged on WORKER_METRICS_PORT.
+"""
+
+import os
+import json
+import math
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SCRAPE_STAGE_SECONDS = "scrape_stage_seconds"
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+registry = {}
+registry_lock = threading.RLock()
+
+
+def register(metric):
+    """Keep a metric so it is rendered, replacing one of the same name and labels.
+
+    Returns:
+        Histogram | Counter | Gauge: The metric.
+    """
+    with registry_lock:
+        registry[(metric.name, tuple(sorted(metric.labels.items())))] = metric
+    return metric
+
+
+class Histogram:
+    """Counts observations in cumulative buckets, like a prometheus histogram.
+
+    Args:
+        name (str): Name of the histogram.
+        buckets (tuple, optional): Upper bounds of the buckets, in seconds.
+        Defaults to DEFAULT_BUCKETS.
+        labels (dict, optional): Labels of the histogram. Defaults to None.
+    """
+
+    def __init__(self, name: str, buckets=DEFAULT_BUCKETS, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+        register(self)
+
+    def observe(self, value: float):
+        with self._lock:
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Get the cumulative count of each bucket.
+
+        Returns:
+            dict: Cumulative counts by upper bound, count and sum.
+        """
+        with self._lock:
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                buckets[bound] = cumulative
+            return {"buckets": buckets, "count": self.count, "sum": self.sum}
+
+    def quantile(self, fraction: float):
+        """Get the upper bound of the bucket a quantile falls in.
+
+        Args:
+            fraction (float): Quantile, e.g. 0.95.
+
+        Returns:
+            float: Upper bound, None when nothing was observed.
+        """
+        snapshot = self.snapshot()
+        if snapshot["count"] == 0:
+            return None
+
+        for bound, cumulative in snapshot["buckets"].items():
+            if cumulative >= fraction * snapshot["count"]:
+                return bound
+
+    def summary_line(self):
+        """Count, average and quantiles formatted for the logs.
+
+        Returns:
+            str: Summary of the histogram.
+        """
+        snapshot = self.snapshot()
+        if snapshot["count"] == 0:
+            return f"{self.name}: no observations"
+
+        return (
+            f"{self.name}: count={snapshot['count']} "
+            f"avg={snapshot['sum'] / snapshot['count']:.2f}s "
+            f"p50<={self.quantile(0.5)}s p95<={self.quantile(0.95)}s "
+            f"p99<={self.quantile(0.99)}s"
+        )
+
+    def export(self):
+        """Get the histogram as a dict which can be saved as json and merged.
+
+        Returns:
+            dict: Type, name, labels, cumulative buckets, count and sum.
+        """
+        snapshot = self.snapshot()
+        return {
+            "type": "histogram",
+            "name": self.name,
+            "labels": self.labels,
+            "buckets": [list(bucket) for bucket in snapshot["buckets"].items()],
+            "count": snapshot["count"],
+            "sum": snapshot["sum"],
+        }
+
+
+class Counter:
+    """Counts up, like a prometheus counter.
+
+    Args:
+        name (str): Name of the counter.
+        labels (dict, optional): Labels of the counter. Defaults to None.
+    """
+
+    def __init__(self, name: str, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+        register(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def export(self):
+        return {
+            "type": "counter",
+            "name": self.name,
+            "labels": self.labels,
+            "value": self.value,
+        }
+
+
+class Gauge:
+    """Holds the last value set, like a prometheus gauge.
+
+    Args:
+        name (str): Name of the gauge.
+        labels (dict, optional): Labels of the gauge. Defaults to None.
+    """
+
+    def __init__(self, name: str, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.value = 0
+        self.updated_at = 0.0
+        self._lock = threading.Lock()
+        register(self)
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+            self.updated_at = time.time()
+
+    def export(self):
+        return {
+            "type": "gauge",
+            "name": self.name,
+            "labels": self.labels,
+            "value": self.value,
+            "updated_at": self.updated_at,
+        }
+
+
+def get_histogram(name: str, buckets=DEFAULT_BUCKETS, **labels):
+    """Get the histogram of a name and labels, created on first use.
+
+    Returns:
+        Histogram: Histogram of the name and labels.
+    """
+    with registry_lock:
+        metric = registry.get((name, tuple(sorted(labels.items()))))
+        if metric is None:
+            metric = Histogram(name, buckets=buckets, labels=labels)
+    return metric
+
+
+def get_counter(name: str, **labels):
+    """Get the counter of a name and labels, created on first use.
+
+    Returns:
+        Counter: Counter of the name and labels.
+    """
+    with registry_lock:
+        metric = registry.get((name, tuple(sorted(labels.items()))))
+        if metric is None:
+            metric = Counter(name, labels=labels)
+    return metric
+
+
+@contextmanager
+def span(name: str, **labels):
+    """Time a block of code into the histogram of a name and labels.
+
+    Args:
+        name (str): Name of the histogram, with STAGE_BUCKETS.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_histogram(name, buckets=STAGE_BUCKETS, **labels).observe(
+            time.perf_counter() - start
+        )
+
+
+def export_metrics():
+    """Get every metric of this process.
+
+    Returns:
+        list: Exported metrics.
+    """
+    with registry_lock:
+        metrics = list(registry.values())
+    return [metric.export() for metric in metrics]
+
+
+def merge_metrics(exports: list):
+    """Merge the metrics of several processes, adding up those of the same name
+    and labels, and keeping the value set last of gauges.
+
+    Args:
+        exports (list): Exported metrics of each process.
+
+    Returns:
+        list: Merged metrics.
+    """
+    merged = {}
+    for metrics in exports:
+        for metric in metrics:
+            key = (metric["name"], tuple(sorted(metric["labels"].items())))
+            if key not in merged:
+                merged[key] = json.loads(json.dumps(metric))
+            elif metric["type"] == "counter":
+                merged[key]["value"] += metric["value"]
+            elif metric["type"] == "gauge":
+                if metric["updated_at"] > merged[key]["updated_at"]:
+                    merged[key] = json.loads(json.dumps(metric))
+            else:
+                total = merged[key]
+                total["count"] += metric["count"]
+                total["sum"] += metric["sum"]
+                for bucket, other in zip(total["buckets"], metric["buckets"]):
+                    bucket[1] += other[1]
+
+    return list(merged.values())
+
+
+def format_labels(labels: dict):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def render_metrics(metrics: list = None):
+    """Render metrics in the prometheus text format.
+
+    Args:
+        metrics (list, optional): Exported metrics. Defaults to those of this
+        process.
+
+    Returns:
+        str: Metrics, one sample a line.
+    """
+    metrics = export_metrics() if metrics is None else metrics
+
+    lines = []
+    typed = set()
+    for metric in sorted(metrics, key=lambda metric: metric["name"]):
+        name = metric["name"]
+        if name not in typed:
+            lines.append(f"# TYPE {name} {metric['type']}")
+            typed.add(name)
+
+        if metric["type"] in ("counter", "gauge"):
+            lines.append(f"{name}{format_labels(metric['labels'])} {metric['value']}")
+            continue
+
+        for bound, cumulative in metric["buckets"]:
+            le = "+Inf" if bound == math.inf else str(bound)
+            labels = format_labels({**metric["labels"], "le": le})
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(metric['labels'])} {metric['sum']}")
+        lines.append(f"{name}_count{format_labels(metric['labels'])} {metric['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+def get_metrics_dir():
+    """Get the directory the worker processes of this host write their metrics to.
+
+    Returns:
+        str: Path of the directory.
+    """
+    return os.path.join(
+        os.getenv("METRICS_DIR", "metrics_snapshots"), socket.gethostname()
+    )
+
+
+def write_metrics_snapshot():
+    """Save the metrics of this process for the metrics server of the worker."""
+    directory = get_metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(export_metrics(), file)
+    os.replace(f"{path}.tmp", path)
+
+
+def read_metrics_snapshots():
+    """Read the metrics saved by every process of this host.
+
+    Returns:
+        list: Merged metrics.
+    """
+    directory = get_metrics_dir()
+    if not os.path.isdir(directory):
+        return []
+
+    exports = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as file:
+                exports.append(json.load(file))
+        except (OSError, ValueError) as error:
+            print(f"Could not read metrics {filename}... {error}")
+
+    return merge_metrics(exports)
+
+
+def clear_metrics_snapshots():
+    """Remove the metrics left by the processes of an earlier run of this host."""
+    directory = get_metrics_dir()
+    if not os.path.isdir(directory):
+        return
+
+    for filename in os.listdir(directory):
+        os.remove(os.path.join(directory, filename))
+
+
+def start_metrics_server(port: int, collect=read_metrics_snapshots):
+    """Serve metrics on /metrics from a thread.
+
+    Args:
+        port (int): Port to listen on.
+        collect (callable, optional): Gets the metrics to serve. Defaults to
+        those saved by the processes of this host.
+
+    Returns:
+        ThreadingHTTPServer: Server, already serving.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = render_metrics(collect()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
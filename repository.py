@@ -0,0 +1,629 @@
+"""Queries of the alerts, chats, codes and listings collections.
+
+Filter values are always quoted with quote_filter_value. Hot reads go through
+in-process caches which are invalidated when this process writes to them, and
+expire after their ttl so that writes of other processes show up too.
+"""
+
+import os
+import threading
+from datetime import datetime
+from collections import Counter
+from typing import Iterable, List, Optional
+
+import utils
+from db import get_client
+from pocketbase.models import Record
+from pocketbase.models.utils import ListResult
+
+# Chats never change user, so both directions are cached for long.
+chat_id_cache = utils.TTLCache(
+    ttl_seconds=float(os.getenv("CHAT_CACHE_TTL_SECONDS", "3600"))
+)
+chat_user_id_cache = utils.TTLCache(
+    ttl_seconds=float(os.getenv("CHAT_CACHE_TTL_SECONDS", "3600"))
+)
+query_cache = utils.TTLCache(
+    ttl_seconds=float(os.getenv("REPOSITORY_CACHE_TTL_SECONDS", "60"))
+)
+quota_locks = {}
+quota_locks_lock = threading.Lock()
+
+
+def quote_filter_value(value) -> str:
+    """Quote a value to be compared against in a filter.
+
+    PocketBase only unescapes the quote of a string, and takes any quote after a
+    backslash as escaped. A value can not end in a backslash then, as it would
+    escape the closing quote, so trailing backslashes are dropped and such a value
+    is compared without them.
+
+    Args:
+        value (Any): Value to compare against.
+
+    Returns:
+        str: Value as a double quoted filter string.
+    """
+    return '"' + str(value).rstrip("\\").replace('"', '\\"') + '"'
+
+
+def filter_equals(field: str, value) -> str:
+    """Filter on a field being equal to a value.
+
+    Args:
+        field (str): Field of the collection.
+        value (Any): Value to compare against.
+
+    Returns:
+        str: Filter expression.
+    """
+    return f"{field} = {quote_filter_value(value)}"
+
+
+def filter_any(field: str, values: Iterable) -> str:
+    """Filter on a field being equal to any of the values.
+
+    Args:
+        field (str): Field of the collection.
+        values (Iterable): Values to compare against, at least one.
+
+    Returns:
+        str: Filter expression, in brackets.
+    """
+    return "(" + " || ".join(filter_equals(field, value) for value in values) + ")"
+
+
+def cache_chat(chat: Record):
+    """Remember the user of a chat fetched some other way, e.g. expanded.
+
+    Args:
+        chat (Record): Chat as per db in chats.
+    """
+    chat_id_cache.set(str(chat.user_id), chat.id)
+    chat_user_id_cache.set(chat.id, chat.user_id)
+
+
+def get_or_create_chat_id(user_id) -> str:
+    """Get the chat of a telegram user, created on their first message.
+
+    Args:
+        user_id (str): Telegram user id.
+
+    Returns:
+        str: chat id as per db in chats.
+    """
+    user_id = str(user_id)
+    chat_id = chat_id_cache.get(user_id)
+    if chat_id is not None:
+        return chat_id
+
+    chats = (
+        get_client()
+        .collection("chats")
+        .get_list(1, 1, query_params={"filter": filter_equals("user_id", user_id)})
+    )
+    if chats.items is None or len(chats.items) == 0:
+        chat = get_client().collection("chats").create({"user_id": user_id})
+    else:
+        chat = chats.items[0]
+
+    cache_chat(chat)
+    return chat.id
+
+
+def get_chat_user_ids(alerts: List[Record]) -> dict:
+    """Get the telegram user id of the chat of each alert.
+
+    Chats expanded with the alerts are used first, then the cache, and the rest
+    are fetched together, 50 to a query.
+
+    Args:
+        alerts (list): Alerts as per db in alerts, expanded with created_by when
+        possible.
+
+    Returns:
+        dict: Telegram user id by chat id.
+    """
+    user_ids = {}
+    missing_chat_ids = []
+    for alert in alerts:
+        chat = getattr(alert, "expand", {}).get("created_by")
+        if chat is not None:
+            cache_chat(chat)
+
+        user_id = chat_user_id_cache.get(alert.created_by)
+        if user_id is not None:
+            user_ids[alert.created_by] = user_id
+        elif alert.created_by not in missing_chat_ids:
+            missing_chat_ids.append(alert.created_by)
+
+    chunk_size = int(os.getenv("LISTING_FILTER_CHUNK_SIZE", "50"))
+    for index in range(0, len(missing_chat_ids), chunk_size):
+        chunk = missing_chat_ids[index:index + chunk_size]
+        chats = (
+            get_client()
+            .collection("chats")
+            .get_list(1, len(chunk), query_params={"filter": filter_any("id", chunk)})
+        )
+        for chat in chats.items:
+            cache_chat(chat)
+            user_ids[chat.id] = chat.user_id
+
+    return user_ids
+
+
+def get_code(code: str) -> Optional[Record]:
+    """Get a code by what the user typed.
+
+    Args:
+        code (str): Code as typed.
+
+    Returns:
+        Record: Code as per db in codes, None when there is no such code.
+    """
+    codes = (
+        get_client()
+        .collection("codes")
+        .get_list(1, 1, query_params={"filter": filter_equals("code", code)})
+    )
+    if codes.items is None or len(codes.items) == 0:
+        return None
+
+    return codes.items[0]
+
+
+def redeem_code(code: Record, chat_id: str):
+    """Give the alerts of a code to a chat.
+
+    Args:
+        code (Record): Code as per db in codes.
+        chat_id (str): chat id as per db in chats.
+    """
+    get_client().collection("codes").update(code.id, {"subscribed_by": chat_id})
+    add_to_alert_quota(chat_id, given=code.alert_amt_to_give)
+
+
+def create_alert(body: dict) -> Record:
+    """Create an alert.
+
+    Args:
+        body (dict): Fields of the alert.
+
+    Returns:
+        Record: Alert as per db in alerts.
+    """
+    alert = get_client().collection("alerts").create(body)
+    if body.get("created_by"):
+        query_cache.delete(("alerts_created_by", body["created_by"]))
+        add_to_alert_quota(body["created_by"], used=1)
+
+    return alert
+
+
+def update_alert(alert_id: str, body: dict) -> Record:
+    """Update fields of an alert.
+
+    Alerts cached by chat are left as they are, the fields shown from them do not
+    change once the alert is created.
+
+    Args:
+        alert_id (str): alert id as per db in alerts.
+        body (dict): Fields to update.
+
+    Returns:
+        Record: Alert as per db in alerts.
+    """
+    return get_client().collection("alerts").update(alert_id, body)
+
+
+def get_alerts_created_by(chat_id: str) -> List[Record]:
+    """Get the alerts of a chat.
+
+    Args:
+        chat_id (str): chat id as per db in chats.
+
+    Returns:
+        list: Alerts as per db in alerts.
+    """
+    key = ("alerts_created_by", chat_id)
+    alerts = query_cache.get(key)
+    if alerts is None:
+        alerts = (
+            get_client()
+            .collection("alerts")
+            .get_full_list(
+                query_params={"filter": filter_equals("created_by", chat_id)}
+            )
+        )
+        query_cache.set(key, alerts)
+
+    return alerts
+
+
+def get_due_alerts_filter() -> str:
+    now = quote_filter_value(datetime.today())
+    return f"""status = "ready_to_search" &&
+                next_time_to_run < {now} &&
+                expire_at > {now}"""
+
+
+def get_due_alerts_page(per_page: int) -> ListResult:
+    """Get the most overdue alerts which are ready to be scraped, with their chat
+    expanded.
+
+    Args:
+        per_page (int): Max alerts to get.
+
+    Returns:
+        ListResult: Alerts as per db in alerts, total_items tells how many are due.
+    """
+    return (
+        get_client()
+        .collection("alerts")
+        .get_list(
+            1,
+            per_page,
+            query_params={
+                "filter": get_due_alerts_filter(),
+                "sort": "next_time_to_run",
+                "expand": "created_by",
+            },
+        )
+    )
+
+
+def get_recent_scrape_seconds(count: int = 20) -> List[float]:
+    """Get how long the last scrapes took.
+
+    Args:
+        count (int, optional): Scrapes to look at. Defaults to 20.
+
+    Returns:
+        list: Seconds taken by each scrape.
+    """
+    alerts = (
+        get_client()
+        .collection("alerts")
+        .get_list(
+            1,
+            count,
+            query_params={"filter": "last_scrape_seconds > 0", "sort": "-updated"},
+        )
+    )
+    return [alert.last_scrape_seconds for alert in alerts.items]
+
+
+def count_alerts(alert_filter: str) -> int:
+    """Count alerts without fetching them.
+
+    Args:
+        alert_filter (str): Filter of the alerts to count.
+
+    Returns:
+        int: Number of alerts.
+    """
+    return (
+        get_client()
+        .collection("alerts")
+        .get_list(1, 1, query_params={"filter": alert_filter})
+        .total_items
+    )
+
+
+def count_in_flight_alerts() -> int:
+    """Count the alerts queued or being scraped. Unlike the depth of the broker
+    queue, this counts the tasks prefetched by the workers too.
+
+    Returns:
+        int: Number of alerts.
+    """
+    return count_alerts(filter_any("status", ["queued", "ongoing"]))
+
+
+def get_active_alert_rates() -> List[Record]:
+    """Get the fields the scheduler weighs its budget with of every alert which
+    has not expired. It pages through all of them, so callers cache the result.
+
+    Returns:
+        list: Alerts, with listing_rate, last_scraped_at and is_first_scrape only.
+    """
+    return (
+        get_client()
+        .collection("alerts")
+        .get_full_list(
+            batch=500,
+            query_params={
+                "filter": f"expire_at > {quote_filter_value(datetime.today())}",
+                "fields": "listing_rate,last_scraped_at,is_first_scrape",
+            },
+        )
+    )
+
+
+def count_listings_of_alert(alert_id: str) -> int:
+    """Count the listings found by an alert without fetching them.
+
+    Args:
+        alert_id (str): alert id as per db in alerts.
+
+    Returns:
+        int: Number of listings.
+    """
+    return (
+        get_client()
+        .collection("listings")
+        .get_list(1, 1, query_params={"filter": filter_equals("alert_id", alert_id)})
+        .total_items
+    )
+
+
+def get_quota_lock(chat_id: str):
+    with quota_locks_lock:
+        return quota_locks.setdefault(chat_id, threading.Lock())
+
+
+def count_alert_quota(chat_id: str):
+    """Count the alerts given to and used by a chat from its codes and alerts.
+
+    Args:
+        chat_id (str): chat id as per db in chats.
+
+    Returns:
+        tuple: Alerts given and alerts used.
+    """
+    codes = (
+        get_client()
+        .collection("codes")
+        .get_full_list(query_params={"filter": filter_equals("subscribed_by", chat_id)})
+    )
+    used = count_alerts(filter_equals("created_by", chat_id))
+    return sum(code.alert_amt_to_give for code in codes), used
+
+
+def save_alert_quota(chat_id: str, given: int, used: int):
+    get_client().collection("chats").update(
+        chat_id,
+        {
+            "alert_amt_given": given,
+            "alert_amt_used": used,
+            "quota_reconciled_at": datetime.today().isoformat(),
+        },
+    )
+
+
+def add_to_alert_quota(chat_id: str, given: int = 0, used: int = 0):
+    """Add to the quota kept on a chat, after its code or alert is written.
+
+    PocketBase has no increment, so the read and write are done under a lock of
+    the chat. Chats whose quota was never counted are counted instead.
+
+    Args:
+        chat_id (str): chat id as per db in chats.
+        given (int, optional): Alerts given by a code. Defaults to 0.
+        used (int, optional): Alerts created. Defaults to 0.
+    """
+    with get_quota_lock(chat_id):
+        chat = get_client().collection("chats").get_one(chat_id)
+        if not getattr(chat, "quota_reconciled_at", None):
+            save_alert_quota(chat_id, *count_alert_quota(chat_id))
+            return
+
+        get_client().collection("chats").update(
+            chat_id,
+            {
+                "alert_amt_given": (chat.alert_amt_given or 0) + given,
+                "alert_amt_used": (chat.alert_amt_used or 0) + used,
+            },
+        )
+
+
+def get_alerts_left(chat_id: str) -> int:
+    """Get how many more alerts a chat can create, with one read of the chat.
+
+    Args:
+        chat_id (str): chat id as per db in chats.
+
+    Returns:
+        int: Alerts left.
+    """
+    chat = get_client().collection("chats").get_one(chat_id)
+    if not getattr(chat, "quota_reconciled_at", None):
+        with get_quota_lock(chat_id):
+            given, used = count_alert_quota(chat_id)
+            save_alert_quota(chat_id, given, used)
+        return given - used
+
+    return (chat.alert_amt_given or 0) - (chat.alert_amt_used or 0)
+
+
+def reconcile_alert_quotas() -> int:
+    """Count the quota of every chat again and fix the ones which drifted, e.g.
+    when a write failed halfway or two processes added at once.
+
+    The quota lock is only of this process, so it does not keep the bot from
+    adding to a quota meanwhile. Chats which look drifted are counted again on
+    their own, and left for the next run if their quota changed since they were
+    read, so a fresh add is not overwritten with a stale count. An add landing
+    between the last read and the write can still be overwritten.
+
+    Returns:
+        int: Number of chats fixed.
+    """
+    chats = get_client().collection("chats").get_full_list(batch=500)
+
+    given = Counter()
+    for code in (
+        get_client()
+        .collection("codes")
+        .get_full_list(batch=500, query_params={"filter": 'subscribed_by != ""'})
+    ):
+        given[code.subscribed_by] += code.alert_amt_to_give
+
+    used = Counter(
+        alert.created_by
+        for alert in get_client()
+        .collection("alerts")
+        .get_full_list(batch=500, query_params={"filter": 'created_by != ""'})
+    )
+
+    num_of_fixed = 0
+    for chat in chats:
+        quota = (getattr(chat, "alert_amt_given", 0), getattr(chat, "alert_amt_used", 0))
+        if getattr(chat, "quota_reconciled_at", None) and quota == (
+            given[chat.id],
+            used[chat.id],
+        ):
+            continue
+
+        with get_quota_lock(chat.id):
+            counted = count_alert_quota(chat.id)
+            current = get_client().collection("chats").get_one(chat.id)
+            if (
+                getattr(current, "alert_amt_given", 0),
+                getattr(current, "alert_amt_used", 0),
+            ) != quota:
+                print(f"Quota changed while reconciling, skipping... [{chat.id}]")
+                continue
+            if getattr(chat, "quota_reconciled_at", None) and quota == counted:
+                continue
+
+            save_alert_quota(chat.id, *counted)
+        num_of_fixed += 1
+
+    return num_of_fixed
+
+
+def find_sent_notification_keys(keys: list) -> set:
+    """Find which notifications were already sent.
+
+    Args:
+        keys (list): Idempotency keys of the notifications.
+
+    Returns:
+        set: Keys already sent.
+    """
+    sent_keys = set()
+    chunk_size = int(os.getenv("LISTING_FILTER_CHUNK_SIZE", "50"))
+    for index in range(0, len(keys), chunk_size):
+        chunk = keys[index:index + chunk_size]
+        notifications = (
+            get_client()
+            .collection("notifications")
+            .get_list(1, len(chunk), query_params={"filter": filter_any("key", chunk)})
+        )
+        sent_keys.update(notification.key for notification in notifications.items)
+
+    return sent_keys
+
+
+def save_sent_notification(alert_id: str, key: str):
+    """Remember a notification was sent.
+
+    Args:
+        alert_id (str): alert id as per db in alerts.
+        key (str): Idempotency key of the notification.
+    """
+    get_client().collection("notifications").create(
+        {"key": key, "alert_id": alert_id, "sent_at": datetime.today().isoformat()}
+    )
+
+
+def count_pending_digest_entries(chat_id: str) -> int:
+    """Count the buffered messages of a chat not claimed by a flush yet.
+
+    Args:
+        chat_id (str): Telegram user id of the chat.
+
+    Returns:
+        int: Messages waiting for a flush.
+    """
+    return (
+        get_client()
+        .collection("digest_entries")
+        .get_list(
+            1,
+            1,
+            query_params={
+                "filter": f'{filter_equals("chat_id", chat_id)} && flush_owner = ""'
+            },
+        )
+        .total_items
+    )
+
+
+def create_digest_entry(chat_id: str, alert_id: str, key: str, text: str, footer: str):
+    """Buffer a message of an alert until the digest of its chat is flushed.
+
+    Args:
+        chat_id (str): Telegram user id of the chat.
+        alert_id (str): alert id as per db in alerts.
+        key (str): Idempotency key of the message.
+        text (str): Listings of the message.
+        footer (str): Search of the alert, shown under its listings.
+    """
+    get_client().collection("digest_entries").create(
+        {
+            "chat_id": chat_id,
+            "alert_id": alert_id,
+            "key": key,
+            "text": text,
+            "footer": footer,
+            "flush_owner": "",
+        }
+    )
+
+
+def claim_digest_entries(chat_id: str, flush_owner: str, lease_seconds: float = 600):
+    """Claim the buffered messages of a chat for a flush.
+
+    Like the leases on alerts, the claim is written and read back, and claims
+    older than lease_seconds are taken over as their flush must have died.
+
+    Args:
+        chat_id (str): Telegram user id of the chat.
+        flush_owner (str): Owner to claim them with.
+        lease_seconds (float, optional): Age of a claim to take over. Defaults to
+        600.
+
+    Returns:
+        list: Buffered messages claimed, oldest first.
+    """
+    stale = quote_filter_value(
+        datetime.fromtimestamp(datetime.today().timestamp() - lease_seconds)
+    )
+    entries = (
+        get_client()
+        .collection("digest_entries")
+        .get_full_list(
+            query_params={
+                "filter": f'{filter_equals("chat_id", chat_id)} && '
+                f'(flush_owner = "" || claimed_at < {stale})',
+            }
+        )
+    )
+    for entry in entries:
+        get_client().collection("digest_entries").update(
+            entry.id,
+            {"flush_owner": flush_owner, "claimed_at": datetime.today().isoformat()},
+        )
+
+    return (
+        get_client()
+        .collection("digest_entries")
+        .get_full_list(
+            query_params={
+                "filter": filter_equals("flush_owner", flush_owner),
+                "sort": "created",
+            }
+        )
+    )
+
+
+def release_digest_entry(entry_id: str):
+    get_client().collection("digest_entries").update(
+        entry_id, {"flush_owner": "", "claimed_at": ""}
+    )
+
+
+def delete_digest_entry(entry_id: str):
+    get_client().collection("digest_entries").delete(entry_id)
@@ -2,6 +2,8 @@ from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import string
 import random
+import threading
+import time
 
 
 def get_alert_next_time_to_run(min_seconds=150, max_seconds=600):
@@ -19,3 +21,39 @@ def generate_random_string(length=5):
     )  # You can customize the character set as needed
     random_string = "".join(random.choice(characters) for _ in range(length))
     return random_string
+
+
+class TTLCache:
+    """Small in-process cache whose entries expire after ttl_seconds."""
+
+    def __init__(self, ttl_seconds=3600, max_size=10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return default
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                # Drop the oldest entry.
+                del self._entries[next(iter(self._entries))]
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
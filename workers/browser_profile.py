@@ -0,0 +1,154 @@
+"""Lean browser profile, loading only what is needed to read the listing cards.
+
+Scrapes read the card DOM and the src of images, never the image bytes, so
+images, media, fonts and trackers are blocked, and pages are handed over once
+the DOM is ready instead of once every resource has loaded.
+"""
+
+import os
+
+# Blocked through the DevTools protocol, on top of the images blocked by prefs.
+BLOCKED_URL_PATTERNS = [
+    "*.jpg",
+    "*.jpeg",
+    "*.png",
+    "*.gif",
+    "*.webp",
+    "*.avif",
+    "*.svg",
+    "*.ico",
+    "*.mp4",
+    "*.webm",
+    "*.m3u8",
+    "*.mp3",
+    "*.woff",
+    "*.woff2",
+    "*.ttf",
+    "*.otf",
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*googlesyndication.com*",
+    "*doubleclick.net*",
+    "*connect.facebook.net*",
+    "*facebook.com/tr*",
+    "*analytics.tiktok.com*",
+    "*hotjar.com*",
+    "*branch.io*",
+    "*appsflyer.com*",
+    "*criteo.com*",
+    "*criteo.net*",
+    "*scorecardresearch.com*",
+    "*clarity.ms*",
+    "*sentry.io*",
+]
+
+
+def is_lean_profile_enabled():
+    return os.getenv("LEAN_BROWSER_PROFILE", "true") == "true"
+
+
+def get_blocked_url_patterns():
+    """Get the urls to block, with those added in BROWSER_BLOCKED_URLS.
+
+    Returns:
+        list: Url patterns, * matches anything.
+    """
+    extra = os.getenv("BROWSER_BLOCKED_URLS", "")
+    return BLOCKED_URL_PATTERNS + [
+        pattern.strip() for pattern in extra.split(",") if pattern.strip()
+    ]
+
+
+def apply_lean_options(options):
+    """Set up chrome options to skip images and media and to hand the page over
+    once the DOM is ready.
+
+    Args:
+        options (ChromeOptions): Options of the driver to be created.
+
+    Returns:
+        ChromeOptions: Same options.
+    """
+    options.page_load_strategy = "eager"
+    options.add_argument("--blink-settings=imagesEnabled=false")
+    options.add_argument("--autoplay-policy=user-gesture-required")
+    options.add_experimental_option(
+        "prefs",
+        {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.default_content_setting_values.notifications": 2,
+            "profile.default_content_setting_values.geolocation": 2,
+        },
+    )
+    return options
+
+
+def execute_cdp_command(driver, cmd: str, params: dict = None):
+    """Run a DevTools protocol command in a session.
+
+    The remote driver talks to the selenium server through a plain
+    RemoteConnection, which unlike the chrome one does not know of the chromium
+    cdp endpoint, so it is registered first.
+
+    Args:
+        driver (webdriver): Webdriver from selenium, on chrome.
+        cmd (str): Command, like Network.enable.
+        params (dict, optional): Parameters of the command.
+
+    Returns:
+        dict: Result of the command.
+    """
+    driver.command_executor._commands.setdefault(
+        "executeCdpCommand", ("POST", "/session/$sessionId/goog/cdp/execute")
+    )
+    return driver.execute(
+        "executeCdpCommand", {"cmd": cmd, "params": params or {}}
+    )["value"]
+
+
+def block_resources(driver):
+    """Block fonts, media and trackers in a session through the DevTools protocol.
+
+    Args:
+        driver (webdriver): Webdriver from selenium, on chrome.
+
+    Returns:
+        bool: False when the session does not support it, only images are then
+        blocked, through prefs.
+    """
+    try:
+        execute_cdp_command(driver, "Network.enable")
+        execute_cdp_command(
+            driver, "Network.setBlockedURLs", {"urls": get_blocked_url_patterns()}
+        )
+        return True
+    except Exception as error:
+        print(
+            "WARNING: could not block resources through the DevTools protocol, "
+            f"fonts, media and trackers will be loaded... {error!r}"
+        )
+        return False
+
+
+def get_transfer_bytes(driver):
+    """Get the bytes transferred to load the current page, from the resource
+    timing of the browser. Blocked requests are not counted.
+
+    Args:
+        driver (webdriver): Webdriver from selenium.
+
+    Returns:
+        int: Bytes transferred, 0 when the browser can not tell.
+    """
+    try:
+        return int(
+            driver.execute_script(
+                """return performance.getEntriesByType("navigation")
+                    .concat(performance.getEntriesByType("resource"))
+                    .reduce((total, entry) => total + (entry.transferSize || 0), 0);"""
+            )
+            or 0
+        )
+    except Exception as error:
+        print(f"Could not get bytes transferred... {error}")
+        return 0
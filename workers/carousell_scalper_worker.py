@@ -1,24 +1,120 @@
 """Worker file for scrapping."""
 
-import re
 import os
 import time
+import uuid
+import threading
 from urllib.parse import quote
-from datetime import datetime, date
-from urllib.parse import urlparse
+from datetime import datetime
+from urllib.parse import parse_qs, urlparse
 
-import asyncio
 from celery import Celery
-from telegram import Bot
+from celery.signals import task_postrun, worker_process_shutdown, worker_ready
 
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from selenium import webdriver
-from pocketbase import PocketBase, utils as pbutils
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.support.ui import WebDriverWait
+from pocketbase import utils as pbutils
 
 import utils
-from constants import USER_AGENTS, BASE_URL, CURRENCY_MAP
-import random
+import repository
+from db import get_client
+from metrics import (
+    SCRAPE_STAGE_SECONDS,
+    STAGE_BUCKETS,
+    Counter,
+    Gauge,
+    Histogram,
+    clear_metrics_snapshots,
+    get_histogram,
+    span,
+    start_metrics_server,
+    write_metrics_snapshot,
+)
+from constants import BASE_URL, CURRENCY_MAP
+from workers.driver_pool import init_driver_pool
+from workers.browser_profile import (
+    apply_lean_options,
+    block_resources,
+    get_transfer_bytes,
+    is_lean_profile_enabled,
+)
+from workers.telegram_sender import FAILED, init_telegram_sender
+from workers.notifications import (
+    FEEDBACK_FOOTER,
+    FIRST_RUN_KEY,
+    build_notifications,
+    delivery_latency,
+    get_alert_footer,
+    get_digest_max_messages,
+    get_digest_window_seconds,
+    get_notification_queue,
+    is_notification_queue_enabled,
+    observe_delivery,
+    pack_blocks,
+    pack_digest,
+    parse_created,
+)
+from workers.listing_extractor import (
+    CARD_CSS,
+    extract_listings,
+    extract_listings_from_soup,
+    extract_listings_in_browser,
+    get_card_listing_id,
+    get_high_water_listing_id,
+    is_browser_extraction_enabled,
+    is_older_listing,
+)
+from workers.listing_writer import bulk_create_listings
+from workers.seen_index import SeenIndex, evict_expired_indexes
+from workers.leases import (
+    ONGOING_STATUS,
+    READY_STATUS,
+    claim_alert,
+    reap_expired_leases,
+    release_lease,
+    renew_lease,
+)
+from workers.scheduler import (
+    get_adaptive_next_time_to_run,
+    get_average_scrape_seconds,
+    get_capacity_load,
+    get_known_listing_rate,
+    get_scrape_demand,
+    get_group_fetch_backend,
+    get_group_high_water_listing_id,
+    get_lag_seconds,
+    get_scrape_capacity,
+    group_jobs_by_url,
+    parse_db_datetime,
+    update_listing_rate,
+)
+from workers.fetchers import (
+    HTTP_BACKEND,
+    SELENIUM_BACKEND,
+    choose_fetch_backend,
+    fetch_page_with_http,
+)
+
+
+SCRAPE_TICK_SECONDS = 60.0
+NEWEST_SORT_BY = "3"
+LOAD_MORE_XPATH = "//button[contains(text(), 'Show more results')]"
+# Shown instead of the cards when nothing matches the search.
+NO_RESULTS_XPATH = "//*[contains(text(), 'No results found') or contains(text(), 'No results for')]"
+
+items_parsed = Counter("scrape_items_parsed_total")
+listings_created = Counter("scrape_listings_created_total")
+scrape_duration = Histogram("scrape_task_seconds")
+browser_bytes = Counter("browser_transfer_bytes_total")
+scrape_demand_cache = utils.TTLCache(
+    ttl_seconds=float(os.getenv("CAPACITY_LOAD_REFRESH_SECONDS", "600"))
+)
+scheduler_backlog = Gauge("scheduler_backlog_alerts")
+scheduler_lag = Gauge("scheduler_lag_seconds")
+scheduler_queue_depth = Gauge("scheduler_queue_depth")
 
 
 def init_celery():
@@ -37,8 +133,26 @@ def init_celery():
     celery_init.conf.beat_schedule = {
         "scrape_ready_alerts": {
             "task": "workers.carousell_scalper_worker.scrape_ready_alerts",
-            "schedule": 60.0,
-        }
+            "schedule": SCRAPE_TICK_SECONDS,
+        },
+        "reap_alert_leases": {
+            "task": "workers.carousell_scalper_worker.reap_alert_leases",
+            "schedule": SCRAPE_TICK_SECONDS,
+        },
+        "reconcile_alert_quotas": {
+            "task": "workers.carousell_scalper_worker.reconcile_alert_quotas",
+            "schedule": 3600.0,
+        },
+    }
+    # Notifications are consumed by their own workers, started with
+    # -Q notifications, so telegram never holds up a scrape.
+    celery_init.conf.task_routes = {
+        "workers.carousell_scalper_worker.send_alert_notifications": {
+            "queue": get_notification_queue()
+        },
+        "workers.carousell_scalper_worker.flush_chat_digest": {
+            "queue": get_notification_queue()
+        },
     }
 
     return celery_init
@@ -49,9 +163,90 @@ load_dotenv()
 celery = init_celery()
 
 
-def get_client():
-    client = PocketBase(os.getenv("POCKETBASE_URL"))
-    return client
+driver_pool = None
+telegram_sender = None
+telegram_sender_pid = None
+
+
+def get_driver_pool():
+    """Get the selenium session pool of this worker process, created on first use
+    so that every forked worker process gets its own sessions.
+
+    Returns:
+        DriverPool: Pool of selenium sessions.
+    """
+    global driver_pool
+    if driver_pool is None:
+        driver_pool = init_driver_pool(set_up_driver_option)
+    return driver_pool
+
+
+def get_telegram_sender():
+    """Get the telegram sender of this worker process, created on first use and
+    again after a fork, as its event loop thread does not survive one.
+
+    Returns:
+        TelegramSender: Sender of the process.
+    """
+    global telegram_sender, telegram_sender_pid
+    if telegram_sender is None or telegram_sender_pid != os.getpid():
+        telegram_sender = init_telegram_sender()
+        telegram_sender_pid = os.getpid()
+    return telegram_sender
+
+
+@worker_process_shutdown.connect
+def close_telegram_sender(**kwargs):
+    """Shut the telegram bot down when the worker process exits."""
+    if telegram_sender is not None and telegram_sender_pid == os.getpid():
+        telegram_sender.close()
+
+
+@worker_process_shutdown.connect
+def close_driver_pool(**kwargs):
+    """Quit the warm selenium sessions when the worker process exits."""
+    if driver_pool is not None:
+        print(driver_pool.stats_line())
+        driver_pool.close()
+
+
+@worker_ready.connect
+def serve_worker_metrics(**kwargs):
+    """Serve the metrics of the worker processes of this host from the main
+    worker process."""
+    clear_metrics_snapshots()
+    port = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+    if port > 0:
+        start_metrics_server(port)
+        print(f"serving metrics on {port}...")
+
+
+@worker_ready.connect
+def schedule_seen_index_eviction(**kwargs):
+    """Delete the seen listings index of expired alerts every
+    SEEN_INDEX_EVICT_SECONDS from the main worker process. Indexes are kept on the
+    disk of each worker, which a beat task, run by a single worker, would not all
+    reach."""
+    interval = float(os.getenv("SEEN_INDEX_EVICT_SECONDS", "3600"))
+
+    def evict():
+        while True:
+            try:
+                print(f"{evict_expired_indexes()} seen listings indexes evicted...")
+            except OSError as error:
+                print(f"Could not evict seen listings indexes... {error}")
+            time.sleep(interval)
+
+    threading.Thread(target=evict, name="seen-index-eviction", daemon=True).start()
+
+
+@task_postrun.connect
+def save_worker_metrics(**kwargs):
+    """Save the metrics of this worker process after each task."""
+    try:
+        write_metrics_snapshot()
+    except OSError as error:
+        print(f"Could not save metrics... {error}")
 
 
 @celery.task()
@@ -63,6 +258,13 @@ def scrape_carousell_with_params(
     to_range=None,
     is_first_time=False,
     initial_url=None,
+    fetch_backend=None,
+    expire_at=None,
+    high_water_listing_id=None,
+    lease_owner=None,
+    listing_rate=None,
+    last_scraped_at=None,
+    capacity_load=None,
 ):
     """Scrape Carousell website with search params. Will update DB when done.
 
@@ -74,107 +276,433 @@ def scrape_carousell_with_params(
         to_range (float, optional): Maximum price. Defaults to None.
         is_first_time (bool, optional): Is this the first time the alert runs.
         Defaults to False.
+        initial_url (str, optional): Url pasted by the user. Defaults to None.
+        fetch_backend (str, optional): Backend recorded on the alert by its last run.
+        Defaults to None.
+        expire_at (str, optional): When the alert expires, kept with its seen
+        listings index. Defaults to None.
+        high_water_listing_id (str, optional): Newest listing id found by the last
+        run, scrapping stops once older listings are reached. Defaults to None.
+        lease_owner (str, optional): Lease taken on the alert when it was queued.
+        Defaults to None.
+        listing_rate (float, optional): Estimated new listings per hour. Defaults
+        to None.
+        last_scraped_at (str, optional): When the alert was last scraped. Defaults
+        to None.
+        capacity_load (float, optional): Share of the scrape slots the alerts ask
+        for, holding the next run to the budget of the alert. Defaults to None.
     """
-    print("data")
-    print(initial_url)
-    print(query, from_range, to_range)
+    scrape_carousell_shared_query(
+        [
+            {
+                "alert_id": alert_id,
+                "chat_id": chat_id,
+                "query": query,
+                "from_range": from_range,
+                "to_range": to_range,
+                "is_first_time": is_first_time,
+                "initial_url": initial_url,
+                "fetch_backend": fetch_backend,
+                "expire_at": expire_at,
+                "high_water_listing_id": high_water_listing_id,
+                "lease_owner": lease_owner,
+                "listing_rate": listing_rate,
+                "last_scraped_at": last_scraped_at,
+                "capacity_load": capacity_load,
+            }
+        ]
+    )
 
+
+@celery.task()
+def scrape_carousell_shared_query(jobs: list):
+    """Scrape a search once for every alert subscribed to it, then save and send
+    the listings of each alert. Will update DB when done.
+
+    Args:
+        jobs (list): Arguments of scrape_carousell_with_params of each alert, all
+        searching for the same url.
+    """
+    print(f"scrapping for alerts {[job['alert_id'] for job in jobs]}")
+    started_at = time.monotonic()
+
+    owned_jobs = []
     try:
-        print(f"set status to ongoing... [{alert_id}]")
-        get_client().collection("alerts").update(
-            alert_id,
-            {
-                "status": "ongoing",
-            },
-        )
+        for job in jobs:
+            print(f"set status to ongoing... [{job['alert_id']}]")
+            if job.get("lease_owner") is None:
+                repository.update_alert(job["alert_id"], {"status": ONGOING_STATUS})
+            elif not renew_lease(
+                get_client(), job["alert_id"], job["lease_owner"], ONGOING_STATUS
+            ):
+                print(f"Lease was reclaimed, skipping... [{job['alert_id']}]")
+                continue
+            owned_jobs.append(job)
+
+        if len(owned_jobs) == 0:
+            return
 
         print("setting up url...")
-        if initial_url is None or initial_url == "":
-            url = set_up_scape_url(
-                query=query, from_range=from_range, to_range=to_range
-            )
-        else:
-            url = set_up_initial_url_better(initial_url)
+        url = set_up_job_url(owned_jobs[0])
         print(url)
 
-        print("setting up driver...")
-        driver = set_up_driver_option(random.choice(USER_AGENTS))
-        print("driver getting url...")
-        driver.get(url)
+        high_water_listing_id = get_group_high_water_listing_id(owned_jobs)
+        if os.getenv("INCREMENTAL_SCRAPE", "true") != "true":
+            high_water_listing_id = None
+        # Older listings only come after the mark when sorted by newest.
+        if not is_sorted_by_newest(url):
+            high_water_listing_id = None
+
+        items, backend = fetch_listings(
+            url,
+            is_first_time=owned_jobs[0]["is_first_time"],
+            fetch_backend=get_group_fetch_backend(owned_jobs),
+            high_water_listing_id=high_water_listing_id,
+        )
+
+        deliveries = []
+        for job in owned_jobs:
+            if job.get("lease_owner") is not None and not renew_lease(
+                get_client(), job["alert_id"], job["lease_owner"]
+            ):
+                print(f"Lease was reclaimed, skipping... [{job['alert_id']}]")
+                continue
+
+            try:
+                delivery = save_and_send_listings(job, items, url, backend)
+                if delivery is not None:
+                    deliveries.append((job["alert_id"], delivery))
+            except pbutils.ClientResponseError as error:
+                print(f"Seem to be an error with pocketbase... {error.data}")
+            except Exception as error:
+                print(f"Seem to be an error... {error}")
+
+        # Messages of the alerts go out concurrently, wait for all of them when
+        # they are not queued.
+        for alert_id, delivery in deliveries:
+            print(f"messages delivered... {delivery.result()} [{alert_id}]")
+
+    except pbutils.ClientResponseError as error:
+        print(f"Seem to be an error with pocketbase... {error.data}")
+    except Exception as error:
+        print(f"Seem to be an error... {error}")
+    finally:
+        print(f"pocketbase: {get_client().metrics_line()}")
+        scrape_seconds = round(time.monotonic() - started_at, 3)
+        scrape_duration.observe(scrape_seconds)
+        for job in owned_jobs:
+            if job.get("lease_owner") is None:
+                repository.update_alert(
+                    job["alert_id"],
+                    {
+                        "status": READY_STATUS,
+                        "last_scrape_seconds": scrape_seconds,
+                    },
+                )
+            else:
+                release_lease(
+                    get_client(),
+                    job["alert_id"],
+                    job["lease_owner"],
+                    {"last_scrape_seconds": scrape_seconds},
+                )
+
 
-        # ! Remove this as we only need the most recent.
-        # Click on load more button until there is no more.
-        if is_first_time:
-            print("Is first time loading longer...")
-            continuous_press_load_more_button(driver, 5)
+def set_up_job_url(job: dict):
+    """Set up the url to scrape for the arguments of an alert.
 
-        print("scrapping...")
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-        items = scrape_page(soup, alert_id, hostname=urlparse(url).hostname)
+    Args:
+        job (dict): Arguments of scrape_carousell_with_params.
 
-        items_created, messages = create_listing_to_db(
-            items, alert_id, hostname=urlparse(url).hostname
+    Returns:
+        str: Url to be used to scrape.
+    """
+    if job.get("initial_url") is None or job["initial_url"] == "":
+        return set_up_scape_url(
+            query=job["query"], from_range=job["from_range"], to_range=job["to_range"]
         )
 
-        print("sending messages...")
+    return set_up_initial_url_better(job["initial_url"])
 
-        if is_first_time:
-            messages = [
-                f"Alert ran for the first time and found {items_created} new listings! Subsequent alerts will only send\
- you new listings.\n"
-            ]
-
-            asyncio.run(
-                send_messages(
-                    chat_id,
-                    messages,
-                    query=query,
-                    from_range=from_range,
-                    to_range=to_range,
-                    initial_url=initial_url,
+
+def fetch_listings(
+    url: str, is_first_time=False, fetch_backend=None, high_water_listing_id=None
+):
+    """Load the search page, with plain http when possible, and extract listings.
+
+    Args:
+        url (str): Url to be scraped.
+        is_first_time (bool, optional): Load every page of the search. Defaults to
+        False.
+        fetch_backend (str, optional): Backend recorded by the last run. Defaults to
+        None.
+        high_water_listing_id (str, optional): Newest listing id found by the last
+        run. Defaults to None.
+
+    Returns:
+        tuple: Items found, without alert id, and the backend used.
+    """
+    items = None
+    backend = choose_fetch_backend(fetch_backend, is_first_time)
+    if backend == HTTP_BACKEND:
+        try:
+            print("fetching with http...")
+            with span(SCRAPE_STAGE_SECONDS, stage="http_fetch"):
+                html = fetch_page_with_http(url)
+            with span(SCRAPE_STAGE_SECONDS, stage="parse"):
+                items = extract_listings(
+                    html,
+                    None,
+                    urlparse(url).hostname,
+                    high_water_listing_id=high_water_listing_id,
                 )
-            )
-        else:
-            if items_created > 0:
-                asyncio.run(
-                    send_messages(
-                        chat_id,
-                        messages,
-                        query=query,
-                        from_range=from_range,
-                        to_range=to_range,
-                        initial_url=initial_url,
+        except Exception as error:
+            print(f"Could not fetch with http... {error}")
+
+        if not items:
+            print("No listings found with http, falling back to selenium...")
+            backend = SELENIUM_BACKEND
+
+    if backend == SELENIUM_BACKEND:
+        print("acquiring driver...")
+        with span(SCRAPE_STAGE_SECONDS, stage="driver_acquire"):
+            driver = get_driver_pool().acquire()
+        driver_failed = False
+        try:
+            print("driver getting url...")
+            with span(SCRAPE_STAGE_SECONDS, stage="page_load"):
+                driver.get(url)
+                wait_for_cards(driver)
+
+            # ! Remove this as we only need the most recent.
+            # Click on load more button until there is no more.
+            if is_first_time:
+                print("Is first time loading longer...")
+                with span(SCRAPE_STAGE_SECONDS, stage="load_more"):
+                    load_more_stats = continuous_press_load_more_button(
+                        driver, high_water_listing_id=high_water_listing_id
+                    )
+                print(f"load more stats... {load_more_stats}")
+
+            print("scrapping...")
+            with span(SCRAPE_STAGE_SECONDS, stage="parse"):
+                items = None
+                if is_browser_extraction_enabled():
+                    try:
+                        items = extract_listings_in_browser(
+                            driver,
+                            None,
+                            urlparse(url).hostname,
+                            high_water_listing_id=high_water_listing_id,
+                        )
+                    except WebDriverException as error:
+                        print(f"Could not extract in browser... {error}")
+
+                if items is None:
+                    items = extract_listings(
+                        driver.page_source,
+                        None,
+                        urlparse(url).hostname,
+                        high_water_listing_id=high_water_listing_id,
                     )
-                )
 
-        print("updating alert...")
-        next_time_to_run = utils.get_alert_next_time_to_run()
-        get_client().collection("alerts").update(
+            transfer_bytes = get_transfer_bytes(driver)
+            browser_bytes.inc(transfer_bytes)
+            print(f"page transferred {transfer_bytes} bytes...")
+        except Exception:
+            driver_failed = True
+            raise
+        finally:
+            print("releasing driver...")
+            get_driver_pool().release(driver, discard=driver_failed)
+            print(get_driver_pool().stats_line())
+
+    items_parsed.inc(len(items))
+    return items, backend
+
+
+def save_and_send_listings(job: dict, items: list, url: str, backend: str):
+    """Save the new listings of an alert, send them to its chat and schedule its
+    next run.
+
+    Args:
+        job (dict): Arguments of scrape_carousell_with_params of the alert.
+        items (list): Items found for the search of the alert.
+        url (str): Url scraped.
+        backend (str): Backend used to load the page.
+
+    Returns:
+        Future: Delivery of the messages when they are sent from the scrape, None
+        when they are queued or there are none to send.
+    """
+    alert_id = job["alert_id"]
+    items = [{**item, "alert_id": alert_id} for item in items]
+
+    items_created, messages, message_listing_ids = create_listing_to_db(
+        items, alert_id, hostname=urlparse(url).hostname, expire_at=job["expire_at"]
+    )
+
+    print("sending messages...")
+
+    if job["is_first_time"]:
+        messages = [
+            f"Alert ran for the first time and found {items_created} new listings! Subsequent alerts will only send\
+ you new listings.\n"
+        ]
+        message_listing_ids = [[FIRST_RUN_KEY]]
+
+    delivery = None
+    notifications = build_notifications(alert_id, messages, message_listing_ids)
+    if not (job["is_first_time"] or items_created > 0):
+        notifications = []
+
+    if len(notifications) > 0 and not is_notification_queue_enabled():
+        delivery = send_messages(
+            job["chat_id"],
+            messages,
+            query=job["query"],
+            from_range=job["from_range"],
+            to_range=job["to_range"],
+            initial_url=job["initial_url"],
+        )
+    elif (
+        len(notifications) > 0
+        and get_digest_window_seconds() > 0
+        and not job["is_first_time"]
+    ):
+        # First runs are not buffered, they tell the user the alert works.
+        queue_digest_notifications(job, notifications)
+    elif len(notifications) > 0:
+        send_alert_notifications.delay(
+            job["chat_id"],
             alert_id,
-            {
-                "status": "ready_to_search",
-                "next_time_to_run": next_time_to_run.isoformat(),
-                "is_first_scrape": False,
-            },
+            notifications,
+            query=job["query"],
+            from_range=job["from_range"],
+            to_range=job["to_range"],
+            initial_url=job["initial_url"],
+            enqueued_at=time.time(),
         )
 
-        print(f"{items_created} new listings created... [{alert_id}]")
+    print("updating alert...")
+    scraped_at = datetime.today()
+    listing_rate = job.get("listing_rate")
+    last_scraped_at = parse_db_datetime(job.get("last_scraped_at"))
+    if not job["is_first_time"] and last_scraped_at is not None:
+        listing_rate = update_listing_rate(
+            listing_rate, items_created, (scraped_at - last_scraped_at).total_seconds()
+        )
 
-    except pbutils.ClientResponseError as error:
-        print(f"Seem to be an error with pocketbase... {error.data}")
-    except Exception as error:
-        print(f"Seem to be an error... {error}")
-    finally:
-        print("quitting driver...")
-        get_client().collection("alerts").update(
-            alert_id,
-            {
-                "status": "ready_to_search",
-            },
+    if os.getenv("ADAPTIVE_POLLING", "true") == "true":
+        next_time_to_run = get_adaptive_next_time_to_run(
+            listing_rate, job.get("capacity_load")
+        )
+    else:
+        next_time_to_run = utils.get_alert_next_time_to_run()
+
+    repository.update_alert(
+        alert_id,
+        {
+            "next_time_to_run": next_time_to_run.isoformat(),
+            "last_scraped_at": scraped_at.isoformat(),
+            "listing_rate": listing_rate,
+            "is_first_scrape": False,
+            "fetch_backend": backend,
+            "high_water_listing_id": get_high_water_listing_id(
+                items, job["high_water_listing_id"]
+            )
+            if is_sorted_by_newest(url)
+            else None,
+        },
+    )
+
+    print(f"{items_created} new listings created with {backend}... [{alert_id}]")
+    return delivery
+
+
+def get_alert_job(alert, user_id, capacity_load=None):
+    """Get the arguments of scrape_carousell_with_params for an alert.
+
+    Args:
+        alert (Record): Alert as per db in alerts.
+        user_id (str): Telegram user id of the chat which created the alert.
+        capacity_load (float, optional): Share of the scrape slots the alerts ask
+        for. Defaults to None.
+
+    Returns:
+        dict: Arguments of scrape_carousell_with_params, plus the url to scrape.
+    """
+    job = {
+        "alert_id": alert.id,
+        "chat_id": user_id,
+        "query": None,
+        "from_range": None,
+        "to_range": None,
+        "is_first_time": alert.is_first_scrape,
+        "initial_url": None,
+        "fetch_backend": getattr(alert, "fetch_backend", None),
+        "expire_at": alert.expire_at,
+        "high_water_listing_id": getattr(alert, "high_water_listing_id", None) or None,
+        "listing_rate": get_known_listing_rate(alert),
+        "last_scraped_at": getattr(alert, "last_scraped_at", None) or None,
+        "capacity_load": capacity_load,
+    }
+    if alert.url is not None and alert.url != "":
+        job["initial_url"] = alert.url
+    else:
+        job["query"] = alert.query
+        job["from_range"] = alert.from_price
+        job["to_range"] = alert.to_price
+
+    job["url"] = set_up_job_url(job)
+    return job
+
+
+def dispatch_scrape_jobs(jobs: list, max_scrapes: int = None):
+    """Queue one scrape per unique search, shared by every alert subscribed to it.
+
+    Args:
+        jobs (list): Jobs from get_alert_job, most overdue first.
+        max_scrapes (int, optional): Max scrapes to queue, the most overdue searches
+        go first. Defaults to None, no limit.
+
+    Returns:
+        tuple: Number of alerts and number of scrapes queued.
+    """
+    groups = []
+    for group in list(group_jobs_by_url(jobs).values())[:max_scrapes]:
+        # Lease the alerts before queuing, so the next tick does not queue them
+        # again while they wait.
+        claimed_group = []
+        for job in group:
+            lease_owner = claim_alert(get_client(), job["alert_id"])
+            if lease_owner is None:
+                print(f"Alert was claimed by someone else... [{job['alert_id']}]")
+                continue
+            claimed_group.append(
+                {
+                    **{k: v for k, v in job.items() if k != "url"},
+                    "lease_owner": lease_owner,
+                }
+            )
+        if len(claimed_group) > 0:
+            groups.append(claimed_group)
+
+    jobs = [job for group in groups for job in group]
+    for group in groups:
+        if len(group) == 1:
+            print("scrape_carousell_with_params.delay")
+            scrape_carousell_with_params.delay(**group[0])
+        else:
+            print(f"scrape_carousell_shared_query.delay for {len(group)} alerts")
+            scrape_carousell_shared_query.delay(group)
+
+    if len(jobs) > 0:
+        print(
+            f"coalesced {len(jobs)} alerts into {len(groups)} scrapes "
+            f"({len(jobs) / len(groups):.2f} alerts per scrape)"
         )
-        if driver is not None:
-            driver.delete_all_cookies()
-            driver.quit()
+    return len(jobs), len(groups)
 
 
 @celery.task()
@@ -185,56 +713,284 @@ def scrape_ready_alerts():
     try:
         print("scrape_ready_alerts")
 
-        alerts_to_scrape = (
-            get_client()
-            .collection("alerts")
-            .get_full_list(
-                query_params={
-                    "filter": f"""status = "ready_to_search" &&
-                                        next_time_to_run < "{datetime.today()}" &&
-                                        expire_at > "{datetime.today()}" """,
-                    "sort": "next_time_to_run",  # Sort by next_time_to_run in ascending order
-                }
-            )
+        average_scrape_seconds = get_average_scrape_seconds(
+            repository.get_recent_scrape_seconds()
+        )
+        in_flight = repository.count_in_flight_alerts()
+        scrape_demand = get_cached_scrape_demand()
+        capacity_load = get_capacity_load(scrape_demand, average_scrape_seconds)
+        queue_depth = get_queue_depth()
+        capacity = get_scrape_capacity(
+            in_flight, average_scrape_seconds, SCRAPE_TICK_SECONDS
         )
 
-        # filter alerts_to_scrape to 3 items.
-        alerts_to_scrape = alerts_to_scrape[:3]
+        # Only fetch as many alerts as there are scrapes to queue, most overdue
+        # first. The total tells how many are waiting.
+        alerts_to_scrape = repository.get_due_alerts_page(max(capacity, 1))
+
+        lag_seconds = 0
+        if len(alerts_to_scrape.items) > 0:
+            lag_seconds = get_lag_seconds(alerts_to_scrape.items[0].next_time_to_run)
+        scheduler_backlog.set(alerts_to_scrape.total_items)
+        scheduler_lag.set(lag_seconds)
+        scheduler_queue_depth.set(queue_depth)
+        print(
+            f"scheduler: backlog={alerts_to_scrape.total_items} lag={lag_seconds:.0f}s "
+            f"queue_depth={queue_depth} in_flight={in_flight} "
+            f"average_scrape={average_scrape_seconds:.1f}s capacity={capacity} "
+            f"scrape_demand={scrape_demand * 3600:.0f}/h capacity_load={capacity_load:.2f}"
+        )
 
-        for alert in alerts_to_scrape:
-            user_id = (
-                get_client()
-                .collection("chats")
-                .get_list(1, 1, query_params={"filter": f'id = "{alert.created_by}"'})
-                .items[0]
-                .user_id
-            )
+        if capacity == 0:
+            return
+
+        user_ids = repository.get_chat_user_ids(alerts_to_scrape.items)
+
+        jobs = []
+        for alert in alerts_to_scrape.items:
+            user_id = user_ids.get(alert.created_by)
             if user_id is None:
                 continue
 
-            print("scrape_carousell_with_params.delay")
-            if alert.url is not None and alert.url != "":
-                scrape_carousell_with_params.delay(
-                    alert.id,
-                    user_id,
-                    initial_url=alert.url,
-                    is_first_time=alert.is_first_scrape,
-                )
-            else:
-                scrape_carousell_with_params.delay(
-                    alert.id,
-                    user_id,
-                    query=alert.query,
-                    from_range=alert.from_price,
-                    to_range=alert.to_price,
-                    is_first_time=alert.is_first_scrape,
-                )
+            jobs.append(get_alert_job(alert, user_id, capacity_load))
+
+        dispatch_scrape_jobs(jobs, max_scrapes=capacity)
     except pbutils.ClientResponseError as error:
         print(error.data)
     except Exception as error:
         print(error)
 
 
+def get_cached_scrape_demand():
+    """Get the scrapes a second the active alerts ask for, summed again from the
+    db every CAPACITY_LOAD_REFRESH_SECONDS as it pages through every alert.
+
+    Returns:
+        float: Scrapes a second.
+    """
+    scrape_demand = scrape_demand_cache.get("scrape_demand")
+    if scrape_demand is None:
+        scrape_demand = get_scrape_demand(
+            [get_known_listing_rate(alert) for alert in repository.get_active_alert_rates()]
+        )
+        scrape_demand_cache.set("scrape_demand", scrape_demand)
+    return scrape_demand
+
+
+def get_queue_depth():
+    """Get how many tasks are waiting in the default queue of the broker.
+
+    Returns:
+        int: Tasks waiting, 0 when the broker can not tell.
+    """
+    try:
+        with celery.connection_for_read() as connection:
+            return connection.default_channel.queue_declare(
+                queue=celery.conf.task_default_queue, passive=True
+            ).message_count
+    except Exception as error:
+        print(f"Could not get queue depth... {error}")
+        return 0
+
+
+@celery.task()
+def reap_alert_leases():
+    """Called by celery beat to give back alerts whose lease expired, e.g. when
+    their worker died mid scrape.
+    """
+    try:
+        print(f"{reap_expired_leases(get_client())} expired alert leases reaped...")
+    except pbutils.ClientResponseError as error:
+        print(error.data)
+
+
+@celery.task(bind=True, acks_late=True, max_retries=3, default_retry_delay=30)
+def send_alert_notifications(
+    self,
+    chat_id: str,
+    alert_id: str,
+    notifications: list,
+    query=None,
+    from_range=None,
+    to_range=None,
+    initial_url=None,
+    enqueued_at=None,
+):
+    """Send the new listings of an alert to its chat, on the notification queue.
+    Notifications which were already sent are skipped, so it is safe to retry.
+
+    Args:
+        chat_id (str): Telegram user id of the chat of the alert.
+        alert_id (str): alert id as per db in alerts.
+        notifications (list): Messages with their idempotency key.
+        query (str, optional): Search query of the alert. Defaults to None.
+        from_range (float, optional): Minimum price. Defaults to None.
+        to_range (float, optional): Maximum price. Defaults to None.
+        initial_url (str, optional): Url pasted by the user. Defaults to None.
+        enqueued_at (float, optional): Epoch seconds the scrape queued them at.
+        Defaults to None.
+    """
+    started_at = time.monotonic()
+    sent_keys = repository.find_sent_notification_keys(
+        [notification["key"] for notification in notifications]
+    )
+    pending = [
+        notification
+        for notification in notifications
+        if notification["key"] not in sent_keys
+    ]
+    if len(pending) < len(notifications):
+        print(
+            f"skipping {len(notifications) - len(pending)} notifications already sent"
+            f"... [{alert_id}]"
+        )
+    if len(pending) == 0:
+        return
+
+    stats = send_messages(
+        chat_id,
+        [notification["text"] for notification in pending],
+        query=query,
+        from_range=from_range,
+        to_range=to_range,
+        initial_url=initial_url,
+    ).result()
+
+    results = stats.pop("results")
+    for notification, result in zip(pending, results):
+        if result != FAILED:
+            repository.save_sent_notification(alert_id, notification["key"])
+
+    observe_delivery(enqueued_at or time.time(), started_at, stats["sent"])
+    print(f"notifications delivered... {stats} [{alert_id}]")
+    print(delivery_latency.summary_line())
+
+    # Only failures which may pass are retried, rejected messages are kept as
+    # sent so they are not tried again.
+    if FAILED in results:
+        raise self.retry()
+
+
+def queue_digest_notifications(job: dict, notifications: list):
+    """Buffer the messages of an alert in the digest of its chat. The digest is
+    flushed after the window, or right away once enough messages are waiting.
+
+    Args:
+        job (dict): Arguments of scrape_carousell_with_params of the alert.
+        notifications (list): Messages with their idempotency key.
+    """
+    chat_id = job["chat_id"]
+    footer = get_alert_footer(
+        job["query"], job["from_range"], job["to_range"], job["initial_url"]
+    )
+    num_of_pending = repository.count_pending_digest_entries(chat_id)
+    for notification in notifications:
+        try:
+            repository.create_digest_entry(
+                chat_id,
+                job["alert_id"],
+                notification["key"],
+                notification["text"],
+                footer,
+            )
+        except pbutils.ClientResponseError as error:
+            print(f"Could not buffer notification {notification['key']}... {error.data}")
+
+    if num_of_pending + len(notifications) >= get_digest_max_messages():
+        flush_chat_digest.delay(chat_id)
+    elif num_of_pending == 0:
+        flush_chat_digest.apply_async((chat_id,), countdown=get_digest_window_seconds())
+
+
+@celery.task(bind=True, acks_late=True, max_retries=3, default_retry_delay=30)
+def flush_chat_digest(self, chat_id: str):
+    """Send the buffered messages of a chat, packed together, on the notification
+    queue. Messages which were already sent are dropped, so it is safe to retry.
+    Messages buffered during the flush get a flush of their own.
+
+    Args:
+        chat_id (str): Telegram user id of the chat.
+    """
+    started_at = time.monotonic()
+    entries = repository.claim_digest_entries(chat_id, uuid.uuid4().hex)
+    if len(entries) == 0:
+        return
+
+    sent_keys = repository.find_sent_notification_keys([entry.key for entry in entries])
+    for entry in entries:
+        if entry.key in sent_keys:
+            repository.delete_digest_entry(entry.id)
+    entries = [entry for entry in entries if entry.key not in sent_keys]
+    if len(entries) == 0:
+        schedule_remaining_digest(chat_id)
+        return
+
+    messages = pack_digest(
+        [
+            {
+                "key": entry.key,
+                "alert_id": entry.alert_id,
+                "text": entry.text,
+                "footer": entry.footer,
+            }
+            for entry in entries
+        ]
+    )
+    stats = (
+        get_telegram_sender()
+        .submit(chat_id, [text for text, _ in messages])
+        .result()
+    )
+
+    entries_by_key = {entry.key: entry for entry in entries}
+    results = stats.pop("results")
+    for (_, keys), result in zip(messages, results):
+        for key in keys:
+            entry = entries_by_key[key]
+            if result == FAILED:
+                repository.release_digest_entry(entry.id)
+            else:
+                repository.save_sent_notification(entry.alert_id, key)
+                repository.delete_digest_entry(entry.id)
+
+    observe_delivery(
+        min(parse_created(entry.created) for entry in entries),
+        started_at,
+        stats["sent"],
+    )
+    print(
+        f"digest of {len(entries)} notifications flushed in {len(messages)} messages"
+        f"... {stats} [{chat_id}]"
+    )
+    print(delivery_latency.summary_line())
+
+    if FAILED in results and self.request.retries < self.max_retries:
+        raise self.retry()
+    # Once out of retries the failed messages are left unclaimed, and the flush
+    # scheduled for them keeps the next messages of the chat from being stuck.
+    schedule_remaining_digest(chat_id)
+
+
+def schedule_remaining_digest(chat_id: str):
+    """Schedule another flush when messages of a chat are still waiting, like
+    those buffered after a flush claimed its own or those a flush gave up on.
+
+    Args:
+        chat_id (str): Telegram user id of the chat.
+    """
+    if repository.count_pending_digest_entries(chat_id) > 0:
+        flush_chat_digest.apply_async((chat_id,), countdown=get_digest_window_seconds())
+
+
+@celery.task()
+def reconcile_alert_quotas():
+    """Called by celery beat to fix alert quotas of chats which drifted."""
+    try:
+        print(f"{repository.reconcile_alert_quotas()} alert quotas reconciled...")
+    except pbutils.ClientResponseError as error:
+        print(error.data)
+
+
 def scrape_page(
     soup: BeautifulSoup, alert_id: str, hostname: str = "https://www.carousell.sg"
 ):
@@ -243,67 +999,13 @@ def scrape_page(
     Args:
         soup (BeautifulSoup): Used to scape elements in page, page should be loaded.
         alert_id (str): alert id as per db in alerts.
+        hostname (str, optional): Hostname of the page, decides the currency.
 
     Returns:
         _type_: items found.
     """
     print("scrape_page")
-
-    # Need to change when the classname changes.soup
-    item_listings = soup.find_all("div", {"data-testid": re.compile("listing-card-")})
-
-    items_found = []
-    for item_listing in item_listings:
-        # if any error with any item, skip to the next item.
-        try:
-            # seller
-            seller = item_listing.find(
-                "p", {"data-testid": "listing-card-text-seller-name"}
-            ).getText()
-
-            # price
-            price_result = item_listing.find(
-                "p",
-                {
-                    "title": re.compile(
-                        CURRENCY_MAP[hostname.split(".")[len(hostname.split(".")) - 1]]
-                    )
-                },
-            )
-            price = price_result.getText() if price_result else "0"
-
-            # name
-            name = item_listing.find("p", {"style": re.compile("--max-line")}).getText()
-
-            item_id = item_listing["data-testid"].split("-")[2]
-            urlify_name = name
-            urlify_name = re.sub(r"[^\w\s]", "", urlify_name)
-            urlify_name = re.sub(r"\s+", "-", urlify_name)
-            if urlify_name[0] == "-":
-                urlify_name = urlify_name[1:]
-            if urlify_name[-1] == "-":
-                urlify_name = urlify_name[:-1]
-            item_url = f"{hostname}/p/{urlify_name}-{item_id}"
-            clean_price = price.replace("$", "").replace(",", "")
-            clean_price = re.sub(r"[a-zA-Z]", r"", clean_price).strip()
-
-            items_found.append(
-                {
-                    "listing_id": item_id,
-                    "detail_url": item_url,
-                    "image_url": item_listing.find_all("img")[0].get("src"),
-                    "name": name,
-                    "price": float(clean_price),
-                    "seller": seller,
-                    "date_found": date.today().isoformat(),
-                    "alert_id": alert_id,
-                }
-            )
-        except Exception as error:
-            print(f"Error with item: {error}")
-            continue
-
-    return items_found
+    return extract_listings_from_soup(soup, alert_id, hostname)
 
 
 def set_up_scape_url(query: str, from_range: float, to_range: float):
@@ -344,7 +1046,7 @@ def set_up_initial_url_better(initial_url: str):
 
     filters = []
     if "sort_by" not in initial_url:
-        filters.append("sort_by=3")
+        filters.append(f"sort_by={NEWEST_SORT_BY}")
     if "tab" not in initial_url:
         filters.append("tab=marketplace")
 
@@ -358,7 +1060,20 @@ def set_up_initial_url_better(initial_url: str):
     return url
 
 
-async def send_messages(
+def is_sorted_by_newest(url: str):
+    """Check if the search of a url lists the newest listings first, which the
+    high water mark relies on.
+
+    Args:
+        url (str): Url scraped.
+
+    Returns:
+        bool: True when sorted by recent.
+    """
+    return parse_qs(urlparse(url).query).get("sort_by") == [NEWEST_SORT_BY]
+
+
+def send_messages(
     chat_id: str,
     messages: list,
     query=None,
@@ -374,90 +1089,75 @@ async def send_messages(
         query (str): What is the query used to search.
         from_range (str): What is the minimum price used to search.
         to_range (str): What is the maximum price used to search.
+
+    Returns:
+        Future: Resolves with the stats of the delivery once every message is sent.
     """
     print("send messages...", initial_url)
-    try:
-        bot = Bot(token=os.getenv("TELEGRAM_TOKEN"))
-        await bot.initialize()
+    footer = get_alert_footer(query, from_range, to_range, initial_url)
+    texts = [message + footer + FEEDBACK_FOOTER for message in messages]
 
-        for message in messages:
-            message += "----- ----- -----\n"
-            if initial_url is not None:
-                message += f"Initial URL: {initial_url}\n"
-            else:
-                message += f'Query: {query}\n\
-Minimum Price: {"-" if from_range== 0 else ("$" + str(from_range))}\n\
-Maximum Price: {"-" if to_range== 0 else ("$" + str(to_range))}\n'
-
-            message += "----- ----- -----\n"
-            message += "We are constantly improving! \n\
-Contact me@buildersjam.com for feedback and enquires! 💯💯\n\n"
-            await bot.send_message(
-                chat_id, message, parse_mode="html", disable_web_page_preview=True
-            )
-
-    finally:
-        await bot.shutdown()
+    return get_telegram_sender().submit(chat_id, texts)
 
 
 def create_listing_to_db(
-    items: list, alert_id: str, hostname: str = "https://www.carousell.sg"
+    items: list,
+    alert_id: str,
+    hostname: str = "https://www.carousell.sg",
+    expire_at: str = None,
 ):
     """Create listings found to the db.
 
     Args:
         items (list): List of items to be created.
         alert_id (str): alert id as per db in alerts.
+        hostname (str, optional): Hostname of the page, decides the currency.
+        expire_at (str, optional): When the alert expires, kept with its seen
+        listings index. Defaults to None.
 
     Returns:
-        List: Number of items that are actually created after filtering and messages
-        to be sent.
+        List: Number of items that are actually created after filtering, messages
+        to be sent and the listing ids in each message.
     """
     num_of_items_created = 0
     messages = [""]
-    message_index = 0
+    message_listing_ids = [[]]
     print(f"looking through {str(len(items))} items...")
 
     if len(items) == 0:
-        return num_of_items_created, messages
+        return num_of_items_created, messages, message_listing_ids
 
-    filter_string = " || ".join(
-        [f'listing_id="{item["listing_id"]}"' for item in items]
+    seen_index = SeenIndex.load(alert_id, expire_at=expire_at)
+    new_items, stats = bulk_create_listings(
+        get_client(), items, alert_id, seen_index=seen_index
     )
-    filter_string += f' && alert_id="{alert_id}"'
-
-    all_listing = (
-        get_client()
-        .collection("listings")
-        .get_list(
-            1,
-            len(items),
-            query_params={"filter": filter_string},
-        )
-    )
-
-    existing_listing_ids = {listing.listing_id for listing in all_listing.items}
-    new_items = [
-        item for item in items if item["listing_id"] not in existing_listing_ids
-    ]
-
-    print("making new items...", len(new_items))
+    seen_index.save()
+    print(f"listings stats... {stats}")
+    for stage, seconds in (
+        ("db_dedupe", stats["lookup_seconds"]),
+        ("db_insert", stats["insert_seconds"]),
+    ):
+        get_histogram(SCRAPE_STAGE_SECONDS, STAGE_BUCKETS, stage=stage).observe(seconds)
+    listings_created.inc(stats["created"])
+
+    blocks = []
     for item in new_items:
         num_of_items_created += 1
 
-        if num_of_items_created % 8 == 0:
-            messages.append("")
-            message_index += 1
-
-        messages[
-            message_index
-        ] += f'<b>{item["name"]}</b>\nPrice: <b>{CURRENCY_MAP[hostname.split(".")[len(hostname.split(".")) - 1]]}\
+        blocks.append(
+            (
+                item["listing_id"],
+                f'<b>{item["name"]}</b>\nPrice: <b>{CURRENCY_MAP[hostname.split(".")[len(hostname.split(".")) - 1]]}\
 {item["price"]}\
-            </b>\nSeller:{item["seller"]}\nVisit Here: {item["detail_url"]}\n\n\n'
+            </b>\nSeller:{item["seller"]}\nVisit Here: {item["detail_url"]}\n\n\n',
+            )
+        )
 
-        get_client().collection("listings").create(item)
+    # As many listings as fit in a message, instead of a fixed number.
+    if len(blocks) > 0:
+        messages, message_listing_ids = pack_blocks(blocks)
 
-    return num_of_items_created, messages
+    return num_of_items_created, messages, message_listing_ids
 
 
 def set_up_driver_option(user_agent: str):
@@ -479,40 +1179,160 @@ def set_up_driver_option(user_agent: str):
     options.add_argument("--remote-debugging-port=9222")
     options.add_argument(f"user-agent={user_agent}")
     # options.add_argument("--remote-debugging-port=9222")
+    if is_lean_profile_enabled():
+        apply_lean_options(options)
     driver = webdriver.Remote(os.getenv("SELENIUM_URL"), options=options)
+    if is_lean_profile_enabled():
+        block_resources(driver)
 
     return driver
 
 
-def continuous_press_load_more_button(driver: webdriver, sleep_time=2.5):
+def continuous_press_load_more_button(
+    driver: webdriver,
+    timeout=None,
+    high_water_listing_id=None,
+    max_items=None,
+    max_seconds=None,
+):
     """
     Ask driver to continuously press load more button until there is no more items to
-    load.
+    load. After each press it waits for more cards to show up instead of sleeping a
+    fixed time, and it stops once enough cards are loaded or time is up.
 
     Args:
         driver (webdriver): Webdriver from selenium.
-        sleep_time (float, optional): Time to sleep for more button to load. Defaults
-        to 2.5.
+        timeout (float, optional): Time to wait for more cards after a press.
+        Defaults to LOAD_MORE_TIMEOUT_SECONDS or 10.
+        high_water_listing_id (str, optional): Newest listing id of the last run, stop
+        loading more once the last card loaded is older. Defaults to None.
+        max_items (int, optional): Stop once this many cards are loaded. Defaults to
+        LOAD_MORE_MAX_ITEMS or 400.
+        max_seconds (float, optional): Stop after this long. Defaults to
+        LOAD_MORE_MAX_SECONDS or 120.
+
+    Returns:
+        dict: Pages loaded, new cards of each page, seconds taken and why it stopped.
     """
+    timeout = timeout or float(os.getenv("LOAD_MORE_TIMEOUT_SECONDS", "10"))
+    max_items = max_items or int(os.getenv("LOAD_MORE_MAX_ITEMS", "400"))
+    max_seconds = max_seconds or float(os.getenv("LOAD_MORE_MAX_SECONDS", "120"))
+
+    started_at = time.monotonic()
+    stats = {"pages": 0, "items_per_page": [], "seconds": 0, "stop_reason": None}
+    num_of_cards = get_card_count(driver)
+
+    while stats["stop_reason"] is None:
+        more_buttons = driver.find_elements("xpath", LOAD_MORE_XPATH)
+        if len(more_buttons) == 0:
+            stats["stop_reason"] = "no_more_button"
+        elif high_water_listing_id is not None and is_older_listing(
+            get_last_card_listing_id(driver), high_water_listing_id
+        ):
+            print("reached listings found by the last run...")
+            stats["stop_reason"] = "high_water_mark"
+        elif num_of_cards >= max_items:
+            stats["stop_reason"] = "max_items"
+        elif time.monotonic() - started_at >= max_seconds:
+            stats["stop_reason"] = "max_seconds"
+        else:
+            try:
+                print("loading more...")
+                more_buttons[0].click()
+                time_left = max_seconds - (time.monotonic() - started_at)
+                num_of_new_cards = wait_for_more_cards(
+                    driver, num_of_cards, min(timeout, max(time_left, 0.5))
+                )
+                num_of_cards += num_of_new_cards
+                stats["pages"] += 1
+                stats["items_per_page"].append(num_of_new_cards)
+            except TimeoutException:
+                if time.monotonic() - started_at >= max_seconds:
+                    stats["stop_reason"] = "max_seconds"
+                else:
+                    stats["stop_reason"] = "no_new_cards"
+            except WebDriverException as error:
+                print(f"Could not load more... {error}")
+                stats["stop_reason"] = "error"
+
+    stats["seconds"] = round(time.monotonic() - started_at, 3)
+    print("loading done...")
+    return stats
+
 
+def wait_for_cards(driver: webdriver, timeout=None):
+    """Wait until listing cards are on the page, as the page is handed over before
+    it is done loading. Stops waiting once the page says there are no results.
+
+    Args:
+        driver (webdriver): Webdriver from selenium.
+        timeout (float, optional): Seconds to wait. Defaults to CARD_WAIT_SECONDS
+        or 10.
+
+    Returns:
+        int: Number of cards, 0 when there are no results or none showed up in
+        time.
+    """
+    timeout = timeout or float(os.getenv("CARD_WAIT_SECONDS", "10"))
     try:
-        more_button = driver.find_element(
-            "xpath", "//button[contains(text(), 'Show more results')]"
+        num_of_cards = WebDriverWait(driver, timeout, poll_frequency=0.25).until(
+            lambda driver: get_card_count(driver)
+            or (len(driver.find_elements("xpath", NO_RESULTS_XPATH)) > 0 and -1)
         )
-    except:  # noqa: E722
-        more_button = None
+    except TimeoutException:
+        print("No listing cards showed up...")
+        return 0
 
-    while more_button is not None:
-        try:
-            print("loading more...")
-            more_button.click()
+    if num_of_cards < 0:
+        print("No results for the search...")
+        return 0
+    return num_of_cards
 
-            time.sleep(sleep_time)
 
-            more_button = driver.find_element(
-                "xpath", "//button[contains(text(), 'Show more results')]"
-            )
-        except:  # noqa: E722
-            more_button = None
+def wait_for_more_cards(driver: webdriver, num_of_cards: int, timeout: float):
+    """Wait until more cards than before are loaded on the page.
 
-    print("loading done...")
+    Args:
+        driver (webdriver): Webdriver from selenium.
+        num_of_cards (int): Cards loaded before.
+        timeout (float): Seconds to wait.
+
+    Raises:
+        TimeoutException: When no more cards are loaded in time.
+
+    Returns:
+        int: Number of new cards.
+    """
+    return WebDriverWait(driver, timeout, poll_frequency=0.25).until(
+        lambda driver: max(get_card_count(driver) - num_of_cards, 0)
+    )
+
+
+def get_card_count(driver: webdriver):
+    """Get how many listing cards are loaded on the page.
+
+    Args:
+        driver (webdriver): Webdriver from selenium.
+
+    Returns:
+        int: Number of cards.
+    """
+    return driver.execute_script(
+        f"return document.querySelectorAll('{CARD_CSS}').length;"
+    )
+
+
+def get_last_card_listing_id(driver: webdriver):
+    """Get the listing id of the last listing card loaded on the page.
+
+    Args:
+        driver (webdriver): Webdriver from selenium.
+
+    Returns:
+        str: Listing id, None when there is no card.
+    """
+    testid = driver.execute_script(
+        f"""const cards = document.querySelectorAll('{CARD_CSS}');
+        return cards.length ? cards[cards.length - 1].getAttribute("data-testid") : null;"""
+    )
+    return get_card_listing_id(testid) if testid is not None else None
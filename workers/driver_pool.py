@@ -0,0 +1,169 @@
+"""Pool of warm selenium sessions reused across tasks of a worker process."""
+
+import os
+import time
+import random
+import threading
+from collections import deque
+
+from constants import USER_AGENTS
+
+
+class DriverPool:
+    """Hand out warm webdriver sessions instead of opening one per task.
+
+    Sessions are reset (cookies and storage) between tasks, and recycled after
+    `max_uses` tasks, after an error, or when they sat idle long enough for the
+    selenium grid to have timed them out.
+    """
+
+    def __init__(self, factory, max_size=1, max_uses=20, max_idle_seconds=240):
+        """Init pool.
+
+        Args:
+            factory (callable): Called with a user agent, returns a new WebDriver.
+            max_size (int, optional): Max idle sessions kept. Defaults to 1.
+            max_uses (int, optional): Tasks served before a session is recycled.
+            Defaults to 20.
+            max_idle_seconds (float, optional): Idle sessions older than this are
+            recycled. Should be below SE_NODE_SESSION_TIMEOUT. Defaults to 240.
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self.max_uses = max_uses
+        self.max_idle_seconds = max_idle_seconds
+
+        self._idle = deque()
+        self._uses = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "recycled": 0, "reset_failed": 0}
+
+    def acquire(self):
+        """Get a warm session from the pool, or open a new one.
+
+        Returns:
+            WebDriver: Driver to be used to scrape.
+        """
+        while True:
+            with self._lock:
+                if len(self._idle) == 0:
+                    break
+                driver, released_at = self._idle.popleft()
+
+            if time.monotonic() - released_at > self.max_idle_seconds:
+                self._quit(driver)
+                continue
+
+            if not self._is_alive(driver):
+                self._quit(driver)
+                continue
+
+            with self._lock:
+                self.stats["hits"] += 1
+            return driver
+
+        with self._lock:
+            self.stats["misses"] += 1
+        driver = self.factory(random.choice(USER_AGENTS))
+        self._uses[id(driver)] = 0
+        return driver
+
+    def release(self, driver, discard=False):
+        """Return a session to the pool once the task is done with it.
+
+        Args:
+            driver (WebDriver): Driver previously returned by `acquire`.
+            discard (bool, optional): Quit the session instead of keeping it,
+            e.g. when the task failed. Defaults to False.
+        """
+        uses = self._uses.get(id(driver), 0) + 1
+        self._uses[id(driver)] = uses
+
+        if discard or uses >= self.max_uses:
+            self._quit(driver)
+            return
+
+        if not self._reset(driver):
+            with self._lock:
+                self.stats["reset_failed"] += 1
+            self._quit(driver)
+            return
+
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((driver, time.monotonic()))
+                return
+
+        self._quit(driver)
+
+    def close(self):
+        """Quit every idle session, called when the worker process shuts down."""
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+
+        for driver, _ in idle:
+            self._quit(driver)
+
+    def stats_line(self):
+        """Stats of the pool formatted for the logs.
+
+        Returns:
+            str: hits, misses and recycled sessions so far.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            idle = len(self._idle)
+        total = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / total if total > 0 else 0
+        return (
+            f"driver pool: {stats['hits']} hits, {stats['misses']} misses "
+            f"({hit_rate:.0%} hit rate), {stats['recycled']} recycled, "
+            f"{stats['reset_failed']} failed resets, {idle} idle"
+        )
+
+    def _reset(self, driver):
+        try:
+            driver.delete_all_cookies()
+            driver.execute_script(
+                "try { window.localStorage.clear(); window.sessionStorage.clear(); }"
+                " catch (e) {}"
+            )
+            driver.get("about:blank")
+            return True
+        except Exception as error:
+            print(f"Could not reset driver... {error}")
+            return False
+
+    def _is_alive(self, driver):
+        try:
+            driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def _quit(self, driver):
+        self._uses.pop(id(driver), None)
+        with self._lock:
+            self.stats["recycled"] += 1
+        try:
+            driver.quit()
+        except Exception as error:
+            print(f"Could not quit driver... {error}")
+
+
+def init_driver_pool(factory):
+    """Init the pool of the current worker process from env.
+
+    Args:
+        factory (callable): Called with a user agent, returns a new WebDriver.
+
+    Returns:
+        DriverPool: Pool of selenium sessions.
+    """
+    return DriverPool(
+        factory,
+        max_size=int(os.getenv("DRIVER_POOL_SIZE", "1")),
+        max_uses=int(os.getenv("DRIVER_POOL_MAX_USES", "20")),
+        max_idle_seconds=float(os.getenv("DRIVER_POOL_MAX_IDLE_SECONDS", "240")),
+    )
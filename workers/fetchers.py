@@ -0,0 +1,75 @@
+"""Fetch backends used to load a search page before scrapping it."""
+
+import os
+import random
+
+import httpx
+
+from constants import USER_AGENTS
+
+HTTP_BACKEND = "http"
+SELENIUM_BACKEND = "selenium"
+
+http_client = None
+
+
+def get_http_client():
+    """Get the http client of this worker process, kept alive between tasks.
+
+    Returns:
+        httpx.Client: Client used by the http backend.
+    """
+    global http_client
+    if http_client is None:
+        http_client = httpx.Client(
+            follow_redirects=True,
+            timeout=float(os.getenv("HTTP_FETCH_TIMEOUT_SECONDS", "15")),
+        )
+    return http_client
+
+
+def choose_fetch_backend(recorded_backend: str = None, is_first_time=False):
+    """Choose which backend an alert run should try first.
+
+    Alerts which needed the browser last time stay on selenium, but are given a
+    chance to go back to plain http every now and then.
+
+    Args:
+        recorded_backend (str, optional): Backend recorded on the alert by its last
+        run. Defaults to None.
+        is_first_time (bool, optional): Is this the first time the alert runs, these
+        need the browser to press the load more button. Defaults to False.
+
+    Returns:
+        str: HTTP_BACKEND or SELENIUM_BACKEND.
+    """
+    if is_first_time or os.getenv("HTTP_FETCH_ENABLED", "true") != "true":
+        return SELENIUM_BACKEND
+
+    if recorded_backend == SELENIUM_BACKEND:
+        reprobe_rate = float(os.getenv("HTTP_FETCH_REPROBE_RATE", "0.1"))
+        if random.random() >= reprobe_rate:
+            return SELENIUM_BACKEND
+
+    return HTTP_BACKEND
+
+
+def fetch_page_with_http(url: str):
+    """Fetch the server rendered search page without a browser.
+
+    Args:
+        url (str): Url to be scraped.
+
+    Returns:
+        str: Html of the page.
+    """
+    response = get_http_client().get(
+        url,
+        headers={
+            "User-Agent": random.choice(USER_AGENTS),
+            "Accept": "text/html,application/xhtml+xml",
+            "Accept-Language": "en-US,en;q=0.9",
+        },
+    )
+    response.raise_for_status()
+    return response.text
@@ -0,0 +1,159 @@
+"""Leases on alerts, so that an alert is only queued and scraped once at a time.
+
+PocketBase has no conditional update, so a claim checks no one else holds the
+lease, writes it and reads it back. That only catches claims which land in
+order: when two claims write before either reads back, both win. Alerts are
+only dispatched by the scrape_ready_alerts task, so this takes two of its runs
+at once, e.g. a manual run during a tick. Renewals and releases check the
+owner before writing, and the reaper the expiry, with the same window.
+
+Leases expire, and expired ones are reclaimed by the reaper so that alerts of a
+crashed worker are scraped again.
+"""
+
+import os
+import uuid
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+
+from pocketbase import PocketBase
+
+from repository import filter_any, quote_filter_value
+from workers.scheduler import parse_db_datetime
+
+QUEUED_STATUS = "queued"
+ONGOING_STATUS = "ongoing"
+READY_STATUS = "ready_to_search"
+
+
+def get_lease_expiry():
+    """Get when a lease taken or renewed now expires.
+
+    Returns:
+        datetime: Expiry of the lease.
+    """
+    seconds = int(os.getenv("ALERT_LEASE_SECONDS", "600"))
+    return datetime.today() + relativedelta(seconds=seconds)
+
+
+def claim_alert(client: PocketBase, alert_id: str):
+    """Lease an alert before it is queued.
+
+    Args:
+        client (PocketBase): PocketBase client.
+        alert_id (str): alert id as per db in alerts.
+
+    Returns:
+        str: Lease owner, None when another scheduler claimed it.
+    """
+    alert = client.collection("alerts").get_one(alert_id)
+    lease_expires_at = parse_db_datetime(getattr(alert, "lease_expires_at", ""))
+    if (
+        getattr(alert, "lease_owner", "")
+        and lease_expires_at is not None
+        and lease_expires_at > datetime.today()
+    ):
+        return None
+
+    lease_owner = uuid.uuid4().hex
+    client.collection("alerts").update(
+        alert_id,
+        {
+            "status": QUEUED_STATUS,
+            "lease_owner": lease_owner,
+            "lease_expires_at": get_lease_expiry().isoformat(),
+        },
+    )
+
+    if client.collection("alerts").get_one(alert_id).lease_owner != lease_owner:
+        return None
+
+    return lease_owner
+
+
+def renew_lease(client: PocketBase, alert_id: str, lease_owner: str, status=None):
+    """Extend the lease of an alert if it is still owned.
+
+    Args:
+        client (PocketBase): PocketBase client.
+        alert_id (str): alert id as per db in alerts.
+        lease_owner (str): Owner the lease was claimed with.
+        status (str, optional): Status to set. Defaults to None, unchanged.
+
+    Returns:
+        bool: False when the lease was reclaimed by someone else.
+    """
+    if client.collection("alerts").get_one(alert_id).lease_owner != lease_owner:
+        return False
+
+    body = {"lease_expires_at": get_lease_expiry().isoformat()}
+    if status is not None:
+        body["status"] = status
+    client.collection("alerts").update(alert_id, body)
+    return True
+
+
+def release_lease(client: PocketBase, alert_id: str, lease_owner: str, body=None):
+    """Give the alert back to the scheduler if the lease is still owned.
+
+    Args:
+        client (PocketBase): PocketBase client.
+        alert_id (str): alert id as per db in alerts.
+        lease_owner (str): Owner the lease was claimed with.
+        body (dict, optional): Other fields to update with it. Defaults to None.
+
+    Returns:
+        bool: False when the lease was reclaimed by someone else.
+    """
+    if client.collection("alerts").get_one(alert_id).lease_owner != lease_owner:
+        return False
+
+    client.collection("alerts").update(
+        alert_id,
+        {
+            **(body or {}),
+            "status": READY_STATUS,
+            "lease_owner": "",
+            "lease_expires_at": "",
+        },
+    )
+    return True
+
+
+def reap_expired_leases(client: PocketBase):
+    """Give back alerts whose lease expired, e.g. when their worker died.
+
+    Args:
+        client (PocketBase): PocketBase client.
+
+    Returns:
+        int: Number of alerts given back.
+    """
+    alerts = client.collection("alerts").get_full_list(
+        query_params={
+            "filter": f"{filter_any('status', [QUEUED_STATUS, ONGOING_STATUS])} && "
+            f"lease_expires_at < {quote_filter_value(datetime.today())}"
+        }
+    )
+
+    num_of_reaped = 0
+    for alert in alerts:
+        # The lease may have been renewed or released since the list was read.
+        alert = client.collection("alerts").get_one(alert.id)
+        lease_expires_at = parse_db_datetime(getattr(alert, "lease_expires_at", ""))
+        if alert.status not in (QUEUED_STATUS, ONGOING_STATUS) or (
+            lease_expires_at is not None and lease_expires_at > datetime.today()
+        ):
+            continue
+
+        client.collection("alerts").update(
+            alert.id,
+            {
+                "status": READY_STATUS,
+                "lease_owner": "",
+                "lease_expires_at": "",
+            },
+        )
+        num_of_reaped += 1
+
+    return num_of_reaped
@@ -0,0 +1,449 @@
+"""Extract listings from a carousell search page in a single pass over each card."""
+
+import os
+import re
+from datetime import date
+from functools import lru_cache
+
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+
+from constants import CURRENCY_MAP
+from metrics import Counter
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    HTMLParser = None
+
+try:
+    import lxml  # noqa: F401
+
+    BS4_PARSER = "lxml"
+except ImportError:
+    BS4_PARSER = "html.parser"
+
+SELECTOLAX_BACKEND = "selectolax"
+BS4_BACKEND = "bs4"
+
+# Need to change when the classname changes.
+CARD_TESTID_PATTERN = re.compile("listing-card-")
+CARD_CSS = 'div[data-testid*="listing-card-"]'
+SELLER_TESTID = "listing-card-text-seller-name"
+NAME_STYLE_PATTERN = re.compile("--max-line")
+NON_WORD_PATTERN = re.compile(r"[^\w\s]")
+SPACES_PATTERN = re.compile(r"\s+")
+LETTERS_PATTERN = re.compile(r"[a-zA-Z]")
+
+items_skipped = Counter("scrape_items_skipped_total")
+
+# Collects the fields extract_listings reads from each card, the same way, so only
+# these are sent back by the browser instead of the whole page.
+CARD_FIELDS_SCRIPT = """
+const [cardCss, sellerTestid, currencySource, nameStyleSource] = arguments;
+const currencyPattern = new RegExp(currencySource);
+const nameStylePattern = new RegExp(nameStyleSource);
+return Array.from(document.querySelectorAll(cardCss), (card) => {
+  let seller = null, price = null, name = null, image = null;
+  for (const node of card.querySelectorAll("img, p")) {
+    if (node.tagName === "IMG") {
+      if (image === null) image = node;
+      continue;
+    }
+    const title = node.getAttribute("title");
+    const style = node.getAttribute("style");
+    if (seller === null && node.getAttribute("data-testid") === sellerTestid) {
+      seller = node;
+    }
+    if (price === null && title && currencyPattern.test(title)) price = node;
+    if (name === null && style && nameStylePattern.test(style)) name = node;
+  }
+  return [
+    card.getAttribute("data-testid"),
+    name && name.textContent,
+    price && price.textContent,
+    seller && seller.textContent,
+    image !== null,
+    image && image.getAttribute("src"),
+  ];
+});
+"""
+
+
+@lru_cache(maxsize=None)
+def get_currency_pattern(hostname: str):
+    """Compile the price selector of a hostname once.
+
+    Args:
+        hostname (str): Hostname of the page, e.g. www.carousell.sg.
+
+    Returns:
+        re.Pattern: Matches the title of the price element.
+    """
+    return re.compile(CURRENCY_MAP[hostname.split(".")[-1]])
+
+
+def get_default_backend():
+    """Get the fastest backend installed, can be forced with LISTING_PARSER.
+
+    Returns:
+        str: SELECTOLAX_BACKEND or BS4_BACKEND.
+    """
+    backend = os.getenv("LISTING_PARSER")
+    if backend is not None:
+        return backend
+
+    return SELECTOLAX_BACKEND if HTMLParser is not None else BS4_BACKEND
+
+
+def get_card_listing_id(testid: str):
+    """Get the listing id out of the data-testid of a listing card.
+
+    Args:
+        testid (str): data-testid of the card, e.g. listing-card-1234.
+
+    Returns:
+        str: Listing id, None when there is none.
+    """
+    parts = testid.split("-")
+    return parts[2] if len(parts) > 2 else None
+
+
+def is_older_listing(listing_id: str, high_water_listing_id: str):
+    """Check if a listing was posted before the newest listing of the last run.
+
+    Listing ids are increasing, so anything at or below the high water mark is old.
+
+    Args:
+        listing_id (str): Listing id.
+        high_water_listing_id (str): Newest listing id of the last run.
+
+    Returns:
+        bool: True if the listing is old.
+    """
+    try:
+        return int(listing_id) <= int(high_water_listing_id)
+    except (TypeError, ValueError):
+        return False
+
+
+def get_high_water_listing_id(items: list, high_water_listing_id: str = None):
+    """Get the newest listing id out of the items found and the previous mark.
+
+    Args:
+        items (list): Items found.
+        high_water_listing_id (str, optional): Mark of the last run. Defaults to
+        None.
+
+    Returns:
+        str: Newest listing id, None when there is none.
+    """
+    listing_ids = [item["listing_id"] for item in items]
+    if high_water_listing_id is not None:
+        listing_ids.append(high_water_listing_id)
+
+    listing_ids = [int(listing_id) for listing_id in listing_ids if listing_id.isdigit()]
+    return str(max(listing_ids)) if len(listing_ids) > 0 else None
+
+
+def get_stop_after():
+    return int(os.getenv("INCREMENTAL_STOP_AFTER", "3"))
+
+
+def collect_items(cards, get_testid, read_item, high_water_listing_id: str = None):
+    """Build the items of the cards of a page, whichever way they were parsed.
+
+    Args:
+        cards (iterable): Cards of the page, in order.
+        get_testid (callable): Gets the data-testid of a card.
+        read_item (callable): Builds the item of a card, a card it fails on is
+        skipped.
+        high_water_listing_id (str, optional): Newest listing id of the last run,
+        stops after INCREMENTAL_STOP_AFTER older listings in a row. Defaults to
+        None.
+
+    Returns:
+        list: items found.
+    """
+    stop_after = get_stop_after()
+    old_in_a_row = 0
+
+    items_found = []
+    for card in cards:
+        if high_water_listing_id is not None:
+            if old_in_a_row >= stop_after:
+                break
+            listing_id = get_card_listing_id(get_testid(card))
+            if is_older_listing(listing_id, high_water_listing_id):
+                old_in_a_row += 1
+            else:
+                old_in_a_row = 0
+
+        # if any error with any item, skip to the next item.
+        try:
+            items_found.append(read_item(card))
+        except Exception as error:
+            print(f"Error with item: {error}")
+            items_skipped.inc()
+            continue
+
+    return items_found
+
+
+def extract_listings(
+    html: str,
+    alert_id: str,
+    hostname: str,
+    backend: str = None,
+    high_water_listing_id: str = None,
+):
+    """Extract listings from the html of a search page.
+
+    Args:
+        html (str): Html of the page.
+        alert_id (str): alert id as per db in alerts.
+        hostname (str): Hostname of the page.
+        backend (str, optional): Parser backend to use. Defaults to the fastest
+        one installed.
+        high_water_listing_id (str, optional): Newest listing id of the last run,
+        extraction stops after INCREMENTAL_STOP_AFTER older listings in a row.
+        Defaults to None, extracting every listing.
+
+    Returns:
+        list: items found, same as scrape_page.
+    """
+    backend = backend or get_default_backend()
+    if backend == SELECTOLAX_BACKEND and HTMLParser is not None:
+        return extract_listings_from_tree(
+            HTMLParser(html), alert_id, hostname, high_water_listing_id
+        )
+
+    soup = BeautifulSoup(
+        html,
+        BS4_PARSER,
+        parse_only=SoupStrainer("div", {"data-testid": CARD_TESTID_PATTERN}),
+    )
+    return extract_listings_from_soup(soup, alert_id, hostname, high_water_listing_id)
+
+
+def extract_listings_from_soup(
+    soup: BeautifulSoup,
+    alert_id: str,
+    hostname: str,
+    high_water_listing_id: str = None,
+):
+    """Extract listings from a page already loaded in BeautifulSoup.
+
+    Args:
+        soup (BeautifulSoup): Page to be scraped.
+        alert_id (str): alert id as per db in alerts.
+        hostname (str): Hostname of the page.
+        high_water_listing_id (str, optional): Newest listing id of the last run.
+        Defaults to None.
+
+    Returns:
+        list: items found.
+    """
+    try:
+        currency_pattern = get_currency_pattern(hostname)
+    except (KeyError, AttributeError) as error:
+        print(f"Unknown currency for hostname: {error}")
+        return []
+
+    def read_item(card):
+        seller = price = name = image = None
+        for tag in card.descendants:
+            if not isinstance(tag, Tag):
+                continue
+
+            if tag.name == "img":
+                if image is None:
+                    image = tag
+                continue
+
+            if tag.name != "p":
+                continue
+
+            if seller is None and tag.get("data-testid") == SELLER_TESTID:
+                seller = tag
+            title = tag.get("title")
+            if price is None and title and currency_pattern.search(title):
+                price = tag
+            style = tag.get("style")
+            if name is None and style and NAME_STYLE_PATTERN.search(style):
+                name = tag
+
+        return build_item(
+            item_id=card["data-testid"].split("-")[2],
+            name=name.getText(),
+            price=price.getText() if price else "0",
+            seller=seller.getText(),
+            image_url=image.get("src"),
+            alert_id=alert_id,
+            hostname=hostname,
+        )
+
+    return collect_items(
+        soup.find_all("div", {"data-testid": CARD_TESTID_PATTERN}),
+        lambda card: card["data-testid"],
+        read_item,
+        high_water_listing_id,
+    )
+
+
+def extract_listings_from_tree(
+    tree, alert_id: str, hostname: str, high_water_listing_id: str = None
+):
+    """Extract listings from a page parsed by selectolax.
+
+    Args:
+        tree (HTMLParser): Page to be scraped.
+        alert_id (str): alert id as per db in alerts.
+        hostname (str): Hostname of the page.
+        high_water_listing_id (str, optional): Newest listing id of the last run.
+        Defaults to None.
+
+    Returns:
+        list: items found.
+    """
+    try:
+        currency_pattern = get_currency_pattern(hostname)
+    except (KeyError, AttributeError) as error:
+        print(f"Unknown currency for hostname: {error}")
+        return []
+
+    def read_item(card):
+        seller = price = name = image = None
+        for node in card.traverse():
+            if node.tag == "img":
+                if image is None:
+                    image = node
+                continue
+
+            if node.tag != "p":
+                continue
+
+            attributes = node.attributes
+            if seller is None and attributes.get("data-testid") == SELLER_TESTID:
+                seller = node
+            title = attributes.get("title")
+            if price is None and title and currency_pattern.search(title):
+                price = node
+            style = attributes.get("style")
+            if name is None and style and NAME_STYLE_PATTERN.search(style):
+                name = node
+
+        return build_item(
+            item_id=card.attributes["data-testid"].split("-")[2],
+            name=name.text(),
+            price=price.text() if price else "0",
+            seller=seller.text(),
+            image_url=image.attributes.get("src"),
+            alert_id=alert_id,
+            hostname=hostname,
+        )
+
+    return collect_items(
+        tree.css(CARD_CSS),
+        lambda card: card.attributes["data-testid"],
+        read_item,
+        high_water_listing_id,
+    )
+
+
+def is_browser_extraction_enabled():
+    return os.getenv("BROWSER_EXTRACTION", "true") == "true"
+
+
+def extract_listings_in_browser(
+    driver, alert_id: str, hostname: str, high_water_listing_id: str = None
+):
+    """Extract listings from the page loaded in a browser, collecting the card
+    fields with CARD_FIELDS_SCRIPT instead of sending the whole page over.
+
+    Args:
+        driver (webdriver): Webdriver from selenium, with the page loaded.
+        alert_id (str): alert id as per db in alerts.
+        hostname (str): Hostname of the page.
+        high_water_listing_id (str, optional): Newest listing id of the last run.
+        Defaults to None.
+
+    Returns:
+        list: items found, same as extract_listings.
+    """
+    try:
+        currency_pattern = get_currency_pattern(hostname)
+    except (KeyError, AttributeError) as error:
+        print(f"Unknown currency for hostname: {error}")
+        return []
+
+    cards = driver.execute_script(
+        CARD_FIELDS_SCRIPT,
+        CARD_CSS,
+        SELLER_TESTID,
+        currency_pattern.pattern,
+        NAME_STYLE_PATTERN.pattern,
+    )
+    return extract_listings_from_cards(cards, alert_id, hostname, high_water_listing_id)
+
+
+def extract_listings_from_cards(
+    cards: list, alert_id: str, hostname: str, high_water_listing_id: str = None
+):
+    """Extract listings from the card fields collected by CARD_FIELDS_SCRIPT.
+
+    Args:
+        cards (list): data-testid, name, price, seller, whether there is an image
+        and its src, of each card.
+        alert_id (str): alert id as per db in alerts.
+        hostname (str): Hostname of the page.
+        high_water_listing_id (str, optional): Newest listing id of the last run.
+        Defaults to None.
+
+    Returns:
+        list: items found.
+    """
+    def read_item(card):
+        testid, name, price, seller, has_image, image_url = card
+        if name is None or seller is None or not has_image:
+            raise AttributeError("card is missing its name, seller or image")
+
+        return build_item(
+            item_id=testid.split("-")[2],
+            name=name,
+            price=price if price is not None else "0",
+            seller=seller,
+            image_url=image_url,
+            alert_id=alert_id,
+            hostname=hostname,
+        )
+
+    return collect_items(
+        cards, lambda card: card[0], read_item, high_water_listing_id
+    )
+
+
+def build_item(item_id, name, price, seller, image_url, alert_id, hostname):
+    """Build the listing dict to be saved in db.
+
+    Returns:
+        dict: listing.
+    """
+    urlify_name = NON_WORD_PATTERN.sub("", name)
+    urlify_name = SPACES_PATTERN.sub("-", urlify_name)
+    if urlify_name[0] == "-":
+        urlify_name = urlify_name[1:]
+    if urlify_name[-1] == "-":
+        urlify_name = urlify_name[:-1]
+    clean_price = price.replace("$", "").replace(",", "")
+    clean_price = LETTERS_PATTERN.sub("", clean_price).strip()
+
+    return {
+        "listing_id": item_id,
+        "detail_url": f"{hostname}/p/{urlify_name}-{item_id}",
+        "image_url": image_url,
+        "name": name,
+        "price": float(clean_price),
+        "seller": seller,
+        "date_found": date.today().isoformat(),
+        "alert_id": alert_id,
+    }
@@ -0,0 +1,125 @@
+"""Batched dedupe and insert of the listings found by a scrape."""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pocketbase import PocketBase
+
+from repository import filter_any, filter_equals
+
+
+def find_existing_listing_ids(
+    client: PocketBase, alert_id: str, listing_ids: list, chunk_size: int = None
+):
+    """Find which listing ids are already saved for an alert.
+
+    The filter is sent in chunks so that the query string stays short, and every
+    chunk is scoped to the alert.
+
+    Args:
+        client (PocketBase): Client shared by the calls.
+        alert_id (str): alert id as per db in alerts.
+        listing_ids (list): Listing ids to look for.
+        chunk_size (int, optional): Listing ids per query. Defaults to
+        LISTING_FILTER_CHUNK_SIZE or 50.
+
+    Returns:
+        set: Listing ids already in db.
+    """
+    chunk_size = chunk_size or int(os.getenv("LISTING_FILTER_CHUNK_SIZE", "50"))
+
+    existing_listing_ids = set()
+    for index in range(0, len(listing_ids), chunk_size):
+        chunk = listing_ids[index:index + chunk_size]
+        listings = client.collection("listings").get_list(
+            1,
+            len(chunk),
+            query_params={
+                "filter": f'{filter_equals("alert_id", alert_id)} && '
+                f'{filter_any("listing_id", chunk)}'
+            },
+        )
+        existing_listing_ids.update(listing.listing_id for listing in listings.items)
+
+    return existing_listing_ids
+
+
+def bulk_create_listings(
+    client: PocketBase,
+    items: list,
+    alert_id: str,
+    max_workers: int = None,
+    seen_index=None,
+):
+    """Create the listings which are not in db yet, concurrently over one client.
+
+    Args:
+        client (PocketBase): Client shared by the calls.
+        items (list): Listings found by the scrape.
+        alert_id (str): alert id as per db in alerts.
+        max_workers (int, optional): Concurrent inserts. Defaults to
+        LISTING_INSERT_CONCURRENCY or 8.
+        seen_index (SeenIndex, optional): Listings known to be in db, these are not
+        looked up. Updated with the listings found in or saved to db. Defaults to
+        None.
+
+    Returns:
+        tuple: Listings created, in the order they were found, and stats with the
+        counts and timings of the lookup and insert.
+    """
+    max_workers = max_workers or int(os.getenv("LISTING_INSERT_CONCURRENCY", "8"))
+
+    unique_items = []
+    seen_listing_ids = set()
+    for item in items:
+        if item["listing_id"] not in seen_listing_ids:
+            seen_listing_ids.add(item["listing_id"])
+            unique_items.append(item)
+
+    unseen_items = [
+        item
+        for item in unique_items
+        if seen_index is None or item["listing_id"] not in seen_index
+    ]
+
+    start = time.perf_counter()
+    existing_listing_ids = find_existing_listing_ids(
+        client, alert_id, [item["listing_id"] for item in unseen_items]
+    )
+    lookup_seconds = time.perf_counter() - start
+
+    new_items = [
+        item for item in unseen_items if item["listing_id"] not in existing_listing_ids
+    ]
+
+    def create(item):
+        try:
+            client.collection("listings").create(item)
+            return True
+        except Exception as error:
+            print(f"Could not create listing {item['listing_id']}... {error}")
+            return False
+
+    start = time.perf_counter()
+    results = []
+    if len(new_items) > 0:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(new_items))) as pool:
+            results = list(pool.map(create, new_items))
+    insert_seconds = time.perf_counter() - start
+
+    created_items = [item for item, created in zip(new_items, results) if created]
+    if seen_index is not None:
+        seen_index.update(existing_listing_ids)
+        seen_index.update(item["listing_id"] for item in created_items)
+
+    stats = {
+        "found": len(items),
+        "skipped_by_index": len(unique_items) - len(unseen_items),
+        "existing": len(existing_listing_ids),
+        "created": len(created_items),
+        "failed": len(new_items) - len(created_items),
+        "lookup_seconds": round(lookup_seconds, 3),
+        "insert_seconds": round(insert_seconds, 3),
+    }
+    return created_items, stats
@@ -0,0 +1,205 @@
+"""Notifications of new listings, delivered by their own celery queue.
+
+Every message is keyed by its alert and the listings in it, and the key is saved
+once the message is sent, so a retried or redelivered task never sends it twice.
+
+Messages are packed by length up to Telegram's limit. In digest mode, the
+messages of every alert of a chat are buffered in db and packed together when
+the chat is flushed, after DIGEST_WINDOW_SECONDS or once DIGEST_MAX_MESSAGES
+are waiting.
+"""
+
+import os
+import time
+import hashlib
+from datetime import datetime, timezone
+
+from metrics import Histogram
+
+FIRST_RUN_KEY = "first-run"
+MESSAGE_LIMIT = 4096
+# Room kept in every message for the footers.
+FOOTER_RESERVE = 1024
+FEEDBACK_FOOTER = "We are constantly improving! \n\
+Contact me@buildersjam.com for feedback and enquires! 💯💯\n\n"
+
+delivery_latency = Histogram("notification_delivery_seconds")
+task_duration = Histogram("notification_task_seconds")
+
+
+def get_notification_queue():
+    """Get the queue notifications are sent through.
+
+    Returns:
+        str: Name of the queue.
+    """
+    return os.getenv("NOTIFICATION_QUEUE", "notifications")
+
+
+def is_notification_queue_enabled():
+    return os.getenv("NOTIFICATION_QUEUE_ENABLED", "true") == "true"
+
+
+def get_digest_window_seconds():
+    """Get how long notifications of a chat are buffered, 0 when they are not.
+
+    Returns:
+        float: Seconds.
+    """
+    return float(os.getenv("DIGEST_WINDOW_SECONDS", "0"))
+
+
+def get_digest_max_messages():
+    return int(os.getenv("DIGEST_MAX_MESSAGES", "20"))
+
+
+def get_alert_footer(query=None, from_range=None, to_range=None, initial_url=None):
+    """Get the search of an alert, shown under its listings.
+
+    Args:
+        query (str, optional): Search query of the alert. Defaults to None.
+        from_range (float, optional): Minimum price. Defaults to None.
+        to_range (float, optional): Maximum price. Defaults to None.
+        initial_url (str, optional): Url pasted by the user. Defaults to None.
+
+    Returns:
+        str: Footer of the alert.
+    """
+    footer = "----- ----- -----\n"
+    if initial_url is not None:
+        footer += f"Initial URL: {initial_url[:FOOTER_RESERVE // 2]}\n"
+    else:
+        footer += f'Query: {query}\n\
+Minimum Price: {"-" if from_range== 0 else ("$" + str(from_range))}\n\
+Maximum Price: {"-" if to_range== 0 else ("$" + str(to_range))}\n'
+
+    footer += "----- ----- -----\n"
+    return footer
+
+
+def pack_blocks(blocks: list, limit: int = MESSAGE_LIMIT - FOOTER_RESERVE):
+    """Pack listings into as few messages as fit in the limit, in order.
+
+    Args:
+        blocks (list): Listing id and text of each listing.
+        limit (int, optional): Max length of a message. Defaults to the telegram
+        limit less the room for the footers.
+
+    Returns:
+        tuple: Messages and the listing ids in each message.
+    """
+    messages = []
+    message_listing_ids = []
+    for listing_id, text in blocks:
+        text = text[:limit]
+        if len(messages) == 0 or len(messages[-1]) + len(text) > limit:
+            messages.append("")
+            message_listing_ids.append([])
+        messages[-1] += text
+        message_listing_ids[-1].append(listing_id)
+
+    return messages, message_listing_ids
+
+
+def pack_digest(entries: list, limit: int = MESSAGE_LIMIT):
+    """Pack the buffered messages of a chat together, each alert followed by its
+    footer and each message ending with the feedback footer.
+
+    Args:
+        entries (list): Buffered messages, with a text, footer, alert_id and key,
+        oldest first.
+        limit (int, optional): Max length of a message. Defaults to the telegram
+        limit.
+
+    Returns:
+        list: Texts and the keys of the entries in each.
+    """
+    by_alert = {}
+    for entry in entries:
+        by_alert.setdefault(entry["alert_id"], []).append(entry)
+
+    messages = []
+    text = ""
+    keys = []
+    for alert_entries in by_alert.values():
+        footer = alert_entries[0]["footer"]
+        section = ""
+        for entry in alert_entries:
+            length = len(text) + len(section) + len(entry["text"]) + len(footer)
+            if length + len(FEEDBACK_FOOTER) > limit and (text or section):
+                if section:
+                    text += section + footer
+                messages.append((text + FEEDBACK_FOOTER, keys))
+                text, section, keys = "", "", []
+            section += entry["text"]
+            keys.append(entry["key"])
+        text += section + footer
+
+    if keys:
+        messages.append((text + FEEDBACK_FOOTER, keys))
+    return messages
+
+
+def get_notification_key(alert_id: str, listing_ids: list):
+    """Get the idempotency key of a message.
+
+    Args:
+        alert_id (str): alert id as per db in alerts.
+        listing_ids (list): Listing ids in the message, FIRST_RUN_KEY for the
+        message of a first run.
+
+    Returns:
+        str: Same key for the same alert and listings.
+    """
+    digest = hashlib.sha1(",".join(sorted(listing_ids)).encode()).hexdigest()
+    return f"{alert_id}:{digest[:20]}"
+
+
+def build_notifications(alert_id: str, messages: list, message_listing_ids: list):
+    """Pair every message with its idempotency key.
+
+    Args:
+        alert_id (str): alert id as per db in alerts.
+        messages (list): Messages from create_listing_to_db.
+        message_listing_ids (list): Listing ids in each message.
+
+    Returns:
+        list: Notifications with a key and a text.
+    """
+    return [
+        {"key": get_notification_key(alert_id, listing_ids), "text": text}
+        for text, listing_ids in zip(messages, message_listing_ids)
+    ]
+
+
+def parse_created(created: str):
+    """Parse the created date PocketBase sets, in UTC, as epoch seconds.
+
+    Args:
+        created (str): created as per db.
+
+    Returns:
+        float: Epoch seconds, now when it can not be parsed.
+    """
+    try:
+        created = datetime.fromisoformat(str(created).replace("Z", "+00:00"))
+    except ValueError:
+        return time.time()
+
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    return created.timestamp()
+
+
+def observe_delivery(enqueued_at: float, started_at: float, num_of_sent: int):
+    """Record the latency of the messages of a task.
+
+    Args:
+        enqueued_at (float): Epoch seconds the notifications were queued at.
+        started_at (float): Monotonic seconds the task started at.
+        num_of_sent (int): Messages delivered.
+    """
+    latency = time.time() - enqueued_at
+    for _ in range(num_of_sent):
+        delivery_latency.observe(latency)
+    task_duration.observe(time.monotonic() - started_at)
@@ -0,0 +1,331 @@
+"""Decide which alerts get scraped together, and when."""
+
+import os
+import math
+import random
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from urllib.parse import parse_qsl, quote, unquote, urlencode, urlparse, urlunparse
+
+from workers.fetchers import SELENIUM_BACKEND
+
+# Alerts whose listing rate is not known yet run at a random interval in between.
+UNKNOWN_RATE_SECONDS = (150, 600)
+
+
+def canonicalize_url(url: str):
+    """Normalize a search url so the same search always gives the same url.
+
+    Host is lowercased, query params are sorted, whole number prices lose their
+    decimals and the path is re-quoted the same way.
+
+    Args:
+        url (str): Url to be scraped.
+
+    Returns:
+        str: Canonical url.
+    """
+    parsed = urlparse(url.strip())
+
+    params = []
+    for key, value in parse_qsl(parsed.query, keep_blank_values=True):
+        try:
+            if float(value).is_integer():
+                value = str(int(float(value)))
+        except ValueError:
+            pass
+        params.append((key, value))
+    params.sort()
+
+    path = quote(unquote(parsed.path))
+    if not path.endswith("/"):
+        path += "/"
+
+    return urlunparse(
+        (
+            parsed.scheme.lower() or "https",
+            parsed.netloc.lower(),
+            path,
+            "",
+            urlencode(params),
+            "",
+        )
+    )
+
+
+def group_jobs_by_url(jobs: list):
+    """Group scrape jobs which search for the same thing.
+
+    First time alerts are kept apart from the others as they load every page.
+
+    Args:
+        jobs (list): Jobs with the arguments of scrape_carousell_with_params and
+        the url they scrape.
+
+    Returns:
+        dict: Jobs by (canonical url, is_first_time).
+    """
+    groups = {}
+    for job in jobs:
+        key = (canonicalize_url(job["url"]), bool(job.get("is_first_time")))
+        groups.setdefault(key, []).append(job)
+
+    return groups
+
+
+def get_group_high_water_listing_id(jobs: list):
+    """Get the oldest high water mark of a group, so every alert gets its new
+    listings.
+
+    Args:
+        jobs (list): Jobs of the group.
+
+    Returns:
+        str: Oldest mark, None if any alert has no mark yet.
+    """
+    marks = [job.get("high_water_listing_id") for job in jobs]
+    if any(mark is None or not str(mark).isdigit() for mark in marks):
+        return None
+
+    return min(marks, key=int)
+
+
+def get_group_fetch_backend(jobs: list):
+    """Get the backend recorded for a group, selenium if any alert needed it.
+
+    Args:
+        jobs (list): Jobs of the group.
+
+    Returns:
+        str: Backend recorded.
+    """
+    if any(job.get("fetch_backend") == SELENIUM_BACKEND for job in jobs):
+        return SELENIUM_BACKEND
+
+    return jobs[0].get("fetch_backend")
+
+
+def get_scrape_slots():
+    """Get how many scrapes can run at once, the smaller of the worker concurrency
+    and the selenium sessions.
+
+    Returns:
+        int: Scrapes which can run at once.
+    """
+    return min(
+        int(os.getenv("SCRAPE_WORKER_CONCURRENCY", "3")),
+        int(os.getenv("SELENIUM_MAX_SESSIONS", "3")),
+    )
+
+
+def get_average_scrape_seconds(durations: list):
+    """Get the average duration of the last scrapes.
+
+    Args:
+        durations (list): Seconds taken by the last scrapes.
+
+    Returns:
+        float: Average seconds, SCRAPE_DEFAULT_SECONDS when nothing was measured.
+    """
+    durations = [duration for duration in durations if duration and duration > 0]
+    if len(durations) == 0:
+        return float(os.getenv("SCRAPE_DEFAULT_SECONDS", "30"))
+
+    return sum(durations) / len(durations)
+
+
+def get_scrape_capacity(in_flight: int, average_scrape_seconds: float, tick_seconds=60):
+    """Get how many scrapes to queue so the slots stay busy until the next tick
+    without the queue growing.
+
+    Args:
+        in_flight (int): Alerts queued or running, waiting in the broker, reserved
+        by a worker or being scraped. Alerts sharing a scrape count once each, so
+        it errs on queuing less.
+        average_scrape_seconds (float): Average duration of a scrape.
+        tick_seconds (int, optional): Seconds until the next tick. Defaults to 60.
+
+    Returns:
+        int: Scrapes to queue.
+    """
+    slots = get_scrape_slots()
+    scrapes_per_tick = math.ceil(slots * tick_seconds / max(average_scrape_seconds, 1))
+    return max(0, slots + scrapes_per_tick - in_flight)
+
+
+def parse_db_datetime(value):
+    """Parse a date of the db, saved as local time like datetime.today().
+
+    Args:
+        value (str): Date as per db.
+
+    Returns:
+        datetime: Naive datetime, None when it can not be parsed.
+    """
+    try:
+        return datetime.fromisoformat(str(value)).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def get_lag_seconds(next_time_to_run: str, now: datetime = None):
+    """Get how late an alert is compared to when it should have run.
+
+    Args:
+        next_time_to_run (str): next_time_to_run as per db in alerts.
+        now (datetime, optional): Defaults to now.
+
+    Returns:
+        float: Seconds late, 0 when it can not be parsed.
+    """
+    now = now or datetime.today()
+    next_time_to_run = parse_db_datetime(next_time_to_run)
+    if next_time_to_run is None:
+        return 0
+
+    return max(0, (now - next_time_to_run).total_seconds())
+
+
+def get_target_interval_seconds(listing_rate: float):
+    """Get the interval an alert asks for from how fast it gets new listings,
+    before it is spread out.
+
+    Busy alerts run as often as ADAPTIVE_MIN_SECONDS, quiet ones back off up to
+    ADAPTIVE_MAX_SECONDS, aiming for ADAPTIVE_TARGET_LISTINGS new listings a run.
+
+    Args:
+        listing_rate (float): Estimated new listings per hour, None when unknown.
+
+    Returns:
+        float: Interval in seconds, the middle of UNKNOWN_RATE_SECONDS when the rate
+        is unknown.
+    """
+    min_seconds = float(os.getenv("ADAPTIVE_MIN_SECONDS", "120"))
+    max_seconds = float(os.getenv("ADAPTIVE_MAX_SECONDS", "1800"))
+    target_listings = float(os.getenv("ADAPTIVE_TARGET_LISTINGS", "1"))
+
+    if listing_rate is None:
+        return sum(UNKNOWN_RATE_SECONDS) / 2
+    if listing_rate <= 0:
+        return max_seconds
+    return min(max(target_listings * 3600 / listing_rate, min_seconds), max_seconds)
+
+
+def get_known_listing_rate(alert):
+    """Get the listing rate of an alert, only known once the alert ran twice.
+
+    The rate is written empty after the first run, which PocketBase reads back as
+    0, so 0 is taken as unknown too. An alert measured at 0 is measured afresh on
+    its next run, and its interval is still picked from the 0 measured.
+
+    Args:
+        alert (Record): Alert as per db in alerts.
+
+    Returns:
+        float: Estimated new listings per hour, None when unknown.
+    """
+    if not getattr(alert, "last_scraped_at", None) or alert.is_first_scrape:
+        return None
+    return getattr(alert, "listing_rate", None) or None
+
+
+def get_scrape_demand(listing_rates: list):
+    """Get how many scrapes a second the alerts ask for at their target
+    intervals.
+
+    Args:
+        listing_rates (list): Estimated new listings per hour of each alert which
+        has not expired, None when unknown.
+
+    Returns:
+        float: Scrapes a second.
+    """
+    return sum(
+        1 / get_target_interval_seconds(listing_rate) for listing_rate in listing_rates
+    )
+
+
+def get_capacity_load(scrape_demand: float, average_scrape_seconds: float):
+    """Get how much of the scrape slots the alerts ask for.
+
+    Args:
+        scrape_demand (float): Scrapes a second asked for, from get_scrape_demand.
+        average_scrape_seconds (float): Average duration of a scrape.
+
+    Returns:
+        float: Share of the slots asked for, over 1 when over capacity.
+    """
+    return scrape_demand * average_scrape_seconds / get_scrape_slots()
+
+
+def get_budget_interval_seconds(listing_rate: float, capacity_load: float):
+    """Get the shortest interval an alert can have without going over capacity.
+
+    The budget is shared by listing rate: over capacity every alert backs off
+    from its target interval by the same factor, so busy alerts keep running more
+    often than quiet ones. If no alert runs more often than this, all of them fit
+    in the scrape slots.
+
+    Args:
+        listing_rate (float): Estimated new listings per hour, None when unknown.
+        capacity_load (float): Share of the slots asked for, from
+        get_capacity_load.
+
+    Returns:
+        float: Shortest interval in seconds.
+    """
+    return get_target_interval_seconds(listing_rate) * capacity_load
+
+
+def update_listing_rate(
+    listing_rate: float, new_listings: int, seconds_since_last_run: float
+):
+    """Update the estimated new listings per hour of an alert with its last run.
+
+    Args:
+        listing_rate (float): Estimate so far, None when there is none.
+        new_listings (int): New listings found by the last run.
+        seconds_since_last_run (float): Seconds between the last two runs.
+
+    Returns:
+        float: New estimate, an exponential moving average.
+    """
+    if seconds_since_last_run <= 0:
+        return listing_rate
+
+    rate = new_listings * 3600 / seconds_since_last_run
+    if listing_rate is None:
+        return rate
+
+    smoothing = float(os.getenv("ADAPTIVE_SMOOTHING", "0.3"))
+    return smoothing * rate + (1 - smoothing) * listing_rate
+
+
+def get_adaptive_next_time_to_run(listing_rate: float, capacity_load: float = None):
+    """Get when an alert should run next from how fast it gets new listings, see
+    get_target_interval_seconds.
+
+    Args:
+        listing_rate (float): Estimated new listings per hour, None when unknown.
+        capacity_load (float, optional): Share of the slots asked for, the
+        interval is held to the budget of the alert. Defaults to None.
+
+    Returns:
+        datetime: Next time to run.
+    """
+    min_seconds = float(os.getenv("ADAPTIVE_MIN_SECONDS", "120"))
+    max_seconds = float(os.getenv("ADAPTIVE_MAX_SECONDS", "1800"))
+
+    if listing_rate is None:
+        seconds = random.uniform(*UNKNOWN_RATE_SECONDS)
+    else:
+        seconds = get_target_interval_seconds(listing_rate)
+
+    # Spread alerts out so they do not all come due on the same tick.
+    seconds *= random.uniform(0.9, 1.1)
+
+    seconds = min(max(seconds, min_seconds), max_seconds)
+    if capacity_load is not None:
+        seconds = max(seconds, get_budget_interval_seconds(listing_rate, capacity_load))
+
+    return datetime.today() + relativedelta(seconds=seconds)
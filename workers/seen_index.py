@@ -0,0 +1,197 @@
+"""Per-alert index of the listing ids already saved in db.
+
+Kept on disk by the workers as a sorted array of ids, one file per alert, so that
+only listings which have not been seen before need to be looked up in db.
+
+Rebuild the index of alerts from db after a cold start with:
+    python -m workers.seen_index rebuild [alert_id ...]
+"""
+
+import os
+import sys
+import json
+import tempfile
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+from pocketbase import PocketBase
+
+from db import get_client
+from repository import filter_equals, quote_filter_value
+
+
+def get_index_dir():
+    """Get the directory the indexes are kept in.
+
+    Returns:
+        str: Directory of the indexes.
+    """
+    return os.getenv("SEEN_INDEX_DIR", "seen_index")
+
+
+def parse_expire_at(expire_at):
+    """Parse the expire_at of an alert as an aware datetime.
+
+    Args:
+        expire_at (str): expire_at as per db in alerts.
+
+    Returns:
+        datetime: expire_at, None when it can not be parsed.
+    """
+    try:
+        expire_at = datetime.fromisoformat(str(expire_at))
+    except ValueError:
+        return None
+
+    if expire_at.tzinfo is None:
+        expire_at = expire_at.replace(tzinfo=timezone.utc)
+    return expire_at
+
+
+class SeenIndex:
+    """Listing ids of an alert which are known to be in db."""
+
+    def __init__(self, alert_id: str, listing_ids=(), expire_at: str = None):
+        self.alert_id = alert_id
+        self.listing_ids = set(listing_ids)
+        self.expire_at = expire_at
+
+    def __contains__(self, listing_id):
+        return listing_id in self.listing_ids
+
+    def __len__(self):
+        return len(self.listing_ids)
+
+    def update(self, listing_ids):
+        """Mark listings as saved in db.
+
+        Args:
+            listing_ids (iterable): Listing ids saved in db.
+        """
+        self.listing_ids.update(listing_ids)
+
+    @classmethod
+    def load(cls, alert_id: str, expire_at: str = None):
+        """Load the index of an alert, empty when there is none on disk yet.
+
+        Args:
+            alert_id (str): alert id as per db in alerts.
+            expire_at (str, optional): expire_at of the alert, kept for eviction.
+            Defaults to the one saved with the index.
+
+        Returns:
+            SeenIndex: Index of the alert.
+        """
+        try:
+            with open(get_index_path(alert_id), encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return cls(alert_id, expire_at=expire_at)
+
+        return cls(
+            alert_id, data["listing_ids"], expire_at=expire_at or data["expire_at"]
+        )
+
+    def save(self):
+        """Write the index to disk, replacing the previous one atomically."""
+        directory = get_index_dir()
+        os.makedirs(directory, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, suffix=".tmp", delete=False, encoding="utf-8"
+        ) as file:
+            json.dump(
+                {
+                    "expire_at": self.expire_at,
+                    "listing_ids": sorted(self.listing_ids),
+                },
+                file,
+                separators=(",", ":"),
+            )
+        os.replace(file.name, get_index_path(self.alert_id))
+
+
+def get_index_path(alert_id: str):
+    return os.path.join(get_index_dir(), f"{alert_id}.json")
+
+
+def evict_expired_indexes(now: datetime = None):
+    """Delete the indexes of alerts which have expired.
+
+    Args:
+        now (datetime, optional): Aware datetime to compare against. Defaults to
+        now.
+
+    Returns:
+        int: Number of indexes deleted.
+    """
+    now = now or datetime.now(timezone.utc)
+    directory = get_index_dir()
+    if not os.path.isdir(directory):
+        return 0
+
+    num_of_evicted = 0
+    for filename in os.listdir(directory):
+        if not filename.endswith(".json"):
+            continue
+
+        index = SeenIndex.load(filename[: -len(".json")])
+        expire_at = parse_expire_at(index.expire_at)
+        if expire_at is not None and expire_at < now:
+            # Another worker of the host may have evicted it first.
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                continue
+            num_of_evicted += 1
+
+    return num_of_evicted
+
+
+def rebuild_index(client: PocketBase, alert):
+    """Rebuild the index of an alert from the listings in db.
+
+    Args:
+        client (PocketBase): PocketBase client.
+        alert (Record): Alert as per db in alerts.
+
+    Returns:
+        SeenIndex: Index of the alert.
+    """
+    listings = client.collection("listings").get_full_list(
+        batch=500,
+        query_params={"filter": filter_equals("alert_id", alert.id)},
+    )
+    index = SeenIndex(
+        alert.id, [listing.listing_id for listing in listings], alert.expire_at
+    )
+    index.save()
+    return index
+
+
+def main(args):
+    if len(args) == 0 or args[0] != "rebuild":
+        print(__doc__)
+        return 1
+
+    load_dotenv()
+    client = get_client()
+
+    if len(args) > 1:
+        alerts = [client.collection("alerts").get_one(alert_id) for alert_id in args[1:]]
+    else:
+        alerts = client.collection("alerts").get_full_list(
+            query_params={
+                "filter": f"expire_at > {quote_filter_value(datetime.today())}"
+            }
+        )
+
+    for alert in alerts:
+        index = rebuild_index(client, alert)
+        print(f"rebuilt index with {len(index)} listings... [{alert.id}]")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
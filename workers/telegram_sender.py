@@ -0,0 +1,230 @@
+"""Long-lived telegram sender of a worker process.
+
+One Bot, with its pool of connections, is kept on an event loop running in its
+own thread, so celery tasks can hand messages over without setting up a loop and
+a bot every time. Messages to different chats go out concurrently, within
+Telegram's limits of about 30 messages a second overall and 1 a second per chat,
+and messages which are rate limited are sent again after retry_after. The overall
+limit is shared by every process sending for the bot, so each process gets its
+share of it.
+"""
+
+import os
+import time
+import asyncio
+import threading
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+
+from metrics import SCRAPE_STAGE_SECONDS, STAGE_BUCKETS, get_histogram
+
+# Chats not sent to for this long drop their lock and rate limiter.
+CHAT_IDLE_SECONDS = 60.0
+
+SENT = "sent"
+REJECTED = "rejected"
+FAILED = "failed"
+
+
+class RateLimiter:
+    """Spaces out calls so there are at most `rate` a second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_time = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+    def delay(self, seconds: float):
+        """Hold back the calls after this one, e.g. when told to retry later."""
+        self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+
+class TelegramSender:
+    """Send telegram messages from sync code over one shared bot.
+
+    Args:
+        token (str): Telegram bot token.
+        max_concurrency (int, optional): Messages in flight at once, also the size
+        of the connection pool. Defaults to 8.
+        global_rate (float, optional): Messages a second overall. Defaults to 30.
+        chat_rate (float, optional): Messages a second to one chat. Defaults to 1.
+        max_retries (int, optional): Times a message is sent again after a rate
+        limit or network error. Defaults to 3.
+        bot (Bot, optional): Bot to send with. Defaults to a new one.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        max_concurrency=8,
+        global_rate=30.0,
+        chat_rate=1.0,
+        max_retries=3,
+        bot=None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.chat_limiters = {}
+        self.chat_locks = {}
+        # Sends to each chat in progress or waiting for its lock.
+        self.chat_sends = {}
+        self.next_eviction_time = time.monotonic() + CHAT_IDLE_SECONDS
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="telegram-sender", daemon=True
+        )
+        self.thread.start()
+
+        self.bot = bot or Bot(
+            token=token,
+            request=HTTPXRequest(
+                connection_pool_size=max_concurrency, pool_timeout=30.0
+            ),
+        )
+        self.run(self._start())
+
+    async def _start(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.global_limiter = RateLimiter(self.global_rate)
+        await self.bot.initialize()
+
+    def run(self, coroutine):
+        """Run a coroutine on the loop of the sender and wait for it.
+
+        Returns:
+            Any: Result of the coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def submit(self, chat_id: str, texts: list):
+        """Queue messages to a chat without waiting for them to be sent.
+
+        Args:
+            chat_id (str): Telegram chat to send to.
+            texts (list): Messages, sent in this order.
+
+        Returns:
+            Future: Resolves with the stats of the delivery.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.send_to_chat(chat_id, texts), self.loop
+        )
+
+    def send(self, chat_id: str, texts: list):
+        """Send messages to a chat and wait until they are sent.
+
+        Returns:
+            dict: Stats of the delivery.
+        """
+        return self.submit(chat_id, texts).result()
+
+    async def send_to_chat(self, chat_id: str, texts: list):
+        start = time.monotonic()
+        stats = {"sent": 0, "failed": 0, "retries": 0, "results": []}
+
+        # Messages of a chat stay in order, chats are sent to concurrently.
+        lock = self.chat_locks.setdefault(chat_id, asyncio.Lock())
+        limiter = self.chat_limiters.setdefault(chat_id, RateLimiter(self.chat_rate))
+        self.chat_sends[chat_id] = self.chat_sends.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                for text in texts:
+                    result, retries = await self.send_message(chat_id, text, limiter)
+                    stats["results"].append(result)
+                    stats["sent" if result == SENT else "failed"] += 1
+                    stats["retries"] += retries
+        finally:
+            self.chat_sends[chat_id] -= 1
+            self.evict_idle_chats()
+
+        stats["seconds"] = round(time.monotonic() - start, 3)
+        get_histogram(SCRAPE_STAGE_SECONDS, STAGE_BUCKETS, stage="telegram_send").observe(
+            stats["seconds"]
+        )
+        return stats
+
+    def evict_idle_chats(self):
+        """Drop the lock and rate limiter of chats with no sends going on and no
+        rate limit left to wait out, checked every CHAT_IDLE_SECONDS."""
+        now = time.monotonic()
+        if now < self.next_eviction_time:
+            return
+        self.next_eviction_time = now + CHAT_IDLE_SECONDS
+
+        for chat_id, num_of_sends in list(self.chat_sends.items()):
+            if num_of_sends == 0 and self.chat_limiters[chat_id].next_time <= now:
+                del self.chat_sends[chat_id]
+                del self.chat_locks[chat_id]
+                del self.chat_limiters[chat_id]
+
+    async def send_message(self, chat_id: str, text: str, limiter: RateLimiter):
+        """Send one message, again after rate limits and network errors.
+
+        Returns:
+            tuple: SENT, REJECTED when telegram refused it or FAILED when it
+            still failed after the retries, and the retries it took.
+        """
+        for attempt in range(self.max_retries + 1):
+            await limiter.wait()
+            await self.global_limiter.wait()
+            try:
+                async with self.semaphore:
+                    await self.bot.send_message(
+                        chat_id, text, parse_mode="html", disable_web_page_preview=True
+                    )
+                return SENT, attempt
+            except BadRequest as error:
+                print(f"Could not send message to {chat_id}... {error}")
+                return REJECTED, attempt
+            except RetryAfter as error:
+                print(f"Telegram rate limited, retrying after {error.retry_after}s...")
+                # The limit may be of the bot, not only of the chat.
+                limiter.delay(error.retry_after)
+                self.global_limiter.delay(error.retry_after)
+            except (TimedOut, NetworkError) as error:
+                print(f"Telegram network error, retrying... {error}")
+                await asyncio.sleep(2**attempt)
+            except Exception as error:
+                print(f"Could not send message to {chat_id}... {error}")
+                return REJECTED, attempt
+
+        print(f"Could not send message to {chat_id} after {self.max_retries} retries")
+        return FAILED, self.max_retries
+
+    def close(self):
+        """Shut the bot down and stop the loop."""
+        try:
+            self.run(self.bot.shutdown())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=5)
+
+
+def init_telegram_sender():
+    """Create a sender from env. TELEGRAM_GLOBAL_RATE is split between the
+    TELEGRAM_SENDER_PROCESSES sending for the bot, by default the 3 processes of
+    the scrape worker and the 2 of the notification worker.
+
+    Returns:
+        TelegramSender: Sender of the process.
+    """
+    num_of_processes = max(1, int(os.getenv("TELEGRAM_SENDER_PROCESSES", "5")))
+    return TelegramSender(
+        os.getenv("TELEGRAM_TOKEN"),
+        max_concurrency=int(os.getenv("TELEGRAM_MAX_CONCURRENCY", "8")),
+        global_rate=float(os.getenv("TELEGRAM_GLOBAL_RATE", "30")) / num_of_processes,
+        chat_rate=float(os.getenv("TELEGRAM_CHAT_RATE", "1")),
+        max_retries=int(os.getenv("TELEGRAM_MAX_RETRIES", "3")),
+    )